@@ -31,20 +31,56 @@ DOMAINS=${DOMAINS:-localhost}
 URL=${URL:-http://localhost}
 PASSWORD=${PASSWORD:-}
 ALLOWED_IPS=${ALLOWED_IPS:-}
+STORAGE=${STORAGE:-files}
+SEARCH_INDEX=${SEARCH_INDEX:-false}
 
 [MAILSERVER]
 MAILPORT=${MAILPORT:-25}
 DISCARD_UNKNOWN=${DISCARD_UNKNOWN:-true}
 ATTACHMENTS_MAX_SIZE=${ATTACHMENTS_MAX_SIZE:-0}
+MESSAGE_MAX_SIZE=${MESSAGE_MAX_SIZE:-33554432}
 MAILPORT_TLS=${MAILPORT_TLS:-0}
 TLS_CERTIFICATE=${TLS_CERTIFICATE:-}
 TLS_PRIVATE_KEY=${TLS_PRIVATE_KEY:-0}
+INGEST_EXECUTOR=${INGEST_EXECUTOR:-inline}
+INGEST_WORKERS=${INGEST_WORKERS:-0}
+SPOOL_THRESHOLD=${SPOOL_THRESHOLD:-0}
+MAX_CONCURRENT_DATA=${MAX_CONCURRENT_DATA:-0}
+MAX_INFLIGHT_BYTES=${MAX_INFLIGHT_BYTES:-0}
+IP_RATE_LIMIT=${IP_RATE_LIMIT:-0}
+IP_RATE_BURST=${IP_RATE_BURST:-0}
+DOMAIN_RATE_LIMIT=${DOMAIN_RATE_LIMIT:-0}
+DOMAIN_RATE_BURST=${DOMAIN_RATE_BURST:-0}
+FSYNC=${FSYNC:-none}
+FSYNC_BATCH_WINDOW=${FSYNC_BATCH_WINDOW:-5}
+COMPRESSION=${COMPRESSION:-none}
+WORKERS=${WORKERS:-1}
+; 0.0.0.0 lets Prometheus scrape from outside the container, but /debug/*
+; (PROFILING) is only served on a loopback address
+METRICS_HOST=${METRICS_HOST:-127.0.0.1}
+METRICS_PORT=${METRICS_PORT:-0}
+PROFILING=${PROFILING:-false}
+SLOW_CALLBACK_MS=${SLOW_CALLBACK_MS:-0}
+; the event stream is protected by PASSWORD only, set one before binding 0.0.0.0
+EVENTS_HOST=${EVENTS_HOST:-127.0.0.1}
+EVENTS_PORT=${EVENTS_PORT:-0}
+EVENTS_QUEUE_SIZE=${EVENTS_QUEUE_SIZE:-100}
 
 [DATETIME]
 DATEFORMAT=${DATEFORMAT:-D.M.YYYY HH:mm}
 
+[CLEANUP]
+DELETE_OLDER_THAN_DAYS=${DELETE_OLDER_THAN_DAYS:-false}
+MAILBOX_MAX_AGE_MINUTES=${MAILBOX_MAX_AGE_MINUTES:-15}
+
 [WEBHOOK]
 WEBHOOK_URL=${WEBHOOK_URL:-}
+WEBHOOK_BATCH_WINDOW=${WEBHOOK_BATCH_WINDOW:-0}
+WEBHOOK_BATCH_MAX_SIZE=${WEBHOOK_BATCH_MAX_SIZE:-100}
+WEBHOOK_HOST_CONCURRENCY=${WEBHOOK_HOST_CONCURRENCY:-0}
+WEBHOOK_CIRCUIT_FAILURES=${WEBHOOK_CIRCUIT_FAILURES:-5}
+WEBHOOK_CIRCUIT_COOLDOWN=${WEBHOOK_CIRCUIT_COOLDOWN:-60}
+WEBHOOK_BACKOFF_MAX=${WEBHOOK_BACKOFF_MAX:-300}
 
 [ADMIN]
 ADMIN_ENABLED=${ADMIN_ENABLED:-}
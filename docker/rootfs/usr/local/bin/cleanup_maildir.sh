@@ -1,28 +1,18 @@
 #!/usr/bin/env sh
 set -eu
 
-BASE="/var/www/opentrashmail/data"
-LOGFILE="/var/www/opentrashmail/logs/cleanup_maildir.log"
+APP_DIR="/var/www/opentrashmail"
+LOGFILE="$APP_DIR/logs/cleanup_maildir.log"
 
-if [ ! -d "$BASE" ] || [ "$BASE" = "/" ]; then
-  echo "$(date -Iseconds) [ERROR] Invalid BASE directory: $BASE" >> "$LOGFILE"
+if [ ! -d "$APP_DIR/data" ]; then
+  echo "$(date -Iseconds) [ERROR] Invalid data directory: $APP_DIR/data" >> "$LOGFILE"
   exit 1
 fi
 
-echo "$(date -Iseconds) [INFO] Running cleanup script..." >> "$LOGFILE"
-
-find "$BASE" -mindepth 1 -maxdepth 1 -type d -mmin +15 -print0 |
-  while IFS= read -r -d '' dir; do
-    if [ "$dir" = "$BASE" ] || [ ! -d "$dir" ]; then
-      echo "$(date -Iseconds) [WARN] Skipping invalid dir: $dir" >> "$LOGFILE"
-      continue
-    fi
-
-    echo "$(date -Iseconds) [INFO] Deleting expired mailbox: $dir" >> "$LOGFILE"
-
-    if rm -rf -- "$dir"; then
-      echo "$(date -Iseconds) [INFO] Successfully deleted: $dir" >> "$LOGFILE"
-    else
-      echo "$(date -Iseconds) [ERROR] Failed to delete: $dir" >> "$LOGFILE"
-    fi
-  done
+# Expired messages and mailboxes are tracked in data/_expiry by the
+# mailserver and the web UI; retention.py deletes only what is due
+# (see [CLEANUP] in config.ini) and logs what it removed.
+su www-data -s /bin/sh -c "
+  cd $APP_DIR/python
+  /opt/pyenv/bin/python retention.py
+" >> "$LOGFILE" 2>&1 || echo "$(date -Iseconds) [ERROR] Retention run failed" >> "$LOGFILE"
@@ -40,6 +40,7 @@ $dispatcher = cachedDispatcher(
         $r->addRoute(['GET', 'POST', 'OPTIONS'], '/api/captcha-request', 'api_captcha_request');
         $r->addRoute('GET', '/rss/{email}', 'rss');
         $r->addRoute(['GET', 'POST'], '/json/listaccounts', 'json_listaccounts');
+        $r->addRoute('GET', '/json/search/{email}', 'json_search');
         $r->addRoute('GET', '/json/{email}[/{id}]', 'json_email');
     },
     [
@@ -0,0 +1,173 @@
+"""
+Admission control for the SMTP listener.
+
+- MAX_CONCURRENT_DATA: messages being received or processed at once; more
+  DATA commands are answered with 451 before the message is sent.
+- MAX_INFLIGHT_BYTES: bytes of those messages held in memory (spooled
+  messages count only until they are spooled). A DATA whose declared SIZE
+  doesn't fit is refused right away, one that grows past the limit is read
+  to the end, dropped and answered with 451. A message that is larger than
+  the limit on its own can never fit and gets a permanent 552 instead.
+- IP_RATE_LIMIT: messages per minute per client IP (token bucket, checked at
+  MAIL FROM); clients over it get 421 and are disconnected.
+- DOMAIN_RATE_LIMIT: messages per minute per recipient domain (checked at
+  RCPT TO); recipients over it get 451, the others are accepted.
+
+Every worker process has its own limits. Everything runs on the event loop
+thread, nothing is locked.
+"""
+import time
+from collections import OrderedDict
+
+import metrics
+
+# rate limiter buckets kept per kind; the least recently used go first
+MAX_BUCKETS = 100000
+
+BUSY = "451 4.3.2 Too many messages in progress, try again later"
+NO_RESOURCES = "451 4.3.1 Insufficient system resources, try again later"
+TOO_LARGE = "552 5.3.4 Message size exceeds fixed maximum message size"
+IP_RATE_EXCEEDED = "421 4.7.0 Too many messages from your address, try again later"
+DOMAIN_RATE_EXCEEDED = "451 4.7.1 Too many messages for this domain, try again later"
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """Token buckets per key: per_minute tokens a minute, up to burst saved up."""
+
+    def __init__(self, per_minute: float, burst: float = 0, max_buckets: int = MAX_BUCKETS) -> None:
+        self.rate = per_minute / 60
+        self.burst = max(1.0, burst or per_minute)
+        self.max_buckets = max_buckets
+        self.buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def allow(self, key: str, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.burst, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def limited_keys(self, now: float | None = None) -> int:
+        """Keys that are out of tokens right now."""
+        now = time.monotonic() if now is None else now
+        return sum(
+            1
+            for bucket in self.buckets.values()
+            if bucket.tokens + (now - bucket.updated) * self.rate < 1
+        )
+
+
+def declared_size(mail_options: list[str]) -> int:
+    """The ESMTP SIZE= of MAIL FROM, 0 if there is none."""
+    for option in mail_options:
+        name, _, value = option.partition("=")
+        if name.upper() == "SIZE" and value.isdigit():
+            return int(value)
+    return 0
+
+
+class Admission:
+    def __init__(
+        self,
+        max_data: int = 0,
+        max_bytes: int = 0,
+        ip_rate: float = 0,
+        ip_burst: float = 0,
+        domain_rate: float = 0,
+        domain_burst: float = 0,
+    ) -> None:
+        self.max_data = max_data
+        self.max_bytes = max_bytes
+        self.data_active = 0
+        self.bytes_in_flight = 0
+        self.ip = RateLimiter(ip_rate, ip_burst) if ip_rate else None
+        self.domain = RateLimiter(domain_rate, domain_burst) if domain_rate else None
+
+    def rejected(self, reason: str) -> None:
+        metrics.ADMISSION_REJECTED.labels(reason).inc()
+
+    def start_data(self, expected: int = 0) -> str | None:
+        """
+        Take a DATA slot for a message of (at least) expected bytes in memory.
+        Returns the status to refuse it with, or None; end_data() must follow
+        an admitted one.
+        """
+        if self.max_data and self.data_active >= self.max_data:
+            self.rejected("concurrency")
+            return BUSY
+        if self.max_bytes and expected > self.max_bytes:
+            self.rejected("size")
+            return TOO_LARGE
+        if self.max_bytes and expected and self.bytes_in_flight + expected > self.max_bytes:
+            self.rejected("bytes")
+            return NO_RESOURCES
+        self.data_active += 1
+        return None
+
+    def hold(self, size: int, held: int = 0) -> str | None:
+        """
+        Account size more bytes of an admitted message, of which held bytes
+        (including size) are now in memory. Returns the status to refuse the
+        message with if that goes over MAX_INFLIGHT_BYTES (the bytes stay held
+        until released).
+        """
+        self.bytes_in_flight += size
+        if self.max_bytes and held > self.max_bytes:
+            self.rejected("size")
+            return TOO_LARGE
+        if self.max_bytes and self.bytes_in_flight > self.max_bytes:
+            self.rejected("bytes")
+            return NO_RESOURCES
+        return None
+
+    def release(self, size: int) -> None:
+        self.bytes_in_flight -= size
+
+    def end_data(self, held: int) -> None:
+        self.data_active -= 1
+        self.release(held)
+
+    def allow_ip(self, ip: str) -> bool:
+        if self.ip is None or self.ip.allow(ip):
+            return True
+        self.rejected("ip_rate")
+        return False
+
+    def allow_domain(self, domain: str) -> bool:
+        if self.domain is None or self.domain.allow(domain):
+            return True
+        self.rejected("domain_rate")
+        return False
+
+    def register_metrics(self) -> None:
+        """Export the current state as gauges (read when scraped)."""
+        metrics.ADMISSION_DATA_ACTIVE.set_function(lambda: self.data_active)
+        metrics.ADMISSION_BYTES_IN_FLIGHT.set_function(lambda: self.bytes_in_flight)
+        metrics.ADMISSION_LIMIT.labels("concurrent_data").set(self.max_data)
+        metrics.ADMISSION_LIMIT.labels("inflight_bytes").set(self.max_bytes)
+        for kind, limiter in (("ip", self.ip), ("domain", self.domain)):
+            if limiter is None:
+                continue
+            metrics.ADMISSION_LIMIT.labels(f"{kind}_rate_per_minute").set(limiter.rate * 60)
+            metrics.ADMISSION_LIMIT.labels(f"{kind}_rate_burst").set(limiter.burst)
+            metrics.RATE_LIMIT_KEYS.labels(kind, "tracked").set_function(
+                lambda limiter=limiter: len(limiter.buckets)
+            )
+            metrics.RATE_LIMIT_KEYS.labels(kind, "limited").set_function(limiter.limited_keys)
@@ -0,0 +1,152 @@
+"""
+Compression of stored message files (COMPRESSION in [MAILSERVER]).
+
+A compressed file starts with MAGIC and a codec byte, followed by the
+compressed data:
+
+    \\x89OTM <codec> <data>      0 stored as is, 1 zlib, 2 lzma (xz), 3 zstd
+
+Files without the header are plain, so mail stored before compression was
+enabled (or with COMPRESSION=none) stays readable, and the readers
+(read_file here, src/Services/Compression.php) handle both. Plain data that
+happens to start with MAGIC is written with codec 0.
+
+zstd needs Python 3.14 or the zstandard package (and PHP's zstd extension
+for the web UI); lzma needs PHP's xz extension.
+"""
+import lzma
+import os
+import zlib
+
+try:
+    from compression import zstd as _zstd  # Python 3.14+
+
+    def _zstd_compressor():
+        return _zstd.ZstdCompressor(level=ZSTD_LEVEL)
+
+    def _zstd_decompress(data: bytes) -> bytes:
+        return _zstd.decompress(data)
+
+except ImportError:
+    try:
+        import zstandard as _zstd
+
+        def _zstd_compressor():
+            return _zstd.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+        def _zstd_decompress(data: bytes) -> bytes:
+            # streamed frames don't carry their size, which decompress() needs
+            return _zstd.ZstdDecompressor().decompressobj().decompress(data)
+
+    except ImportError:
+        _zstd = None
+
+MAGIC = b"\x89OTM"
+HEADER_SIZE = len(MAGIC) + 1
+# smaller files are not worth it
+MIN_SIZE = 512
+
+ZLIB_LEVEL = 6
+LZMA_PRESET = 6
+ZSTD_LEVEL = 3
+
+STORED = 0
+
+
+class CompressionError(ValueError):
+    pass
+
+
+class Codec:
+    def __init__(self, name: str, tag: int, compressor, decompress) -> None:
+        self.name = name
+        self.tag = tag
+        self.header = MAGIC + bytes([tag])
+        self.compressor = compressor
+        self.decompress = decompress
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = self.compressor()
+        return compressor.compress(data) + compressor.flush()
+
+
+CODECS: dict[str, Codec] = {
+    "zlib": Codec(
+        "zlib", 1, lambda: zlib.compressobj(ZLIB_LEVEL), zlib.decompress
+    ),
+    "lzma": Codec(
+        "lzma", 2, lambda: lzma.LZMACompressor(preset=LZMA_PRESET), lzma.decompress
+    ),
+}
+if _zstd is not None:
+    CODECS["zstd"] = Codec("zstd", 3, _zstd_compressor, _zstd_decompress)
+
+CODEC_TAGS = {codec.tag: codec for codec in CODECS.values()}
+
+
+def get_codec(name: str) -> Codec | None:
+    """The codec of a COMPRESSION setting (None for none, unknown and unavailable ones)."""
+    return CODECS.get((name or "none").strip().lower())
+
+
+def encode(data: bytes, codec: Codec | None) -> bytes:
+    """data as it is written to disk: compressed if that makes it smaller."""
+    if codec is not None and len(data) >= MIN_SIZE:
+        compressed = codec.compress(data)
+        if len(compressed) + HEADER_SIZE < len(data):
+            return codec.header + compressed
+    if data.startswith(MAGIC):
+        return MAGIC + bytes([STORED]) + data
+    return data
+
+
+def encode_file(source: str, target: str, codec: Codec | None) -> str:
+    """
+    Write the file source as it is stored (see encode) to target, in chunks.
+    Returns the path holding the result (source if it stays as it is); the
+    other file is removed.
+    """
+    with open(source, "rb") as src:
+        first = src.read(64 * 1024)
+        if codec is None and not first.startswith(MAGIC):
+            return source
+        compressor = codec.compressor() if codec is not None else None
+        with open(target, "wb") as dst:
+            dst.write(codec.header if codec is not None else MAGIC + bytes([STORED]))
+            chunk = first
+            while chunk:
+                dst.write(compressor.compress(chunk) if compressor else chunk)
+                chunk = src.read(1024 * 1024)
+            if compressor:
+                dst.write(compressor.flush())
+
+    if (
+        codec is not None
+        and os.path.getsize(target) >= os.path.getsize(source)
+        and not first.startswith(MAGIC)
+    ):
+        os.remove(target)
+        return source
+    os.remove(source)
+    return target
+
+
+def decode(data: bytes) -> bytes:
+    if not data.startswith(MAGIC) or len(data) < HEADER_SIZE:
+        return data
+    tag = data[len(MAGIC)]
+    if tag == STORED:
+        return data[HEADER_SIZE:]
+    codec = CODEC_TAGS.get(tag)
+    if codec is None:
+        raise CompressionError(f"unsupported compression codec {tag}")
+    try:
+        return codec.decompress(data[HEADER_SIZE:])
+    except Exception as e:  # zlib.error, LZMAError, ZstdError
+        raise CompressionError(f"corrupt {codec.name} data: {e}") from e
+
+
+def read_file(path: str) -> bytes:
+    """The content of a stored file, decompressed."""
+    with open(path, "rb") as f:
+        return decode(f.read())
@@ -0,0 +1,239 @@
+"""
+New-mail events for the Server-Sent Events stream (EVENTS_PORT).
+
+Every stored copy of a message is published as a small summary to the
+subscribers of its address, of its domain (*@domain) or of everything (*).
+Each subscriber has a bounded queue: when a slow client falls behind, further
+events for it are dropped and counted, and it is told how many it missed
+instead of the server buffering without limit.
+
+With WORKERS > 1 every worker publishes to its own subscribers and relays the
+event to the other workers over unix datagram sockets (data/_events), so a
+client sees every message whichever worker it is connected to.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# largest relayed event; longer subjects are cut to stay below it
+MAX_DATAGRAM = 16384
+# events kept per worker while its socket is full (the oldest are dropped)
+RELAY_BACKLOG = 10000
+
+
+class Subscriber:
+    def __init__(self, patterns: set[str], queue_size: int) -> None:
+        self.patterns = patterns
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, event: dict) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            metrics.EVENTS_DROPPED.inc()
+
+    async def get(self, timeout: float) -> dict | None:
+        """The next event, or None if there was none within timeout (or closed)."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self) -> None:
+        """End the stream (server shutdown): wake up a waiting get()."""
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+def valid_pattern(pattern: str) -> bool:
+    return pattern == "*" or (
+        pattern.count("@") == 1 and "*" not in pattern.replace("*@", "", 1)
+    )
+
+
+class Peer:
+    """
+    Relay connection to another worker. A unix datagram socket only queues
+    a few datagrams (net.unix.max_dgram_qlen), so a burst is kept in a
+    bounded backlog and sent once the peer's socket is writable again.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.sock: socket.socket | None = None
+        self.pending: deque[bytes] = deque(maxlen=RELAY_BACKLOG)
+        self.waiting = False
+
+    def send(self, data: bytes) -> None:
+        self.pending.append(data)
+        if not self.waiting:
+            self.flush()
+
+    def connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def flush(self) -> None:
+        while self.pending:
+            try:
+                if self.sock is None:
+                    self.sock = self.connect()
+                self.sock.send(self.pending[0])
+            except BlockingIOError:
+                if not self.waiting:
+                    asyncio.get_running_loop().add_writer(self.sock.fileno(), self.flush)
+                    self.waiting = True
+                return
+            except OSError as e:
+                # the worker is not running (or restarted with a new socket,
+                # which the next event connects to): it misses these events
+                logger.debug("Cannot relay events to %s: %s", self.path, e)
+                self.close()
+                self.pending.clear()
+                return
+            self.pending.popleft()
+        self.stop_waiting()
+
+    def stop_waiting(self) -> None:
+        if self.waiting:
+            asyncio.get_running_loop().remove_writer(self.sock.fileno())
+            self.waiting = False
+
+    def close(self) -> None:
+        if self.sock is not None:
+            self.stop_waiting()
+            self.sock.close()
+            self.sock = None
+
+
+class EventHub:
+    """
+    Subscribers indexed by pattern, so publishing only looks at the ones
+    interested in the address. Used on the event loop thread only.
+    """
+
+    def __init__(
+        self,
+        queue_size: int = 100,
+        relay_dir: str | None = None,
+        worker_id: int = 0,
+        workers: int = 1,
+    ) -> None:
+        self.queue_size = queue_size
+        self.subscribers: dict[str, set[Subscriber]] = {}
+        self.relay_dir = relay_dir if workers > 1 else None
+        self.worker_id = worker_id
+        self.workers = workers
+        self.sock: socket.socket | None = None
+        self.peers: list[Peer] = []
+
+    def subscribe(self, patterns: set[str]) -> Subscriber:
+        subscriber = Subscriber(patterns, self.queue_size)
+        for pattern in patterns:
+            self.subscribers.setdefault(pattern, set()).add(subscriber)
+        metrics.EVENT_SUBSCRIBERS.inc()
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        for pattern in subscriber.patterns:
+            subscribers = self.subscribers.get(pattern)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.subscribers[pattern]
+        metrics.EVENT_SUBSCRIBERS.dec()
+
+    def close(self) -> None:
+        for subscribers in list(self.subscribers.values()):
+            for subscriber in subscribers:
+                subscriber.close()
+
+    def deliver(self, event: dict) -> None:
+        email = event["email"]
+        targets: set[Subscriber] = set()
+        for pattern in (email, "*@" + email.rsplit("@", 1)[-1], "*"):
+            targets.update(self.subscribers.get(pattern, ()))
+        for subscriber in targets:
+            subscriber.put(event)
+
+    def publish(self, event: dict) -> None:
+        self.deliver(event)
+        if self.sock is not None:
+            self.relay(event)
+
+    # ---- relaying between workers ---------------------------------------
+
+    def socket_path(self, worker_id: int) -> str:
+        return os.path.join(self.relay_dir, f"{worker_id}.sock")
+
+    def start(self) -> None:
+        if self.relay_dir is None:
+            return
+        os.makedirs(self.relay_dir, mode=0o755, exist_ok=True)
+        path = self.socket_path(self.worker_id)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(path)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self.receive)
+        self.peers = [
+            Peer(self.socket_path(worker_id))
+            for worker_id in range(self.workers)
+            if worker_id != self.worker_id
+        ]
+
+    def stop(self) -> None:
+        if self.sock is None:
+            return
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.sock = None
+        for peer in self.peers:
+            peer.close()
+        try:
+            os.remove(self.socket_path(self.worker_id))
+        except FileNotFoundError:
+            pass
+
+    def relay(self, event: dict) -> None:
+        data = json.dumps(event, ensure_ascii=False).encode("utf-8")
+        if len(data) > MAX_DATAGRAM:
+            event = dict(event, subject=event.get("subject", "")[:1024])
+            data = json.dumps(event, ensure_ascii=False).encode("utf-8")
+            if len(data) > MAX_DATAGRAM:
+                logger.debug("Event for %s too large to relay", event["email"])
+                return
+        for peer in self.peers:
+            peer.send(data)
+
+    def receive(self) -> None:
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            try:
+                self.deliver(json.loads(data))
+            except (ValueError, KeyError, TypeError) as e:
+                logger.debug("Ignoring invalid relayed event: %s", e)
@@ -0,0 +1,270 @@
+"""
+Atomic, batched writes of the mailserver (FSYNC setting).
+
+Files are written under a temporary name and renamed into place, so a crash
+never leaves a truncated message behind. How much is flushed to disk before a
+message is acknowledged depends on the mode:
+
+    none    rename only, the kernel writes the data back when it likes
+    always  every message fsyncs its own files and directories
+    batch   messages arriving within FSYNC_BATCH_WINDOW are committed
+            together: all their new files are fsynced and renamed, then every
+            directory involved is fsynced once for the whole batch
+
+A WriteBatch collects the changes of one message; they only become visible
+when it is committed. commit() returns a concurrent.futures.Future that is
+done once the changes are applied (and, except in mode none, on disk).
+"""
+import concurrent.futures
+import fcntl
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MODES = ("none", "batch", "always")
+
+
+def fsync_path(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_temp(path: str, data: bytes) -> str:
+    """Write data next to path under a unique temporary name."""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    return tmp_path
+
+
+class WriteBatch:
+    """The file changes of one message, applied in order on commit."""
+
+    def __init__(self, committer: "GroupCommit") -> None:
+        self.committer = committer
+        self.ops: list[tuple] = []
+        self.dirs: set[str] = set()
+        self.future: concurrent.futures.Future | None = None
+
+    def makedirs(self, path: str, mode: int = 0o755) -> None:
+        """Create a directory now; its parent is synced with the batch."""
+        if not os.path.isdir(path):
+            os.makedirs(path, mode=mode, exist_ok=True)
+            self.dirs.add(os.path.dirname(path))
+
+    def write(self, path: str, data: bytes) -> None:
+        """Replace path with data."""
+        self.ops.append(("rename", write_temp(path, data), path))
+
+    def publish(self, path: str, data: bytes | None = None, source: str | None = None) -> None:
+        """
+        Add a blob to a content-addressed store from data or an already
+        written file (moved). An existing blob is kept: it has the same
+        content and may already be hardlinked elsewhere.
+        """
+        self.ops.append(("publish", source or write_temp(path, data), path))
+
+    def link(self, source: str, target: str, data: bytes | None = None) -> None:
+        """
+        Hardlink source to target (replacing target). data is the content of
+        source, used to recreate it if it vanished in the meantime.
+        """
+        self.ops.append(("link", source, target, data))
+
+    def sync(self, path: str) -> None:
+        """Include a file that was written directly in the fsyncs."""
+        self.ops.append(("sync", path))
+
+    def append(self, path: str, data: bytes) -> None:
+        """Append to path under an exclusive lock."""
+        self.ops.append(("append", path, data))
+
+    def call(self, func, *args) -> None:
+        """Run func(*args) after the preceding changes were applied."""
+        self.ops.append(("call", func, args))
+
+    def commit(self) -> concurrent.futures.Future:
+        if self.future is None:
+            self.future = self.committer.submit(self)
+        return self.future
+
+    # ---- applying (GroupCommit) ---------------------------------------
+
+    def sync_sources(self) -> None:
+        for op in self.ops:
+            if op[0] in ("rename", "publish", "sync"):
+                fsync_path(op[1])
+
+    def apply(self, dirs: set[str], appended: set[str]) -> None:
+        dirs.update(self.dirs)
+        for op in self.ops:
+            kind = op[0]
+            if kind == "rename":
+                os.replace(op[1], op[2])
+                dirs.add(os.path.dirname(op[2]))
+            elif kind == "publish":
+                publish_file(op[1], op[2])
+                dirs.add(os.path.dirname(op[2]))
+            elif kind == "link":
+                link_file(op[1], op[2], op[3])
+                dirs.add(os.path.dirname(op[2]))
+            elif kind == "sync":
+                dirs.add(os.path.dirname(op[1]))
+            elif kind == "append":
+                with open(op[1], "ab") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    f.write(op[2])
+                appended.add(op[1])
+            elif kind == "call":
+                op[1](*op[2])
+
+    def discard(self) -> None:
+        """Remove the temporary files of a batch that failed."""
+        for op in self.ops:
+            if op[0] in ("rename", "publish") and op[1].endswith(".tmp"):
+                try:
+                    os.remove(op[1])
+                except FileNotFoundError:
+                    pass
+
+
+def publish_file(source: str, path: str) -> None:
+    try:
+        os.link(source, path)
+    except FileExistsError:
+        os.utime(path)
+    except OSError:
+        # no hardlinks on this filesystem
+        if not os.path.exists(path):
+            os.replace(source, path)
+            return
+    os.remove(source)
+
+
+def link_file(source: str, target: str, data: bytes | None) -> None:
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except FileNotFoundError:
+        if data is None:
+            raise
+        # removed by the cleanup in the meantime
+        publish_file(write_temp(source, data), source)
+        os.link(source, target)
+    except OSError as e:
+        logger.debug("Cannot hardlink %s (%s), copying instead", source, e)
+        shutil.copyfile(source, target)
+
+
+class GroupCommit:
+    """
+    Commits WriteBatches according to the FSYNC mode. In batch mode a
+    background thread collects the batches submitted within window seconds
+    (at most max_batches) and flushes them together.
+    """
+
+    def __init__(self, mode: str = "none", window: float = 0.005, max_batches: int = 256) -> None:
+        if mode not in MODES:
+            logger.warning("Unknown FSYNC mode '%s', using none", mode)
+            mode = "none"
+        self.mode = mode
+        self.window = window
+        self.max_batches = max_batches
+        # fsynced after every synced commit (e.g. the SQLite WAL)
+        self.sync_files: list[str] = []
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.thread: threading.Thread | None = None
+
+    def begin(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def start(self) -> None:
+        if self.mode == "batch" and self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="group-commit", daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        """Flush what is queued and stop the background thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, batch: WriteBatch) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        if self.mode == "batch" and self.thread is not None:
+            self.queue.put((batch, future))
+        else:
+            self.flush([(batch, future)], sync=self.mode != "none")
+        return future
+
+    def run(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            group = [item]
+            deadline = time.monotonic() + self.window
+            stopping = False
+            while len(group) < self.max_batches:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+            start = time.perf_counter()
+            self.flush(group, sync=True)
+            metrics.COMMIT_BATCH.observe(len(group))
+            metrics.COMMIT_SECONDS.observe(time.perf_counter() - start)
+            if stopping:
+                return
+
+    def flush(self, group: list[tuple[WriteBatch, concurrent.futures.Future]], sync: bool) -> None:
+        dirs: set[str] = set()
+        appended: set[str] = set()
+        applied = []
+        for batch, future in group:
+            try:
+                if sync:
+                    batch.sync_sources()
+                batch.apply(dirs, appended)
+            except Exception as e:
+                logger.error("Cannot write message files: %s", e)
+                batch.discard()
+                future.set_exception(e)
+                continue
+            applied.append((batch, future))
+
+        try:
+            if sync and applied:
+                for path in sorted(appended) + sorted(dirs) + self.sync_files:
+                    try:
+                        fsync_path(path)
+                    except FileNotFoundError:
+                        pass
+        except OSError as e:
+            logger.error("fsync failed: %s", e)
+            for _, future in applied:
+                future.set_exception(e)
+            return
+
+        for _, future in applied:
+            future.set_result(None)
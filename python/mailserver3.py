@@ -1,19 +1,51 @@
 import aiohttp
+from aiohttp import web
 import asyncio
 import ssl
-from aiosmtpd.controller import Controller
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from email.feedparser import BytesFeedParser
 from email.parser import BytesParser
 from email.header import decode_header, make_header
 from email import policy
+import ipaddress
 import os
 import re
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
 import time
 import json
 import hashlib
 import hmac
 import configparser
+import fcntl
 import logging
 
+import compress
+import metrics
+from admission import DOMAIN_RATE_EXCEEDED, Admission
+import retention
+from events import EventHub, valid_pattern
+from group_commit import GroupCommit, WriteBatch
+from message_template import MessageTemplate
+from profiling import (
+    MemoryTracker,
+    Profiler,
+    ProfilingError,
+    SlowCallbackWatchdog,
+    dump_tasks,
+)
+from search import SearchIndex
+from spooling_smtp import SpoolingSMTP
+from storage import SqliteStorage, mailbox_name
+from webhook_config import WebhookConfigCache, read_webhook_config
+from webhook_destinations import Destinations, backoff_delay, host_failed
+from webhook_spool import Parked, WebhookSpool
+from webhook_template import compile_template
+from worker_supervisor import WorkerSupervisor
+
 logger = logging.getLogger(__name__)
 
 logging.basicConfig(
@@ -26,6 +58,13 @@ logging.basicConfig(
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 CONFIG_PATH = os.path.join(BASE_DIR, "config.ini")
+WEBHOOK_SPOOL_DIR = os.path.join(DATA_DIR, "_webhooks")
+INCOMING_DIR = os.path.join(DATA_DIR, "_incoming")
+EVENTS_RELAY_DIR = os.path.join(DATA_DIR, "_events")
+
+# seconds of silence after which an event stream gets a keep-alive comment,
+# so proxies don't close idle subscriptions
+EVENT_STREAM_KEEPALIVE = 15
 
 # globals for settings
 DISCARD_UNKNOWN: bool = False
@@ -36,6 +75,51 @@ MAILPORT_TLS: int = 0
 TLS_CERTIFICATE: str = ""
 TLS_PRIVATE_KEY: str = ""
 WEBHOOK_URL: str = ""
+WEBHOOK_MAX_CONNECTIONS: int = 100
+WEBHOOK_MAX_CONNECTIONS_PER_HOST: int = 10
+WEBHOOK_KEEPALIVE_TIMEOUT: float = 30
+WEBHOOK_DNS_CACHE_TTL: int = 300
+WEBHOOK_WORKERS: int = 4
+WEBHOOK_CONFIG_CACHE_SIZE: int = 10000
+WEBHOOK_CONFIG_CACHE_TTL: float = 2
+WEBHOOK_BATCH_WINDOW: int = 0
+WEBHOOK_BATCH_MAX_SIZE: int = 100
+WEBHOOK_HOST_CONCURRENCY: int = 0
+WEBHOOK_CIRCUIT_FAILURES: int = 5
+WEBHOOK_CIRCUIT_COOLDOWN: float = 60
+WEBHOOK_BACKOFF_MAX: float = 300
+INGEST_EXECUTOR: str = "inline"
+INGEST_WORKERS: int = 0
+SPOOL_THRESHOLD: int = 0
+MESSAGE_MAX_AGE: int = 0
+MAILBOX_MAX_AGE: int = 0
+MESSAGE_MAX_SIZE: int = 33554432
+WORKERS: int = 1
+MAX_CONCURRENT_DATA: int = 0
+MAX_INFLIGHT_BYTES: int = 0
+IP_RATE_LIMIT: float = 0
+IP_RATE_BURST: float = 0
+DOMAIN_RATE_LIMIT: float = 0
+DOMAIN_RATE_BURST: float = 0
+METRICS_HOST: str = "127.0.0.1"
+METRICS_PORT: int = 0
+PROFILING: bool = False
+PROFILE_DIR: str = os.path.join(BASE_DIR, "logs", "profiles")
+PROFILE_SECONDS: float = 30
+SLOW_CALLBACK_MS: int = 0
+STORAGE: str = "files"
+FSYNC: str = "none"
+FSYNC_BATCH_WINDOW: float = 5
+SEARCH_INDEX: bool = False
+COMPRESSION: str = "none"
+EVENTS_HOST: str = "127.0.0.1"
+EVENTS_PORT: int = 0
+EVENTS_QUEUE_SIZE: int = 100
+PASSWORD: str = ""
+ADMIN_PASSWORD: str = ""
+
+# id of this SMTP worker process (0 unless WORKERS > 1)
+WORKER_ID: int = 0
 
 
 def ensure_dir(path: str, mode: int = 0o755) -> None:
@@ -48,177 +132,926 @@ def safe_email_dir(email: str) -> str:
     Convert an email address into a safe directory path under DATA_DIR.
     Prevents path traversal by sanitising and enforcing base prefix.
     """
-    email = email.lower()
-    safe = re.sub(r"[^a-z0-9@\._\-]+", "_", email)
-    path = os.path.abspath(os.path.join(DATA_DIR, safe))
+    path = os.path.abspath(os.path.join(DATA_DIR, mailbox_name(email)))
     if not path.startswith(DATA_DIR + os.sep) and path != DATA_DIR:
         raise ValueError(f"Unsafe email path derived from: {email}")
     return path
 
 
-def safe_attachment_id(filename: str) -> str:
+def safe_attachment_id(filename: str, digest: str, message_id: str) -> str:
     """
-    Generate a safe file ID for an attachment, based on a sanitised basename.
+    Generate a safe file ID for an attachment from the message id, the
+    content digest and a sanitised basename, so different files with the
+    same name don't collide. Every message has its own links in attachments/,
+    so the link count of a blob is the number of messages using it and
+    deleting a message never has to look at the others.
     """
     basename = os.path.basename(filename) or "file"
     basename = re.sub(r"[^a-zA-Z0-9\.\-_]+", "_", basename)
-    return hashlib.md5(basename.encode("utf-8")).hexdigest() + "_" + basename
+    return f"{message_id}_{digest[:32]}_{basename}"
 
 
-class CustomHandler:
-    connection_type = ""
+RAW_STORE = "_raw"
+ATTACHMENT_STORE = "_attachments"
+BLOB_RE = re.compile(r"^[0-9a-f]{64}$")
 
-    def __init__(self, conntype: str = "Plaintext") -> None:
-        self.connection_type = conntype
 
-    async def handle_DATA(self, server, session, envelope):
-        peer = session.peer
-        rcpts = list(envelope.rcpt_tos)
+def store_blob(
+    store_dir: str, name: str, data: bytes, batch: WriteBatch | None = None
+) -> str:
+    """
+    Write data to a content-addressed store once. If the blob already exists
+    only its mtime is refreshed, which protects it from a concurrent GC.
+    With a batch, the blob is added when the batch is committed.
+    """
+    path = os.path.join(store_dir, name)
+    try:
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        pass
+    except OSError:
+        return path
+
+    ensure_dir(store_dir, 0o755)
+    if batch is not None:
+        batch.publish(path, data)
+        return path
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
 
-        logger.debug("Receiving message from: %s (%s)", peer, self.connection_type)
-        logger.debug("Message addressed from: %s", envelope.mail_from)
-        logger.debug("Message addressed to: %s", rcpts)
 
-        filenamebase = str(int(round(time.time() * 1000)))
-        raw_email = envelope.content.decode("utf-8", errors="replace")
-        message = BytesParser(policy=policy.default).parsebytes(envelope.content)
-        subject = (
-            str(make_header(decode_header(message["subject"])))
-            if message["subject"]
-            else "(No Subject)"
+def adopt_blob(
+    store_dir: str,
+    name: str,
+    source_path: str,
+    batch: WriteBatch | None = None,
+    codec: compress.Codec | None = None,
+) -> str:
+    """
+    Move an already written file (e.g. a spooled message) into a
+    content-addressed store, or drop it if the store has that blob already.
+    The blob is stored encoded with codec (see compress.encode).
+    """
+    path = os.path.join(store_dir, name)
+    try:
+        os.utime(path)
+        os.remove(source_path)
+        return path
+    except FileNotFoundError:
+        pass
+
+    source_path = compress.encode_file(source_path, f"{source_path}.z", codec)
+    ensure_dir(store_dir, 0o755)
+    if batch is not None:
+        batch.publish(path, source=source_path)
+        return path
+    os.replace(source_path, path)
+    return path
+
+
+def link_blob(
+    store_dir: str,
+    name: str,
+    data: bytes | None,
+    target: str,
+    batch: WriteBatch | None = None,
+) -> None:
+    """
+    Hardlink a stored blob to target. The link count of the blob is its
+    reference count: blobs whose only remaining link is the store entry
+    itself are unused and can be removed by the cleanup.
+    Falls back to a plain copy where hardlinks are not possible.
+
+    data may be None if the blob was just written (store_blob/adopt_blob).
+    """
+    path = (
+        store_blob(store_dir, name, data, batch)
+        if data is not None
+        else os.path.join(store_dir, name)
+    )
+    if batch is not None:
+        batch.link(path, target, data)
+        return
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(path, target)
+    except FileNotFoundError:
+        if data is None:
+            raise
+        # removed by the cleanup between store_blob() and link()
+        os.link(store_blob(store_dir, name, data), target)
+    except OSError as e:
+        logger.debug("Cannot hardlink %s (%s), copying instead", path, e)
+        shutil.copyfile(path, target)
+
+
+def raw_store_dir() -> str:
+    return os.path.join(DATA_DIR, RAW_STORE)
+
+
+def attachment_store_dir() -> str:
+    return os.path.join(DATA_DIR, ATTACHMENT_STORE)
+
+
+def load_raw_bytes(email_dir: str, message_id: str, savedata: dict) -> bytes:
+    """
+    Original bytes of a stored message. Messages written before the raw store
+    existed carry them inline in "raw"; newer ones reference the blob by its
+    sha256 ("raw_ref") and have it linked as <id>.eml next to the JSON.
+    """
+    if "raw" in savedata:
+        return (savedata["raw"] or "").encode("utf-8")
+
+    raw_ref = savedata.get("raw_ref") or ""
+    candidates = [os.path.join(email_dir, f"{message_id}.eml")]
+    if BLOB_RE.match(raw_ref):
+        candidates.append(os.path.join(raw_store_dir(), f"{raw_ref}.eml"))
+
+    for path in candidates:
+        try:
+            return compress.read_file(path)
+        except FileNotFoundError:
+            continue
+        except compress.CompressionError as e:
+            logger.warning("Cannot read raw message %s: %s", path, e)
+            return b""
+    logger.warning("Raw message %s/%s not found", email_dir, message_id)
+    return b""
+
+
+def with_raw(savedata: dict) -> dict:
+    """Return savedata with the raw message inlined (as the global webhook expects)."""
+    if "raw" in savedata or not savedata.get("raw_ref"):
+        return savedata
+    raw_ref = savedata["raw_ref"]
+    raw = b""
+    if BLOB_RE.match(raw_ref):
+        try:
+            raw = compress.read_file(os.path.join(raw_store_dir(), f"{raw_ref}.eml"))
+        except FileNotFoundError:
+            logger.warning("Raw message blob %s not found", raw_ref)
+        except compress.CompressionError as e:
+            logger.warning("Cannot read raw message blob %s: %s", raw_ref, e)
+    return {
+        ("raw" if k == "raw_ref" else k): (
+            raw.decode("utf-8", errors="replace") if k == "raw_ref" else v
         )
-        plaintext = ""
-        html = ""
-        attachments: dict[str, tuple[str, bytes, str | None, str]] = {}
+        for k, v in savedata.items()
+    }
+
+
+MAILBOX_INDEX = "index.jsonl"
+MESSAGE_FILE_RE = re.compile(r"^(\d+)\.json$")
 
-        for part in message.walk():
-            if part.get_content_maintype() == "multipart":
-                continue
 
-            content_type = part.get_content_type()
-            is_attachment = part.get_filename() is not None
-            payload_bytes = part.get_payload(decode=True)
-
-            if content_type == "text/plain" and not is_attachment:
-                try:
-                    plaintext += payload_bytes.decode("utf-8")
-                    logger.debug("Plaintext (UTF-8) received")
-                except UnicodeDecodeError:
-                    plaintext += payload_bytes.decode("latin1", errors="replace")
-                    logger.debug("Plaintext (latin1) received")
-                except Exception as e:
-                    logger.error("Error decoding plaintext payload: %s", e)
-            elif content_type == "text/html" and not is_attachment:
-                try:
-                    html += payload_bytes.decode("utf-8")
-                    logger.debug("HTML (UTF-8) received")
-                except UnicodeDecodeError:
-                    html += payload_bytes.decode("latin1", errors="replace")
-                    logger.debug("HTML (latin1) received")
-                except Exception as e:
-                    logger.error("Error decoding HTML payload: %s", e)
+class MessageIds:
+    """
+    Message ids (and file names): the time in milliseconds (13 digits), the
+    SMTP worker id (2 digits) and a per-process sequence (4 digits). They are
+    all digits, so they sort numerically after the plain millisecond ids of
+    older versions, and strictly increase within a process, even when the
+    clock steps back. Up to 10000 ids per millisecond and worker; beyond that
+    the next millisecond is borrowed.
+    """
+
+    def __init__(self, worker_id: int) -> None:
+        self.worker_id = worker_id % 100
+        self.last_ms = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next(self) -> str:
+        with self.lock:
+            now = time.time_ns() // 1_000_000
+            if now > self.last_ms:
+                self.last_ms = now
+                self.sequence = 0
+            elif self.sequence < 9999:
+                self.sequence += 1
             else:
-                att = self.handleAttachment(part, payload_bytes)
-                if att is False:
-                    return (
-                        "500 Attachment too large. Max size: "
-                        + f"{ATTACHMENTS_MAX_SIZE / 1000000:.2f}MB"
-                    )
-                attachments[f"file{len(attachments)}"] = att
-
-        for em in rcpts:
-            em = em.lower()
-
-            if not re.match(r"^[^@\s]+@[^@\s]+\.[a-zA-Z0-9]+$", em):
-                logger.warning("Invalid recipient: %s", em)
-                continue
+                self.last_ms += 1
+                self.sequence = 0
+            return f"{self.last_ms:013d}{self.worker_id:02d}{self.sequence:04d}"
 
-            domain = em.split("@", 1)[1]
-
-            found = False
-            for x in DOMAINS:
-                x = x.strip()
-                if not x:
-                    continue
-                if "*" in x and domain.endswith(x.replace("*", "")):
-                    found = True
-                    break
-                if domain == x:
-                    found = True
-                    break
-
-            if DISCARD_UNKNOWN and not found:
-                logger.info("Discarding email for unknown domain: %s", domain)
-                continue
 
-            try:
-                email_dir = safe_email_dir(em)
-            except ValueError as e:
-                logger.error("Skipping email due to unsafe path for %s: %s", em, e)
-                continue
+_message_ids: MessageIds | None = None
 
-            ensure_dir(email_dir, 0o755)
 
-            edata = {
-                "subject": subject,
-                "body": plaintext,
-                "htmlbody": self.replace_cid_with_attachment_id(html, attachments, em),
-                "from": message["from"],
-                "attachments": [],
-                "attachments_details": [],
-            }
+def next_message_id() -> str:
+    global _message_ids
+    if _message_ids is None:
+        _message_ids = MessageIds(WORKER_ID)
+    return _message_ids.next()
+
+
+def message_digest(message_id: str, source: bytes | str) -> tuple[int, str]:
+    """
+    Size and md5(id . raw) of a message, exactly like Mailbox::getEmailsOfEmail
+    computes them. source is the raw message or the path of a file holding it.
+    """
+    md5 = hashlib.md5(message_id.encode("utf-8"))
+    if isinstance(source, bytes):
+        md5.update(source)
+        return len(source), md5.hexdigest()
+
+    size = 0
+    with open(source, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            md5.update(chunk)
+            size += len(chunk)
+    return size, md5.hexdigest()
+
+
+def mailbox_index_entry(message_id: str, savedata: dict, size: int, digest: str) -> dict:
+    """
+    Summary line for the mailbox index: everything a listing needs, so the
+    web UI doesn't have to read the full message JSON (and its raw body).
+    """
+    parsed = savedata.get("parsed") or {}
+    return {
+        "id": message_id,
+        "from": parsed.get("from") or "",
+        "subject": parsed.get("subject") or "",
+        "size": size,
+        "digest": digest,
+        "attachments": len(parsed.get("attachments") or []),
+    }
+
+
+def index_line(entry: dict) -> str:
+    return json.dumps(entry, ensure_ascii=False) + "\n"
+
+
+def read_mailbox_entries(email_dir: str) -> list[dict]:
+    """Build index entries from the message JSON files of a mailbox."""
+    entries = []
+    for name in os.listdir(email_dir):
+        match = MESSAGE_FILE_RE.match(name)
+        if not match:
+            continue
+        try:
+            savedata = json.loads(compress.read_file(os.path.join(email_dir, name)))
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping unreadable message %s/%s: %s", email_dir, name, e)
+            continue
+        if not isinstance(savedata, dict) or "parsed" not in savedata:
+            continue
+        message_id = match.group(1)
+        size, digest = message_digest(
+            message_id, load_raw_bytes(email_dir, message_id, savedata)
+        )
+        entries.append(mailbox_index_entry(message_id, savedata, size, digest))
+    entries.sort(key=lambda e: int(e["id"]))
+    return entries
+
+
+def rebuild_mailbox_index(email_dir: str) -> int:
+    """
+    Regenerate the index of a mailbox from its message files. The file is
+    rewritten in place under an exclusive lock, so concurrent appends from
+    other processes (and readers in PHP) never see a half-written index.
+    """
+    with open(os.path.join(email_dir, MAILBOX_INDEX), "a+", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        entries = read_mailbox_entries(email_dir)
+        f.seek(0)
+        f.truncate()
+        f.write("".join(index_line(e) for e in entries))
+    return len(entries)
+
+
+def append_mailbox_index(
+    email_dir: str, entry: dict, batch: WriteBatch | None = None
+) -> None:
+    """
+    Append a message summary to the mailbox index. A mailbox without an index
+    (e.g. created before indexes existed) gets a full rebuild instead, which
+    already includes the new message.
+    """
+    path = os.path.join(email_dir, MAILBOX_INDEX)
+    if not os.path.exists(path):
+        if batch is not None:
+            batch.call(rebuild_mailbox_index, email_dir)
+        else:
+            rebuild_mailbox_index(email_dir)
+        return
+    if batch is not None:
+        batch.append(path, index_line(entry).encode("utf-8"))
+        return
+    with open(path, "a", encoding="utf-8") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(index_line(entry))
+
+
+class AttachmentTooLarge(Exception):
+    """Raised while parsing when an attachment exceeds ATTACHMENTS_MAX_SIZE."""
+
 
-            savedata = {
-                "sender_ip": peer[0],
-                "from": message["from"],
-                "rcpts": rcpts,
-                "raw": raw_email,
-                "parsed": edata,
+# (filename, payload or None once it is in the store, cid, id, sha256, size)
+Attachment = tuple[str, bytes | None, str, str, str, int]
+
+
+def decode_text_payload(payload_bytes: bytes, kind: str) -> str:
+    """Decode a text/plain or text/html part, falling back to latin1."""
+    try:
+        text = payload_bytes.decode("utf-8")
+        logger.debug("%s (UTF-8) received", kind)
+        return text
+    except UnicodeDecodeError:
+        logger.debug("%s (latin1) received", kind)
+        return payload_bytes.decode("latin1", errors="replace")
+    except Exception as e:
+        logger.error("Error decoding %s payload: %s", kind, e)
+        return ""
+
+
+def attachment_from_part(
+    part,
+    payload_bytes: bytes,
+    message_id: str,
+    max_size: int,
+    attachment_store: str | None = None,
+) -> Attachment:
+    """
+    Describe an attachment as (filename, payload, cid, id, sha256, size).
+
+    With attachment_store set the payload is written to the store right away
+    and returned as None, so it doesn't have to stay in memory.
+    """
+    filename = part.get_filename() or "untitled"
+
+    cid = part.get("Content-ID")
+    if cid is not None:
+        cid = cid.strip("<>")
+    elif part.get("X-Attachment-Id") is not None:
+        cid = part.get("X-Attachment-Id")
+    else:
+        cid = hashlib.md5(payload_bytes).hexdigest()
+
+    digest = hashlib.sha256(payload_bytes).hexdigest()
+    fid = safe_attachment_id(filename, digest, message_id)
+
+    logger.debug(
+        'Handling attachment: "%s" (ID: "%s") of type "%s" with CID "%s"',
+        filename,
+        fid,
+        part.get_content_type(),
+        cid,
+    )
+
+    if max_size > 0 and len(payload_bytes) > max_size:
+        logger.info("Attachment too large: %s", filename)
+        raise AttachmentTooLarge(filename)
+
+    size = len(payload_bytes)
+    if attachment_store is not None:
+        store_blob(attachment_store, digest, payload_bytes)
+        payload_bytes = None
+
+    return (filename, payload_bytes, cid, fid, digest, size)
+
+
+def parse_message(
+    source: bytes | str,
+    message_id: str,
+    attachments_max_size: int,
+    attachment_store: str | None = None,
+) -> dict:
+    """
+    Parse a raw message into subject, bodies and decoded attachments (whose
+    ids start with message_id).
+
+    source is the message itself or the path of a spooled message file. A
+    spooled message is fed to the parser in chunks, and its attachments are
+    decoded one at a time straight into attachment_store (when given) and
+    released from the message tree, instead of being collected in memory.
+
+    Kept free of module state (everything is passed in) and returns only
+    plain picklable values, so it can run in a ProcessPoolExecutor.
+    """
+    if isinstance(source, bytes):
+        message = BytesParser(policy=policy.default).parsebytes(source)
+    else:
+        parser = BytesFeedParser(policy=policy.default)
+        with open(source, "rb") as f:
+            while chunk := f.read(64 * 1024):
+                parser.feed(chunk)
+        message = parser.close()
+
+    subject = (
+        str(make_header(decode_header(message["subject"])))
+        if message["subject"]
+        else "(No Subject)"
+    )
+    plaintext = ""
+    html = ""
+    attachments: dict[str, Attachment] = {}
+
+    for part in message.walk():
+        if part.get_content_maintype() == "multipart":
+            continue
+
+        content_type = part.get_content_type()
+        is_attachment = part.get_filename() is not None
+        payload_bytes = part.get_payload(decode=True)
+
+        if content_type == "text/plain" and not is_attachment:
+            plaintext += decode_text_payload(payload_bytes, "Plaintext")
+        elif content_type == "text/html" and not is_attachment:
+            html += decode_text_payload(payload_bytes, "HTML")
+        else:
+            attachments[f"file{len(attachments)}"] = attachment_from_part(
+                part, payload_bytes, message_id, attachments_max_size, attachment_store
+            )
+            if attachment_store is not None:
+                part.set_payload("")
+            payload_bytes = None
+
+    return {
+        "subject": subject,
+        "from": str(message["from"]) if message["from"] is not None else None,
+        "plaintext": plaintext,
+        "html": html,
+        "attachments": attachments,
+    }
+
+
+class DomainMatcher:
+    """
+    Precompiled DOMAINS lookup.
+
+    Plain entries go into a set. Wildcard entries keep their old meaning
+    ("the domain ends with the entry without its *") and are stored as a
+    trie over the reversed suffixes, so a lookup costs one set probe plus
+    one walk over the characters of the domain, however many domains are
+    configured.
+    """
+
+    END = ""
+
+    def __init__(self, domains: list[str]) -> None:
+        self.source = domains
+        self.exact: set[str] = set()
+        self.suffixes: dict = {}
+        for entry in domains:
+            entry = entry.strip()
+            if not entry:
+                continue
+            if "*" not in entry:
+                self.exact.add(entry)
+                continue
+            node = self.suffixes
+            for char in reversed(entry.replace("*", "")):
+                node = node.setdefault(char, {})
+            node[self.END] = True
+
+    def match(self, domain: str) -> bool:
+        if domain in self.exact:
+            return True
+        node = self.suffixes
+        if self.END in node:
+            return True
+        for char in reversed(domain):
+            node = node.get(char)
+            if node is None:
+                return False
+            if self.END in node:
+                return True
+        return False
+
+
+_domain_matcher: DomainMatcher | None = None
+
+
+def is_known_domain(domain: str) -> bool:
+    global _domain_matcher
+    if _domain_matcher is None or _domain_matcher.source is not DOMAINS:
+        _domain_matcher = DomainMatcher(DOMAINS)
+    return _domain_matcher.match(domain)
+
+
+def store_message(
+    filenamebase: str,
+    peer_ip: str,
+    rcpts: list[str],
+    source: bytes | str,
+    parsed: dict,
+    raw_ref: str | None = None,
+    batch: WriteBatch | None = None,
+) -> tuple[list[str], MessageTemplate | None]:
+    """
+    Store the message for every accepted recipient. Returns the recipients it
+    was stored for and the message (None if there were none), whose
+    for_mailbox() gives the savedata of each copy for webhook delivery.
+
+    The raw message and the attachments are written once to their
+    content-addressed stores; the storage backend (message_storage) records
+    the deliveries. source is the raw message or the path of its spool file
+    (which is moved into the raw store); raw_ref is its sha256 if already
+    known. The raw message is compressed with the COMPRESSION codec, the
+    attachments are stored as they are (they are served directly).
+
+    All files are written through batch (see group_commit), which is
+    committed before returning; in FSYNC=batch mode the caller has to wait
+    for batch.future before acknowledging the message.
+    """
+    if batch is None:
+        batch = write_batch()
+    codec = storage_codec()
+    content = source if isinstance(source, bytes) else None
+    if raw_ref is None:
+        raw_ref = hashlib.sha256(content).hexdigest()
+    raw_name = f"{raw_ref}.eml"
+    raw_size, raw_digest = message_digest(filenamebase, source)
+    attachments = parsed["attachments"]
+    stored = []
+
+    for em in rcpts:
+        em = em.lower()
+
+        if not re.match(r"^[^@\s]+@[^@\s]+\.[a-zA-Z0-9]+$", em):
+            logger.warning("Invalid recipient: %s", em)
+            continue
+
+        domain = em.split("@", 1)[1]
+
+        if DISCARD_UNKNOWN and not is_known_domain(domain):
+            logger.info("Discarding email for unknown domain: %s", domain)
+            continue
+
+        try:
+            safe_email_dir(em)
+        except ValueError as e:
+            logger.error("Skipping email due to unsafe path for %s: %s", em, e)
+            continue
+
+        stored.append(em)
+
+    if not stored:
+        batch.commit()
+        return stored, None
+
+    # everything but the mailbox is the same for all recipients
+    edata = {
+        "subject": parsed["subject"],
+        "body": parsed["plaintext"],
+        "htmlbody": parsed["html"],
+        "from": parsed["from"],
+        "attachments": [],
+        "attachments_details": [],
+    }
+    for filename, _, cid, file_id, digest, size in attachments.values():
+        edata["attachments"].append(file_id)
+        edata["attachments_details"].append(
+            {
+                "filename": filename,
+                "cid": cid,
+                "id": file_id,
+                "download_url": None,
+                "size": size,
+                "sha256": digest,
             }
+        )
+    message = MessageTemplate(
+        {
+            "sender_ip": peer_ip,
+            "from": parsed["from"],
+            "rcpts": rcpts,
+            "raw_ref": raw_ref,
+            "parsed": edata,
+        },
+        {cid: file_id for _, _, cid, file_id, _, _ in attachments.values() if cid},
+        URL,
+    )
+
+    if content is None:
+        adopt_blob(raw_store_dir(), raw_name, source, batch, codec)
+    else:
+        content = compress.encode(content, codec)
+        store_blob(raw_store_dir(), raw_name, content, batch)
+    for _, payload, _, _, digest, _ in attachments.values():
+        if payload is not None:
+            store_blob(attachment_store_dir(), digest, payload, batch)
+        else:
+            # written while parsing
+            batch.sync(os.path.join(attachment_store_dir(), digest))
+
+    message_storage().save(
+        filenamebase, parsed, stored, message, raw_ref, content, raw_size, raw_digest, batch
+    )
+
+    batch.commit()
+    return stored, message
+
+
+class FileStorage:
+    """
+    The default layout: every recipient gets data/<email>/<id>.json with the
+    raw message hardlinked as <id>.eml, its attachments hardlinked into
+    attachments/, a line in index.jsonl and an entry in the expiry index.
+    """
+
+    name = "files"
+
+    def save(
+        self,
+        message_id: str,
+        parsed: dict,
+        stored: list[str],
+        message: MessageTemplate,
+        raw_ref: str,
+        content: bytes | None,
+        size: int,
+        digest: str,
+        batch: WriteBatch,
+    ) -> None:
+        attachments = parsed["attachments"]
+        index_entry = mailbox_index_entry(message_id, message.savedata, size, digest)
+
+        for em in stored:
+            email_dir = safe_email_dir(em)
+            batch.makedirs(email_dir)
 
             if attachments:
                 attachments_dir = os.path.join(email_dir, "attachments")
-                ensure_dir(attachments_dir, 0o755)
+                batch.makedirs(attachments_dir)
 
-                for att in attachments.values():
-                    filename, payload, cid, file_id = att
-                    file_path = os.path.abspath(
-                        os.path.join(attachments_dir, file_id)
-                    )
+                for _, payload, _, file_id, blob, _ in attachments.values():
+                    file_path = os.path.abspath(os.path.join(attachments_dir, file_id))
 
                     if not file_path.startswith(attachments_dir + os.sep):
                         logger.error("Unsafe attachment path blocked: %s", file_path)
                         continue
 
-                    with open(file_path, "wb") as f:
-                        f.write(payload)
+                    link_blob(attachment_store_dir(), blob, payload, file_path, batch)
+
+            link_blob(
+                raw_store_dir(),
+                f"{raw_ref}.eml",
+                content,
+                os.path.join(email_dir, f"{message_id}.eml"),
+                batch,
+            )
+
+            batch.write(
+                os.path.join(email_dir, f"{message_id}.json"),
+                compress.encode(message.render(em), storage_codec()),
+            )
+            append_mailbox_index(email_dir, index_entry, batch)
+
+        if MESSAGE_MAX_AGE or MAILBOX_MAX_AGE:
+            retention.register_message(
+                DATA_DIR,
+                [os.path.basename(safe_email_dir(em)) for em in stored],
+                message_id,
+                time.time(),
+                MESSAGE_MAX_AGE,
+                MAILBOX_MAX_AGE,
+            )
+
+
+_storage: FileStorage | SqliteStorage | None = None
+_search_index: SearchIndex | None = None
+_group_commit: GroupCommit | None = None
+
+
+def search_index() -> SearchIndex:
+    global _search_index
+    if _search_index is None:
+        _search_index = SearchIndex(DATA_DIR)
+    return _search_index
+
+
+def index_message(message_id: str, stored: list[str], parsed: dict) -> None:
+    """Add a stored message to the search index (SEARCH_INDEX)."""
+    try:
+        search_index().add(
+            [mailbox_name(email) for email in stored],
+            message_id,
+            parsed["subject"],
+            parsed["from"] or "",
+            parsed["plaintext"],
+            parsed["html"],
+        )
+    except sqlite3.Error as e:
+        logger.error("Cannot add message %s to the search index: %s", message_id, e)
+
+
+def storage_codec() -> compress.Codec | None:
+    """The codec stored message files are compressed with (COMPRESSION)."""
+    return compress.get_codec(COMPRESSION)
+
+
+def group_commit() -> GroupCommit:
+    """The GroupCommit for the configured FSYNC mode."""
+    global _group_commit
+    if _group_commit is None:
+        _group_commit = GroupCommit(FSYNC, FSYNC_BATCH_WINDOW / 1000)
+    return _group_commit
+
+
+def write_batch() -> WriteBatch:
+    return group_commit().begin()
+
 
-                    edata["attachments"].append(file_id)
-                    edata["attachments_details"].append(
-                        {
-                            "filename": filename,
-                            "cid": cid,
-                            "id": file_id,
-                            "download_url": f"{URL}/api/attachment/{em}/{file_id}",
-                            "size": len(payload),
-                        }
-                    )
+def message_storage() -> FileStorage | SqliteStorage:
+    """The configured STORAGE backend, opened on first use in this process."""
+    global _storage
+    if _storage is None:
+        if STORAGE == "sqlite":
+            _storage = SqliteStorage(DATA_DIR, fsync=FSYNC)
+            if FSYNC == "batch":
+                group_commit().sync_files.append(_storage.path + "-wal")
+        else:
+            if STORAGE != "files":
+                logger.warning("Unknown STORAGE '%s', using files", STORAGE)
+            _storage = FileStorage()
+    return _storage
+
+
+def create_ingest_executors(mode: str, workers: int):
+    """
+    Build the (parse, io) executors for the configured INGEST_EXECUTOR mode.
+
+    inline:  everything runs on the event loop (previous behaviour)
+    thread:  parsing and disk writes share one thread pool
+    process: parsing runs in a process pool, disk writes in a thread pool
+    """
+    workers = workers or None
+    if mode == "thread":
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest")
+        return pool, pool
+    if mode == "process":
+        return (
+            ProcessPoolExecutor(max_workers=workers),
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ingest-io"),
+        )
+    if mode != "inline":
+        logger.warning("Unknown INGEST_EXECUTOR '%s', falling back to inline", mode)
+    return None, None
 
-            json_path = os.path.join(email_dir, f"{filenamebase}.json")
-            with open(json_path, "w", encoding="utf-8") as outfile:
-                json.dump(savedata, outfile, ensure_ascii=False)
 
-            await self.send_to_webhook(em, savedata)
+class CustomHandler:
+    connection_type = ""
 
+    def __init__(
+        self,
+        conntype: str = "Plaintext",
+        parse_executor: Executor | None = None,
+        io_executor: Executor | None = None,
+        http_session: aiohttp.ClientSession | None = None,
+        webhook_spool: WebhookSpool | None = None,
+        webhook_configs: WebhookConfigCache | None = None,
+        events: EventHub | None = None,
+        webhook_destinations: Destinations | None = None,
+    ) -> None:
+        self.connection_type = conntype
+        self.parse_executor = parse_executor
+        self.io_executor = io_executor
+        self.http_session = http_session
+        self.webhook_spool = webhook_spool
+        self.webhook_configs = webhook_configs
+        self.events = events
+        self.webhook_destinations = webhook_destinations
+
+    async def run_in(self, executor: Executor | None, func, *args):
+        """Run func on the given executor, or inline if there is none."""
+        if executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        """
+        Refuse recipients of unknown domains before the message body is sent,
+        so spam to them costs neither bandwidth nor parsing, and defer those
+        of domains over DOMAIN_RATE_LIMIT.
+        """
+        domain = address.lower().rpartition("@")[2]
+        if DISCARD_UNKNOWN and not is_known_domain(domain):
+            logger.info("Rejecting recipient of unknown domain: %s", domain)
+            metrics.RCPT_REJECTED.labels("unknown_domain").inc()
+            return "550 5.1.1 Recipient domain not accepted here"
+
+        admission = getattr(server, "admission", None)
+        if admission is not None and not admission.allow_domain(domain):
+            logger.info("Deferring recipient, domain over DOMAIN_RATE_LIMIT: %s", domain)
+            return DOMAIN_RATE_EXCEEDED
+
+        envelope.rcpt_tos.append(address)
+        envelope.rcpt_options.extend(rcpt_options)
         return "250 OK"
 
-    async def send_to_webhook(self, email, data):
+    async def handle_DATA(self, server, session, envelope):
+        peer = session.peer
+        rcpts = list(envelope.rcpt_tos)
+
+        logger.debug("Receiving message from: %s (%s)", peer, self.connection_type)
+        logger.debug("Message addressed from: %s", envelope.mail_from)
+        logger.debug("Message addressed to: %s", rcpts)
+
+        filenamebase = next_message_id()
+
+        # large messages arrive spooled to disk (see SPOOL_THRESHOLD)
+        spool_path = getattr(envelope, "spool_path", None)
+        source = spool_path or envelope.content
+        metrics.MESSAGE_SIZE.observe(
+            getattr(envelope, "content_size", 0) or len(envelope.content or b"")
+        )
+
+        try:
+            with metrics.PARSE_SECONDS.time():
+                parsed = await self.run_in(
+                    self.parse_executor,
+                    parse_message,
+                    source,
+                    filenamebase,
+                    ATTACHMENTS_MAX_SIZE,
+                    attachment_store_dir() if spool_path else None,
+                )
+        except AttachmentTooLarge:
+            metrics.MESSAGES.labels("attachment_too_large").inc()
+            return (
+                "500 Attachment too large. Max size: "
+                + f"{ATTACHMENTS_MAX_SIZE / 1000000:.2f}MB"
+            )
+
+        batch = write_batch()
+        with metrics.STORE_SECONDS.time():
+            stored, message = await self.run_in(
+                self.io_executor,
+                store_message,
+                filenamebase,
+                peer[0],
+                rcpts,
+                source,
+                parsed,
+                getattr(envelope, "content_sha256", None),
+                batch,
+            )
+            # FSYNC=batch: acknowledge only once the batch is on disk
+            await asyncio.wrap_future(batch.future)
+        metrics.FANOUT.observe(len(stored))
+        metrics.MESSAGES.labels("stored" if stored else "discarded").inc()
+
+        if stored and SEARCH_INDEX:
+            # before announcing it, so it can be found right away
+            await self.run_in(
+                self.io_executor, index_message, filenamebase, stored, parsed
+            )
+
+        if stored and self.events is not None:
+            self.publish_events(filenamebase, stored, message)
+
+        if stored and self.webhook_spool is not None:
+            await self.run_in(self.io_executor, self.spool_webhooks, stored, message)
+
+        return "250 OK"
+
+    def publish_events(
+        self, message_id: str, stored: list[str], message: MessageTemplate
+    ) -> None:
+        """Announce the stored copies on the event stream (EVENTS_PORT)."""
+        parsed = message.savedata["parsed"]
+        summary = {
+            "id": message_id,
+            "from": parsed["from"],
+            "subject": parsed["subject"],
+            "attachments": len(parsed["attachments"]),
+            "received_at": int(message_id[:13]),
+        }
+        for email in stored:
+            self.events.publish(dict(summary, email=email))
+
+    def spool_webhooks(self, stored: list[str], message: MessageTemplate) -> None:
+        """Write a webhook job for every stored copy that has a webhook target."""
+        jobs = []
+        for email in stored:
+            webhook_config = self.load_webhook_config(email)
+            if (webhook_config and webhook_config.get("enabled")) or WEBHOOK_URL:
+                jobs.append((email, message.for_mailbox(email)))
+        self.webhook_spool.enqueue_many(jobs)
+
+    async def send_to_webhook(self, email, data, attempt: int = 0) -> float | None:
+        """
+        Deliver one spooled webhook job. Returns the delay before the next
+        attempt, or None once the job is done.
+        """
         webhook_config = self.load_webhook_config(email)
 
         if webhook_config and webhook_config.get("enabled"):
-            await self.send_configured_webhook(email, data, webhook_config)
+            return await self.send_configured_webhook(
+                email, data, webhook_config, attempt
+            )
         elif WEBHOOK_URL:
-            await self.send_global_webhook(data)
+            await self.send_global_webhook(
+                await asyncio.to_thread(with_raw, data)
+            )
+        return None
 
     def load_webhook_config(self, email):
         try:
@@ -229,94 +1062,42 @@ class CustomHandler:
 
         webhook_file = os.path.join(email_dir, "webhook.json")
 
-        if os.path.exists(webhook_file):
-            try:
-                with open(webhook_file, "r", encoding="utf-8") as f:
-                    config = json.load(f)
-                    if not isinstance(config, dict):
-                        logger.error(
-                            "Invalid webhook config format for %s: not a dict", email
-                        )
-                        return None
-                    return config
-            except json.JSONDecodeError as e:
-                logger.error(
-                    "Invalid JSON in webhook config for %s: %s", email, str(e)
-                )
-            except Exception as e:
-                logger.error("Error loading webhook config for %s: %s", email, str(e))
-        return None
-
-    def replace_template_variables(self, template, data):
-        """Replace {{variable}} placeholders in template with actual data"""
-
-        def json_escape(value):
-            if value is None:
-                return ""
-            s = str(value)
-            return (
-                s.replace("\\", "\\\\")
-                .replace('"', '\\"')
-                .replace("\n", "\\n")
-                .replace("\r", "\\r")
-                .replace("\t", "\\t")
-            )
-
-        try:
-            parsed = data.get("parsed", {})
-            replacements = {
-                "{{to}}": json_escape(data["rcpts"][0] if data.get("rcpts") else ""),
-                "{{from}}": json_escape(parsed.get("from", "")),
-                "{{subject}}": json_escape(parsed.get("subject", "")),
-                "{{body}}": json_escape(parsed.get("body", "")),
-                "{{htmlbody}}": json_escape(parsed.get("htmlbody", "")),
-                "{{sender_ip}}": json_escape(data.get("sender_ip", "")),
-                "{{attachments}}": json.dumps(
-                    parsed.get("attachments_details", []), ensure_ascii=False
-                ),
-            }
-
-            result = template
-            for key, value in replacements.items():
-                result = result.replace(key, value)
-
-            return result
-        except Exception as e:
-            logger.error("Error replacing template variables: %s", str(e))
-            return template
+        if self.webhook_configs is not None:
+            return self.webhook_configs.get(webhook_file, email)
+        return read_webhook_config(webhook_file, email)
 
-    def sign_payload(self, payload, secret_key):
+    def sign_payload(self, payload: bytes, secret_key):
         """Generate HMAC signature for webhook payload"""
         if not secret_key:
             return None
 
         return hmac.new(
             secret_key.encode("utf-8"),
-            payload.encode("utf-8"),
+            payload,
             hashlib.sha256,
         ).hexdigest()
 
-    async def send_configured_webhook(self, email, data, config):
-        """Send webhook with custom configuration and retry logic"""
+    async def send_configured_webhook(self, email, data, config, attempt: int = 0):
+        """
+        Send one attempt of a webhook with custom configuration. Returns the
+        backoff before the next attempt, or None when done (sent or given up).
+        """
         webhook_url = config.get("webhook_url")
         if not webhook_url:
             logger.error("No webhook URL configured for %s", email)
-            return
-
-        template = config.get("payload_template", "{}")
-        payload_str = self.replace_template_variables(template, data)
+            return None
 
-        try:
-            payload = json.loads(payload_str)
-        except json.JSONDecodeError as e:
+        template = compile_template(str(config.get("payload_template", "{}")))
+        if template.error:
             logger.error(
                 "Invalid JSON in webhook payload template for %s: %s",
                 email,
-                str(e),
+                template.error,
             )
-            logger.error("Template: %s", template)
-            logger.error("Payload string: %s", payload_str)
-            return
+            logger.error("Template: %s", config.get("payload_template"))
+            return None
+
+        payload = template.render(data)
 
         retry_config = config.get("retry_config", {})
         max_attempts = int(retry_config.get("max_attempts", 3))
@@ -326,130 +1107,706 @@ class CustomHandler:
 
         secret_key = config.get("secret_key")
         if secret_key:
-            signature = self.sign_payload(json.dumps(payload, ensure_ascii=False), secret_key)
+            signature = self.sign_payload(payload, secret_key)
             if signature:
                 headers["X-Webhook-Signature"] = signature
 
-        timeout = aiohttp.ClientTimeout(total=30)
-
-        for attempt in range(max_attempts):
-            try:
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    async with session.post(
-                        webhook_url, json=payload, headers=headers
-                    ) as response:
-                        if 200 <= response.status < 300:
-                            logger.info(
-                                "Webhook sent successfully to %s for %s (attempt %d)",
-                                webhook_url,
-                                email,
-                                attempt + 1,
-                            )
-                            return
-                        else:
-                            logger.warning(
-                                "Webhook failed with status %d for %s (attempt %d)",
-                                response.status,
-                                email,
-                                attempt + 1,
-                            )
-            except Exception as e:
-                logger.error(
-                    "Error sending webhook for %s (attempt %d): %s",
+        try:
+            status, _ = await self.post_webhook(
+                "mailbox", webhook_url, data=payload, headers=headers
+            )
+            if 200 <= status < 300:
+                metrics.WEBHOOK_REQUESTS.labels("mailbox", "success").inc()
+                logger.info(
+                    "Webhook sent successfully to %s for %s (attempt %d)",
+                    webhook_url,
                     email,
                     attempt + 1,
-                    str(e),
                 )
-
-            if attempt < max_attempts - 1:
-                wait_time = (backoff_multiplier**attempt) * 1
-                logger.info(
-                    "Retrying webhook for %s in %d seconds...", email, wait_time
+                return None
+            else:
+                metrics.WEBHOOK_REQUESTS.labels("mailbox", "http_error").inc()
+                logger.warning(
+                    "Webhook failed with status %d for %s (attempt %d)",
+                    status,
+                    email,
+                    attempt + 1,
                 )
-                await asyncio.sleep(wait_time)
+        except Parked:
+            raise
+        except Exception as e:
+            metrics.WEBHOOK_REQUESTS.labels("mailbox", "error").inc()
+            logger.error(
+                "Error sending webhook for %s (attempt %d): %s",
+                email,
+                attempt + 1,
+                str(e),
+            )
+
+        if attempt < max_attempts - 1:
+            wait_time = backoff_delay(attempt, backoff_multiplier, WEBHOOK_BACKOFF_MAX)
+            metrics.WEBHOOK_RETRIES.inc()
+            logger.info(
+                "Retrying webhook for %s in %.1f seconds...", email, wait_time
+            )
+            return wait_time
 
+        metrics.WEBHOOK_FAILURES.inc()
         logger.error(
             "Failed to send webhook for %s after %d attempts", email, max_attempts
         )
+        return None
+
+    async def post_webhook(self, kind, url, read_body=False, **kwargs):
+        """
+        POST a webhook within the limits of its host (see webhook_destinations).
+        Returns the status and, with read_body, the response body. Raises
+        Parked if the host cannot take it now or this request was a probe the
+        host failed, and otherwise the errors of the request.
+        """
+        destination = None
+        probe = False
+        if self.webhook_destinations is not None:
+            destination = self.webhook_destinations.get(url)
+            probe = destination.acquire()
+        host_ok = False
+        try:
+            with metrics.WEBHOOK_SECONDS.labels(kind).time():
+                async with self.http_session.post(url, **kwargs) as response:
+                    status = response.status
+                    body = await response.read() if read_body else None
+            host_ok = not host_failed(status)
+            return status, body
+        finally:
+            if destination is not None:
+                destination.release(host_ok, probe)
+
+    def webhook_batch_key(self, email, data):
+        """
+        The batch a spooled webhook job joins: (key, window in seconds, max
+        size), or None to send it on its own. Jobs are batched per target
+        URL, secret and retry settings; the window and size of the mailbox
+        that starts a batch apply to it.
+        """
+        webhook_config = self.load_webhook_config(email)
+
+        if webhook_config and webhook_config.get("enabled"):
+            batch_config = webhook_config.get("batch_config") or {}
+            if not batch_config.get("enabled") or not webhook_config.get("webhook_url"):
+                return None
+            retry_config = webhook_config.get("retry_config", {})
+            key = (
+                "mailbox",
+                webhook_config["webhook_url"],
+                webhook_config.get("secret_key") or "",
+                int(retry_config.get("max_attempts", 3)),
+                float(retry_config.get("backoff_multiplier", 2)),
+            )
+            return (
+                key,
+                int(batch_config.get("window_ms", 1000)) / 1000,
+                max(1, int(batch_config.get("max_size", 100))),
+            )
+        elif WEBHOOK_URL and WEBHOOK_BATCH_WINDOW:
+            return (
+                ("global", WEBHOOK_URL, "", 3, 2.0),
+                WEBHOOK_BATCH_WINDOW / 1000,
+                max(1, WEBHOOK_BATCH_MAX_SIZE),
+            )
+        return None
+
+    def render_webhook_batch(self, items):
+        """
+        The payloads of the mailbox webhooks in a batch, each rendered with
+        the template of its mailbox, and their positions in items. Items
+        that cannot be rendered are left out (and logged).
+        """
+        payloads = []
+        positions = []
+        for i, (email, data) in enumerate(items):
+            config = self.load_webhook_config(email)
+            if not config or not config.get("enabled"):
+                logger.info("Webhook for %s was disabled, not sending it", email)
+                continue
+            template = compile_template(str(config.get("payload_template", "{}")))
+            if template.error:
+                logger.error(
+                    "Invalid JSON in webhook payload template for %s: %s",
+                    email,
+                    template.error,
+                )
+                continue
+            payloads.append(template.render(data))
+            positions.append(i)
+        return payloads, positions
+
+    async def send_webhook_batch(self, key, items, attempt: int = 0):
+        """
+        Send one attempt of a batch of webhooks (see webhook_batch_key) as a
+        JSON array, signed once. A 2xx response may list the items the
+        receiver could not take as {"failed": [positions in the array]};
+        those are tried again, all of them if the request failed. Returns the
+        backoff before the next attempt (None when done) and the positions in
+        items to send again.
+        """
+        kind, webhook_url, secret_key, max_attempts, backoff_multiplier = key
+        kind += "_batch"
+
+        if kind == "global_batch":
+            payloads = [
+                json.dumps(data).encode("utf-8")
+                for data in await asyncio.to_thread(
+                    lambda: [with_raw(data) for _, data in items]
+                )
+            ]
+            positions = list(range(len(items)))
+        else:
+            payloads, positions = self.render_webhook_batch(items)
+        if not payloads:
+            return None, []
+
+        payload = b"[" + b",".join(payloads) + b"]"
+        headers = {
+            "Content-Type": "application/json",
+            "X-Webhook-Batch-Size": str(len(payloads)),
+        }
+        signature = self.sign_payload(payload, secret_key)
+        if signature:
+            headers["X-Webhook-Signature"] = signature
+
+        metrics.WEBHOOK_BATCH_SIZE.observe(len(payloads))
+        failed = positions
+        try:
+            status, body = await self.post_webhook(
+                kind, webhook_url, read_body=True, data=payload, headers=headers
+            )
+            if 200 <= status < 300:
+                failed = failed_batch_items(body, positions)
+            if not 200 <= status < 300:
+                metrics.WEBHOOK_REQUESTS.labels(kind, "http_error").inc()
+                logger.warning(
+                    "Webhook batch of %d to %s failed with status %d (attempt %d)",
+                    len(payloads),
+                    webhook_url,
+                    status,
+                    attempt + 1,
+                )
+            elif failed:
+                metrics.WEBHOOK_REQUESTS.labels(kind, "partial").inc()
+                logger.warning(
+                    "Webhook batch to %s: %d of %d item(s) failed (attempt %d)",
+                    webhook_url,
+                    len(failed),
+                    len(payloads),
+                    attempt + 1,
+                )
+            else:
+                metrics.WEBHOOK_REQUESTS.labels(kind, "success").inc()
+                logger.info(
+                    "Webhook batch of %d sent successfully to %s (attempt %d)",
+                    len(payloads),
+                    webhook_url,
+                    attempt + 1,
+                )
+                return None, []
+        except Parked:
+            raise
+        except Exception as e:
+            metrics.WEBHOOK_REQUESTS.labels(kind, "error").inc()
+            logger.error(
+                "Error sending webhook batch of %d to %s (attempt %d): %s",
+                len(payloads),
+                webhook_url,
+                attempt + 1,
+                str(e),
+            )
+
+        if attempt < max_attempts - 1:
+            wait_time = backoff_delay(attempt, backoff_multiplier, WEBHOOK_BACKOFF_MAX)
+            metrics.WEBHOOK_RETRIES.inc(len(failed))
+            logger.info(
+                "Retrying %d webhook(s) to %s in %.1f seconds...",
+                len(failed),
+                webhook_url,
+                wait_time,
+            )
+            return wait_time, failed
+
+        metrics.WEBHOOK_FAILURES.inc(len(failed))
+        for i in failed:
+            email, data = items[i]
+            logger.error(
+                "Failed to send webhook for %s (subject %r) after %d attempts",
+                email,
+                (data.get("parsed") or {}).get("subject"),
+                max_attempts,
+            )
+        return None, []
 
     async def send_global_webhook(self, data):
         """Send to global webhook URL (backward compatibility)"""
-        timeout = aiohttp.ClientTimeout(total=30)
         try:
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(WEBHOOK_URL, json=data) as response:
-                    if 200 <= response.status < 300:
-                        logger.info("Global webhook sent successfully.")
-                    else:
-                        logger.warning(
-                            "Global webhook failed with status %d", response.status
-                        )
+            status, _ = await self.post_webhook("global", WEBHOOK_URL, json=data)
+            if 200 <= status < 300:
+                metrics.WEBHOOK_REQUESTS.labels("global", "success").inc()
+                logger.info("Global webhook sent successfully.")
+            else:
+                metrics.WEBHOOK_REQUESTS.labels("global", "http_error").inc()
+                metrics.WEBHOOK_FAILURES.inc()
+                logger.warning("Global webhook failed with status %d", status)
+        except Parked:
+            raise
         except Exception as e:
+            metrics.WEBHOOK_REQUESTS.labels("global", "error").inc()
+            metrics.WEBHOOK_FAILURES.inc()
             logger.error("Error sending global webhook: %s", str(e))
 
-    def handleAttachment(self, part, payload_bytes: bytes):
-        filename = part.get_filename() or "untitled"
 
-        cid = part.get("Content-ID")
-        if cid is not None:
-            cid = cid.strip("<>")
-        elif part.get("X-Attachment-Id") is not None:
-            cid = part.get("X-Attachment-Id")
-        else:
-            cid = hashlib.md5(payload_bytes).hexdigest()
+def failed_batch_items(body: bytes, positions: list[int]) -> list[int]:
+    """
+    The items of a webhook batch its receiver reported as failed, from a
+    response like {"failed": [0, 3]} (positions in the posted array);
+    positions maps them to the items of the batch. Any other response
+    means all of them were taken.
+    """
+    try:
+        failed = json.loads(body).get("failed") or []
+        return sorted(
+            {positions[i] for i in failed if isinstance(i, int) and 0 <= i < len(positions)}
+        )
+    except (ValueError, AttributeError, TypeError):
+        return []
+
+
+def create_webhook_session() -> aiohttp.ClientSession:
+    """
+    One pooled HTTP session for all webhook deliveries of this process, so
+    connections (and TLS handshakes) to a receiver are reused between POSTs.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=WEBHOOK_MAX_CONNECTIONS,
+        limit_per_host=WEBHOOK_MAX_CONNECTIONS_PER_HOST,
+        ttl_dns_cache=WEBHOOK_DNS_CACHE_TTL,
+        keepalive_timeout=WEBHOOK_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(
+        connector=connector, timeout=aiohttp.ClientTimeout(total=30)
+    )
+
+
+def worker_dir(base: str, worker_id: int) -> str:
+    """Per-worker partition of a spool directory."""
+    return os.path.join(base, str(worker_id))
 
-        fid = safe_attachment_id(filename)
 
-        logger.debug(
-            'Handling attachment: "%s" (ID: "%s") of type "%s" with CID "%s"',
-            filename,
-            fid,
-            part.get_content_type(),
-            cid,
+def adopt_webhook_jobs(spool_dir: str, workers: int) -> int:
+    """
+    Move pending webhook jobs that no running worker owns (written before
+    WORKERS was introduced or lowered) into the partition of worker 0.
+    """
+    target = worker_dir(spool_dir, 0)
+    ensure_dir(target, 0o755)
+    sources = [spool_dir] + [
+        os.path.join(spool_dir, entry)
+        for entry in os.listdir(spool_dir)
+        if entry.isdigit() and int(entry) >= workers
+    ]
+
+    adopted = 0
+    for source in sources:
+        for entry in os.listdir(source):
+            if entry.endswith(".json"):
+                os.replace(os.path.join(source, entry), os.path.join(target, entry))
+                adopted += 1
+    return adopted
+
+
+async def start_smtp_server(
+    handler: "CustomHandler",
+    port: int,
+    tls_context: ssl.SSLContext | None = None,
+    ssl_context: ssl.SSLContext | None = None,
+    admission: Admission | None = None,
+) -> asyncio.AbstractServer:
+    """
+    Bind an SMTP listener on the running loop.
+
+    Same SMTP settings as aiosmtpd's Controller, but without its private
+    thread and loop, so handlers share the loop (and HTTP session) of run().
+    With WORKERS > 1 every worker binds the port with SO_REUSEPORT and the
+    kernel spreads incoming connections across them.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: SpoolingSMTP(
+            handler,
+            tls_context=tls_context,
+            enable_SMTPUTF8=True,
+            data_size_limit=MESSAGE_MAX_SIZE or None,
+            spool_threshold=SPOOL_THRESHOLD,
+            spool_dir=worker_dir(INCOMING_DIR, WORKER_ID),
+            admission=admission,
+        ),
+        host="0.0.0.0",
+        port=port,
+        ssl=ssl_context,
+        reuse_port=WORKERS > 1,
+    )
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=metrics.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+def is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+async def handle_debug_tasks(request: web.Request) -> web.Response:
+    return web.Response(text=dump_tasks(PROFILE_DIR))
+
+
+async def handle_debug_profile(request: web.Request) -> web.StreamResponse:
+    """
+    GET /debug/profile?seconds=N&format=collapsed|pstats starts a CPU profile
+    (&wait=1 returns the file once it's done), ?stop=1 ends it early.
+    """
+    profiler: Profiler = request.app["profiler"]
+    if request.query.get("stop"):
+        path = profiler.stop()
+        return web.Response(text=f"Written to {path}\n" if path else "No profile running\n")
+
+    try:
+        seconds = float(request.query.get("seconds", PROFILE_SECONDS))
+    except ValueError:
+        seconds = 0
+    if not 0 < seconds <= 3600:
+        raise web.HTTPBadRequest(text="seconds must be between 0 and 3600\n")
+    try:
+        path = profiler.start(seconds, request.query.get("format", "collapsed"))
+    except ProfilingError as e:
+        raise web.HTTPConflict(text=f"{e}\n")
+
+    if request.query.get("wait"):
+        # the profile still ends if the client goes away
+        await asyncio.shield(profiler.finished)
+        return web.FileResponse(path)
+    return web.Response(text=f"Profiling for {seconds:g} seconds, writing to {path}\n")
+
+
+async def handle_debug_tracemalloc(request: web.Request) -> web.Response:
+    """GET /debug/tracemalloc: start tracing or diff to the previous snapshot; ?stop=1."""
+    memory: MemoryTracker = request.app["memory"]
+    if request.query.get("stop"):
+        memory.stop()
+        return web.Response(text="tracemalloc stopped\n")
+    return web.Response(text=await asyncio.to_thread(memory.snapshot))
+
+
+def create_http_app(
+    profiler: Profiler | None = None, memory: MemoryTracker | None = None
+) -> web.Application:
+    """
+    HTTP endpoints of the mailserver process (see METRICS_PORT), with the
+    /debug endpoints if PROFILING is enabled.
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    if profiler is not None:
+        app["profiler"] = profiler
+        app["memory"] = memory
+        app.router.add_get("/debug/tasks", handle_debug_tasks)
+        app.router.add_get("/debug/profile", handle_debug_profile)
+        app.router.add_get("/debug/tracemalloc", handle_debug_tracemalloc)
+    return app
+
+
+def events_allowed(password: str, wildcard: bool) -> bool:
+    """
+    The rules of the web UI: PASSWORD protects everything, and seeing the
+    mail of all addresses (* or *@domain, like the account list) needs
+    ADMIN_PASSWORD if one is set.
+    """
+
+    def matches(secret: str) -> bool:
+        return hmac.compare_digest(password.encode("utf-8"), secret.encode("utf-8"))
+
+    if ADMIN_PASSWORD and matches(ADMIN_PASSWORD):
+        return True
+    if wildcard and ADMIN_PASSWORD:
+        return False
+    return not PASSWORD or matches(PASSWORD)
+
+
+def sse_message(event: str, data: dict, event_id: str | None = None) -> bytes:
+    lines = [f"id: {event_id}"] if event_id else []
+    lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+async def handle_events(request: web.Request) -> web.StreamResponse:
+    """
+    Server-Sent Events stream of new messages:
+    GET /events?address=<email>, *@<domain> or * (repeatable, or comma separated).
+    The password goes into the PWD header or the password parameter.
+    """
+    patterns = {
+        pattern.strip().lower()
+        for value in request.query.getall("address", [])
+        for pattern in value.split(",")
+        if pattern.strip()
+    }
+    if not patterns or not all(map(valid_pattern, patterns)):
+        raise web.HTTPBadRequest(text="address must be an email, *@<domain> or *\n")
+    password = request.headers.get("PWD") or request.query.get("password") or ""
+    if not events_allowed(password, any(p.startswith("*") for p in patterns)):
+        raise web.HTTPUnauthorized(text="Wrong password\n")
+
+    hub: EventHub = request.app["events"]
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await response.prepare(request)
+    subscriber = hub.subscribe(patterns)
+    try:
+        await response.write(b"retry: 3000\n\n")
+        while not subscriber.closed:
+            event = await subscriber.get(EVENT_STREAM_KEEPALIVE)
+            if subscriber.closed:
+                break
+            if subscriber.dropped:
+                # the client fell behind: it has to re-list the mailbox
+                await response.write(sse_message("dropped", {"count": subscriber.dropped}))
+                subscriber.dropped = 0
+            if event is None:
+                await response.write(b": keepalive\n\n")
+            else:
+                await response.write(sse_message("message", event, event["id"]))
+    except ConnectionResetError:
+        pass
+    finally:
+        hub.unsubscribe(subscriber)
+    return response
+
+
+def create_events_app(hub: EventHub) -> web.Application:
+    """The new-mail event stream (see EVENTS_PORT)."""
+    app = web.Application()
+    app["events"] = hub
+    app.router.add_get("/events", handle_events)
+
+    async def close_streams(app: web.Application) -> None:
+        hub.close()
+
+    app.on_shutdown.append(close_streams)
+    return app
+
+
+async def start_http_server(
+    app: web.Application, host: str, port: int, reuse_port: bool = False
+) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=reuse_port or None).start()
+    return runner
+
+
+async def run(port: int):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    profiler = memory = watchdog = None
+    if PROFILING:
+        profiler = Profiler(PROFILE_DIR)
+        memory = MemoryTracker(PROFILE_DIR)
+        loop.add_signal_handler(signal.SIGUSR1, dump_tasks, PROFILE_DIR)
+        loop.add_signal_handler(signal.SIGUSR2, profiler.toggle, PROFILE_SECONDS)
+        logger.info(
+            "Profiling enabled (pid %d): SIGUSR1 dumps the asyncio tasks, SIGUSR2 "
+            "starts or stops a %g second CPU profile, files go to %s",
+            os.getpid(),
+            PROFILE_SECONDS,
+            PROFILE_DIR,
+        )
+    if SLOW_CALLBACK_MS:
+        watchdog = SlowCallbackWatchdog(SLOW_CALLBACK_MS / 1000)
+        watchdog.start()
+        logger.info("Logging event loop callbacks that block for over %d ms", SLOW_CALLBACK_MS)
+
+    if SPOOL_THRESHOLD:
+        incoming_dir = worker_dir(INCOMING_DIR, WORKER_ID)
+        ensure_dir(incoming_dir, 0o755)
+        for leftover in os.listdir(incoming_dir):
+            os.remove(os.path.join(incoming_dir, leftover))
+
+    parse_executor, io_executor = create_ingest_executors(
+        INGEST_EXECUTOR, INGEST_WORKERS
+    )
+    logger.info("Ingest executor: %s", INGEST_EXECUTOR)
+    logger.info("Storage: %s", message_storage().name)
+    logger.info("Fsync mode: %s", group_commit().mode)
+    codec = storage_codec()
+    if codec is None and COMPRESSION.strip().lower() not in ("", "none"):
+        logger.warning(
+            "COMPRESSION '%s' is unknown or not available (zstd needs Python 3.14 "
+            "or the zstandard package), not compressing",
+            COMPRESSION,
         )
+    logger.info("Compression: %s", codec.name if codec else "none")
+    if SEARCH_INDEX:
+        logger.info("Search index: %s", search_index().path)
+    group_commit().start()
+
+    http_session = create_webhook_session()
+    webhook_configs = WebhookConfigCache(
+        WEBHOOK_CONFIG_CACHE_SIZE, WEBHOOK_CONFIG_CACHE_TTL
+    )
+    if WORKER_ID == 0 and os.path.isdir(WEBHOOK_SPOOL_DIR):
+        adopted = adopt_webhook_jobs(WEBHOOK_SPOOL_DIR, WORKERS)
+        if adopted:
+            logger.info("Adopted %d orphaned webhook job(s)", adopted)
+    webhook_spool = WebhookSpool(
+        worker_dir(WEBHOOK_SPOOL_DIR, WORKER_ID), WEBHOOK_WORKERS, group_commit()
+    )
+    webhook_destinations = Destinations(
+        WEBHOOK_HOST_CONCURRENCY, WEBHOOK_CIRCUIT_FAILURES, WEBHOOK_CIRCUIT_COOLDOWN
+    )
+    logger.info(
+        "Webhook hosts: %d request(s) at once each (0 = unlimited), circuit opens "
+        "after %d failure(s) for %g seconds (0 = never)",
+        WEBHOOK_HOST_CONCURRENCY,
+        WEBHOOK_CIRCUIT_FAILURES,
+        WEBHOOK_CIRCUIT_COOLDOWN,
+    )
+
+    events = None
+    events_runner = None
+    if EVENTS_PORT:
+        events = EventHub(EVENTS_QUEUE_SIZE, EVENTS_RELAY_DIR, WORKER_ID, WORKERS)
+        events.start()
+        # all workers share the port; events are relayed between them
+        events_runner = await start_http_server(
+            create_events_app(events), EVENTS_HOST, EVENTS_PORT, reuse_port=WORKERS > 1
+        )
+        logger.info(
+            "Serving new-mail events on http://%s:%d/events", EVENTS_HOST, EVENTS_PORT
+        )
+        if not PASSWORD and not is_loopback(EVENTS_HOST):
+            logger.warning(
+                "The event stream on %s is open to everyone who can reach it: "
+                "set PASSWORD or bind EVENTS_HOST to 127.0.0.1",
+                EVENTS_HOST,
+            )
 
-        if ATTACHMENTS_MAX_SIZE > 0 and len(payload_bytes) > ATTACHMENTS_MAX_SIZE:
-            logger.info("Attachment too large: %s", filename)
-            return False
+    def handler(conntype: str) -> CustomHandler:
+        return CustomHandler(
+            conntype,
+            parse_executor,
+            io_executor,
+            http_session,
+            webhook_spool,
+            webhook_configs,
+            events,
+            webhook_destinations,
+        )
 
-        return (filename, payload_bytes, cid, fid)
+    webhook_handler = handler("Webhook")
+    await webhook_spool.start(
+        webhook_handler.send_to_webhook,
+        webhook_handler.webhook_batch_key,
+        webhook_handler.send_webhook_batch,
+    )
+    if WEBHOOK_URL and WEBHOOK_BATCH_WINDOW:
+        logger.info(
+            "Batching global webhooks: %d ms, up to %d per request",
+            WEBHOOK_BATCH_WINDOW,
+            WEBHOOK_BATCH_MAX_SIZE,
+        )
 
-    def replace_cid_with_attachment_id(self, html_content, attachments, email):
-        """Replace cid: references in HTML with /api/attachment/<email>/<id>"""
-        if not html_content:
-            return html_content
+    admission = None
+    if MAX_CONCURRENT_DATA or MAX_INFLIGHT_BYTES or IP_RATE_LIMIT or DOMAIN_RATE_LIMIT:
+        # shared by all listeners of this worker
+        admission = Admission(
+            MAX_CONCURRENT_DATA,
+            MAX_INFLIGHT_BYTES,
+            IP_RATE_LIMIT,
+            IP_RATE_BURST,
+            DOMAIN_RATE_LIMIT,
+            DOMAIN_RATE_BURST,
+        )
+        logger.info(
+            "Admission control: %d concurrent messages, %d bytes in flight, "
+            "%g/min per IP, %g/min per domain (0 = unlimited)",
+            MAX_CONCURRENT_DATA,
+            MAX_INFLIGHT_BYTES,
+            IP_RATE_LIMIT,
+            DOMAIN_RATE_LIMIT,
+        )
 
-        for (_, _, cid, fid) in attachments.values():
-            if not cid:
-                continue
-            html_content = html_content.replace(
-                f"cid:{cid}", f"/api/attachment/{email}/{fid}"
+    http_runner = None
+    lag_task = None
+    if METRICS_PORT:
+        for stat in ("entries", "hits", "misses", "evictions"):
+            metrics.WEBHOOK_CONFIG_CACHE.labels(stat).set_function(
+                lambda stat=stat: webhook_configs.stats()[stat]
             )
-        return html_content
+        webhook_destinations.register_metrics()
+        if admission is not None:
+            admission.register_metrics()
+        lag_task = asyncio.create_task(metrics.measure_loop_lag())
+        # every worker process serves its own metrics on the next port
+        metrics_port = METRICS_PORT + WORKER_ID
+        debug = profiler is not None and is_loopback(METRICS_HOST)
+        if profiler is not None and not debug:
+            # they have no password
+            logger.warning(
+                "Not serving /debug/*: METRICS_HOST %s is not a loopback address "
+                "(the profiling signals still work)",
+                METRICS_HOST,
+            )
+        http_runner = await start_http_server(
+            create_http_app(profiler, memory) if debug else create_http_app(),
+            METRICS_HOST,
+            metrics_port,
+        )
+        logger.info("Serving metrics on http://%s:%d/metrics", METRICS_HOST, metrics_port)
 
+    servers = []
 
-async def run(port: int):
     if TLS_CERTIFICATE and TLS_PRIVATE_KEY:
         context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         context.load_cert_chain(TLS_CERTIFICATE, TLS_PRIVATE_KEY)
 
-        controller_plaintext = Controller(
-            CustomHandler("Plaintext or STARTTLS"),
-            hostname="0.0.0.0",
-            port=port,
-            tls_context=context,
+        servers.append(
+            await start_smtp_server(
+                handler("Plaintext or STARTTLS"),
+                port,
+                tls_context=context,
+                admission=admission,
+            )
         )
 
-        controller_plaintext.start()
-
         if MAILPORT_TLS > 0:
-            controller_tls = Controller(
-                CustomHandler("TLS"),
-                hostname="0.0.0.0",
-                port=MAILPORT_TLS,
-                ssl_context=context,
+            servers.append(
+                await start_smtp_server(
+                    handler("TLS"), MAILPORT_TLS, ssl_context=context, admission=admission
+                )
             )
-            controller_tls.start()
             logger.info(
                 "Starting TLS only Mailserver on port %d",
                 MAILPORT_TLS,
@@ -460,27 +1817,83 @@ async def run(port: int):
             port,
         )
     else:
-        controller_plaintext = Controller(
-            CustomHandler("Plaintext"),
-            hostname="0.0.0.0",
-            port=port,
+        servers.append(
+            await start_smtp_server(handler("Plaintext"), port, admission=admission)
         )
-        controller_plaintext.start()
 
         logger.info("Starting plaintext Mailserver on port %d", port)
 
-        controller_tls = None
-
     logger.info("Ready to receive Emails")
     logger.info("")
 
-    try:
-        while True:
-            await asyncio.sleep(1)
-    except KeyboardInterrupt:
-        controller_plaintext.stop()
-        if MAILPORT_TLS > 0 and TLS_CERTIFICATE and TLS_PRIVATE_KEY and controller_tls:
-            controller_tls.stop()
+    await stop.wait()
+
+    logger.info("Shutting down Mailserver")
+    for server in servers:
+        server.close()
+    for server in servers:
+        await server.wait_closed()
+    for executor in {parse_executor, io_executor} - {None}:
+        executor.shutdown(wait=True)
+    group_commit().stop()
+    if http_runner is not None:
+        await http_runner.cleanup()
+    if events_runner is not None:
+        await events_runner.cleanup()
+        events.stop()
+    if lag_task is not None:
+        lag_task.cancel()
+    await webhook_spool.stop()
+    webhook_destinations.close()
+    await http_session.close()
+    if profiler is not None:
+        profiler.stop()
+    if watchdog is not None:
+        watchdog.stop()
+    logger.info("Webhook config cache: %s", webhook_configs.stats())
+
+
+def port_conflict(port: int) -> str | None:
+    """
+    Why the configured ports cannot all be bound, or None. Every worker serves
+    its metrics on METRICS_PORT + its id, so that range must not take the
+    port of another listener.
+    """
+    ports = {"MAILPORT": port}
+    if MAILPORT_TLS > 0:
+        ports["MAILPORT_TLS"] = MAILPORT_TLS
+    if EVENTS_PORT:
+        ports["EVENTS_PORT"] = EVENTS_PORT
+    seen: dict[int, str] = {}
+    for name, number in ports.items():
+        if number in seen:
+            return f"{name} and {seen[number]} are both {number}"
+        seen[number] = name
+    if METRICS_PORT:
+        last = METRICS_PORT + WORKERS - 1
+        if last > 65535:
+            return f"METRICS_PORT {METRICS_PORT} + WORKERS {WORKERS} goes beyond port 65535"
+        for number, name in seen.items():
+            if METRICS_PORT <= number <= last:
+                return (
+                    f"{name} {number} is in the metrics ports {METRICS_PORT}-{last} "
+                    f"(METRICS_PORT plus one per worker, WORKERS = {WORKERS})"
+                )
+    return None
+
+
+def run_worker(port: int, worker_id: int) -> None:
+    """Entry point of a forked SMTP worker process."""
+    global WORKER_ID
+    WORKER_ID = worker_id
+    for log_handler in logging.getLogger().handlers:
+        log_handler.setFormatter(
+            logging.Formatter(
+                f"[%(asctime)s] [Mailserver:{worker_id}] %(levelname)s - %(message)s",
+                datefmt="%d-%b-%Y %H:%M:%S",
+            )
+        )
+    asyncio.run(run(port))
 
 
 if __name__ == "__main__":
@@ -504,6 +1917,15 @@ if __name__ == "__main__":
         DOMAINS = [d.strip() for d in domains_raw.split(",") if d.strip()]
 
         URL = Config.get("GENERAL", "URL", fallback="")
+        PASSWORD = (Config.get("GENERAL", "PASSWORD", fallback="") or "").strip('"')
+        ADMIN_PASSWORD = (
+            Config.get("ADMIN", "ADMIN_PASSWORD", fallback="") or ""
+        ).strip('"')
+        STORAGE = (
+            Config.get("GENERAL", "STORAGE", fallback="files") or "files"
+        ).strip().lower()
+        SEARCH_INDEX = Config.getboolean("GENERAL", "SEARCH_INDEX", fallback=False)
+        COMPRESSION = Config.get("MAILSERVER", "COMPRESSION", fallback="none") or "none"
 
         ATTACHMENTS_MAX_SIZE = int(
             Config.get("MAILSERVER", "ATTACHMENTS_MAX_SIZE", fallback="0")
@@ -515,6 +1937,70 @@ if __name__ == "__main__":
         TLS_CERTIFICATE = Config.get("MAILSERVER", "TLS_CERTIFICATE", fallback="")
         TLS_PRIVATE_KEY = Config.get("MAILSERVER", "TLS_PRIVATE_KEY", fallback="")
 
+        INGEST_EXECUTOR = Config.get(
+            "MAILSERVER", "INGEST_EXECUTOR", fallback="inline"
+        ).strip().lower()
+        INGEST_WORKERS = int(
+            Config.get("MAILSERVER", "INGEST_WORKERS", fallback="0") or 0
+        )
+
+        SPOOL_THRESHOLD = int(
+            Config.get("MAILSERVER", "SPOOL_THRESHOLD", fallback="0") or 0
+        )
+        MESSAGE_MAX_SIZE = int(
+            Config.get("MAILSERVER", "MESSAGE_MAX_SIZE", fallback="33554432") or 0
+        )
+        METRICS_HOST = Config.get(
+            "MAILSERVER", "METRICS_HOST", fallback="127.0.0.1"
+        ) or "127.0.0.1"
+        METRICS_PORT = int(Config.get("MAILSERVER", "METRICS_PORT", fallback="0") or 0)
+        PROFILING = Config.getboolean("MAILSERVER", "PROFILING", fallback=False)
+        # relative to the base directory
+        PROFILE_DIR = os.path.join(
+            BASE_DIR, Config.get("MAILSERVER", "PROFILE_DIR", fallback="") or PROFILE_DIR
+        )
+        PROFILE_SECONDS = float(
+            Config.get("MAILSERVER", "PROFILE_SECONDS", fallback="30") or 30
+        )
+        SLOW_CALLBACK_MS = int(
+            Config.get("MAILSERVER", "SLOW_CALLBACK_MS", fallback="0") or 0
+        )
+        WORKERS = max(1, int(Config.get("MAILSERVER", "WORKERS", fallback="1") or 1))
+        FSYNC = (
+            Config.get("MAILSERVER", "FSYNC", fallback="none") or "none"
+        ).strip().lower()
+        FSYNC_BATCH_WINDOW = float(
+            Config.get("MAILSERVER", "FSYNC_BATCH_WINDOW", fallback="5") or 0
+        )
+        MAX_CONCURRENT_DATA = int(
+            Config.get("MAILSERVER", "MAX_CONCURRENT_DATA", fallback="0") or 0
+        )
+        MAX_INFLIGHT_BYTES = int(
+            Config.get("MAILSERVER", "MAX_INFLIGHT_BYTES", fallback="0") or 0
+        )
+        IP_RATE_LIMIT = float(Config.get("MAILSERVER", "IP_RATE_LIMIT", fallback="0") or 0)
+        IP_RATE_BURST = float(Config.get("MAILSERVER", "IP_RATE_BURST", fallback="0") or 0)
+        DOMAIN_RATE_LIMIT = float(
+            Config.get("MAILSERVER", "DOMAIN_RATE_LIMIT", fallback="0") or 0
+        )
+        DOMAIN_RATE_BURST = float(
+            Config.get("MAILSERVER", "DOMAIN_RATE_BURST", fallback="0") or 0
+        )
+        EVENTS_HOST = Config.get(
+            "MAILSERVER", "EVENTS_HOST", fallback="127.0.0.1"
+        ) or "127.0.0.1"
+        EVENTS_PORT = int(Config.get("MAILSERVER", "EVENTS_PORT", fallback="0") or 0)
+        EVENTS_QUEUE_SIZE = max(
+            1, int(Config.get("MAILSERVER", "EVENTS_QUEUE_SIZE", fallback="100") or 100)
+        )
+
+        MESSAGE_MAX_AGE = retention.parse_age(
+            Config.get("CLEANUP", "DELETE_OLDER_THAN_DAYS", fallback="false"), 86400
+        )
+        MAILBOX_MAX_AGE = retention.parse_age(
+            Config.get("CLEANUP", "MAILBOX_MAX_AGE_MINUTES", fallback="false"), 60
+        )
+
         if Config.has_section("WEBHOOK") and Config.has_option(
             "WEBHOOK", "WEBHOOK_URL"
         ):
@@ -522,8 +2008,58 @@ if __name__ == "__main__":
         else:
             WEBHOOK_URL = ""
 
+        WEBHOOK_WORKERS = int(
+            Config.get("WEBHOOK", "WEBHOOK_WORKERS", fallback="4") or 4
+        )
+        WEBHOOK_MAX_CONNECTIONS = int(
+            Config.get("WEBHOOK", "WEBHOOK_MAX_CONNECTIONS", fallback="100") or 100
+        )
+        WEBHOOK_MAX_CONNECTIONS_PER_HOST = int(
+            Config.get("WEBHOOK", "WEBHOOK_MAX_CONNECTIONS_PER_HOST", fallback="10")
+            or 10
+        )
+        WEBHOOK_CONFIG_CACHE_SIZE = int(
+            Config.get("WEBHOOK", "WEBHOOK_CONFIG_CACHE_SIZE", fallback="10000")
+            or 10000
+        )
+        WEBHOOK_CONFIG_CACHE_TTL = float(
+            Config.get("WEBHOOK", "WEBHOOK_CONFIG_CACHE_TTL", fallback="2") or 0
+        )
+        WEBHOOK_BATCH_WINDOW = int(
+            Config.get("WEBHOOK", "WEBHOOK_BATCH_WINDOW", fallback="0") or 0
+        )
+        WEBHOOK_BATCH_MAX_SIZE = int(
+            Config.get("WEBHOOK", "WEBHOOK_BATCH_MAX_SIZE", fallback="100") or 100
+        )
+        WEBHOOK_HOST_CONCURRENCY = int(
+            Config.get("WEBHOOK", "WEBHOOK_HOST_CONCURRENCY", fallback="0") or 0
+        )
+        WEBHOOK_CIRCUIT_FAILURES = int(
+            Config.get("WEBHOOK", "WEBHOOK_CIRCUIT_FAILURES", fallback="5") or 0
+        )
+        WEBHOOK_CIRCUIT_COOLDOWN = float(
+            Config.get("WEBHOOK", "WEBHOOK_CIRCUIT_COOLDOWN", fallback="60") or 60
+        )
+        WEBHOOK_BACKOFF_MAX = float(
+            Config.get("WEBHOOK", "WEBHOOK_BACKOFF_MAX", fallback="300") or 0
+        )
+
     logger.info("Discard unknown domains: %s", DISCARD_UNKNOWN)
     logger.info("Max size of attachments: %d", ATTACHMENTS_MAX_SIZE)
+    logger.info("Max size of messages: %d", MESSAGE_MAX_SIZE)
     logger.info("Listening for domains: %s", DOMAINS)
 
-    asyncio.run(run(port))
+    conflict = port_conflict(port)
+    if conflict:
+        logger.error("Cannot start, the ports overlap: %s", conflict)
+        sys.exit(1)
+
+    if WORKERS > 1:
+        logger.info("Starting %d SMTP worker processes", WORKERS)
+        WorkerSupervisor(
+            WORKERS,
+            lambda worker_id: run_worker(port, worker_id),
+            relay_signals=(signal.SIGUSR1, signal.SIGUSR2) if PROFILING else (),
+        ).run()
+    else:
+        asyncio.run(run(port))
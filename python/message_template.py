@@ -0,0 +1,81 @@
+import json
+import re
+import uuid
+
+from webhook_template import json_escape
+
+
+def cid_pattern(cids) -> re.Pattern | None:
+    """
+    One regex for all cid: references of a message. Longer CIDs come first,
+    so a CID that is a prefix of another one doesn't cut it short.
+    """
+    cids = sorted({cid for cid in cids if cid}, key=len, reverse=True)
+    if not cids:
+        return None
+    return re.compile("cid:(" + "|".join(map(re.escape, cids)) + ")")
+
+
+class MessageTemplate:
+    """
+    The savedata of a message with the recipient's mailbox left open: the
+    attachment links in the HTML body and the download URLs.
+
+    Everything else is done once per message. The HTML is rewritten in a
+    single pass and the whole savedata is serialized once, with a unique
+    token standing in for the mailbox and split on it; a recipient only
+    costs joining the fragments with its (escaped) address.
+
+    savedata itself is the mailbox-independent form, with the cid:
+    references in htmlbody and download_url set to None.
+    """
+
+    def __init__(self, savedata: dict, cids: dict[str, str], base_url: str) -> None:
+        self.savedata = savedata
+        self.base_url = base_url
+        pattern = cid_pattern(cids)
+        html = savedata["parsed"]["htmlbody"]
+        details = savedata["parsed"]["attachments_details"]
+
+        while True:
+            token = uuid.uuid4().hex
+            if pattern is None:
+                html_template, links = html, 0
+            else:
+                html_template, links = pattern.subn(
+                    lambda m: f"/api/attachment/{token}/{cids[m.group(1)]}", html
+                )
+            self.html_parts = html_template.split(token)
+            self.json_parts = json.dumps(
+                self.fill(html_template, token), ensure_ascii=False
+            ).split(token)
+            # the token occurs nowhere in the message itself (practically
+            # always true, but cheap to check)
+            if (
+                len(self.html_parts) == links + 1
+                and len(self.json_parts) == links + len(details) + 1
+            ):
+                break
+
+    def fill(self, htmlbody: str, mailbox: str) -> dict:
+        parsed = self.savedata["parsed"]
+        prefix = f"{self.base_url}/api/attachment/{mailbox}/"
+        return dict(
+            self.savedata,
+            parsed=dict(
+                parsed,
+                htmlbody=htmlbody,
+                attachments_details=[
+                    dict(details, download_url=prefix + details["id"])
+                    for details in parsed["attachments_details"]
+                ],
+            ),
+        )
+
+    def for_mailbox(self, email: str) -> dict:
+        """The savedata of the copy delivered to email."""
+        return self.fill(email.join(self.html_parts), email)
+
+    def render(self, email: str) -> bytes:
+        """for_mailbox(email) serialized as JSON."""
+        return json_escape(email).join(self.json_parts).encode("utf-8")
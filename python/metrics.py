@@ -0,0 +1,416 @@
+import abc
+import asyncio
+import bisect
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(1024 * 4**i for i in range(10))  # 1 KiB .. 256 MiB
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 500)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(abc.ABC):
+    """
+    Base of the Prometheus-style metrics below. Labelled children are
+    created on first use and kept, so the hot path is a dict lookup plus an
+    addition. Nothing is locked unless the metric is created with
+    threaded=True: metrics updated from another thread than the event loop
+    (the group commit and watchdog threads) need it, and must not be
+    labelled, since creating children isn't locked either.
+    """
+
+    kind = ""
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: tuple = (), threaded: bool = False
+    ) -> None:
+        if threaded and labelnames:
+            raise ValueError(f"{name}: threaded metrics cannot have labels")
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.threaded = threaded
+        self.children: dict[tuple, object] = {}
+        if not self.labelnames:
+            self.labels()
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self.children[values] = self.new_child()
+        return child
+
+    @abc.abstractmethod
+    def new_child(self):
+        """A child for one combination of label values."""
+
+    def expose(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for values, child in list(self.children.items()):
+            lines.extend(self.expose_child(values, child))
+        return lines
+
+    def expose_child(self, values: tuple, child) -> list[str]:
+        return [f"{self.name}{format_labels(self.labelnames, values)} {format_value(child.value)}"]
+
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class LockedCounterChild(CounterChild):
+    __slots__ = ("lock",)
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self) -> CounterChild:
+        return LockedCounterChild() if self.threaded else CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class GaugeChild:
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set_function(self, function) -> None:
+        """Read the value from function() whenever the metrics are scraped."""
+        self.function = function
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set_function(self, function) -> None:
+        self.labels().set_function(function)
+
+    def expose_child(self, values: tuple, child: GaugeChild) -> list[str]:
+        value = child.value
+        if child.function is not None:
+            try:
+                value = child.function()
+            except Exception as e:
+                logger.debug("Cannot collect %s: %s", self.name, e)
+                return []
+        return [f"{self.name}{format_labels(self.labelnames, values)} {format_value(value)}"]
+
+
+class HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> tuple[list[int], float, int]:
+        return list(self.counts), self.sum, self.count
+
+    def time(self) -> "Timer":
+        return Timer(self)
+
+
+class LockedHistogramChild(HistogramChild):
+    __slots__ = ("lock",)
+
+    def __init__(self, buckets: tuple) -> None:
+        super().__init__(buckets)
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self.lock:
+            super().observe(value)
+
+    def snapshot(self) -> tuple[list[int], float, int]:
+        # the counts, sum and count of the same observations
+        with self.lock:
+            return super().snapshot()
+
+
+class Timer:
+    """Context manager observing the elapsed wall time in seconds."""
+
+    __slots__ = ("child", "start")
+
+    def __init__(self, child: HistogramChild) -> None:
+        self.child = child
+
+    def __enter__(self) -> "Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple = (),
+        buckets: tuple = DURATION_BUCKETS,
+        threaded: bool = False,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, threaded)
+
+    def new_child(self) -> HistogramChild:
+        if self.threaded:
+            return LockedHistogramChild(self.buckets)
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> Timer:
+        return self.labels().time()
+
+    def expose_child(self, values: tuple, child: HistogramChild) -> list[str]:
+        lines = []
+        counts, total, count = child.snapshot()
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket
+            labels = format_labels(self.labelnames, values, f'le="{format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+REGISTRY: list[Metric] = []
+
+
+def render() -> str:
+    """All registered metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+# SMTP
+SMTP_SESSIONS = Counter("opentrashmail_smtp_sessions_total", "SMTP connections accepted")
+SMTP_SESSIONS_ACTIVE = Gauge("opentrashmail_smtp_sessions_active", "Open SMTP connections")
+RCPT_REJECTED = Counter(
+    "opentrashmail_rcpt_rejected_total",
+    "Recipients rejected at RCPT TO",
+    ("reason",),
+)
+MESSAGES = Counter(
+    "opentrashmail_messages_total",
+    "Messages received, by outcome",
+    ("result",),
+)
+MESSAGE_SIZE = Histogram(
+    "opentrashmail_message_size_bytes",
+    "Size of received messages",
+    buckets=SIZE_BUCKETS,
+)
+
+# admission control
+ADMISSION_REJECTED = Counter(
+    "opentrashmail_admission_rejected_total",
+    "SMTP commands refused by admission control or rate limits",
+    ("reason",),
+)
+ADMISSION_DATA_ACTIVE = Gauge(
+    "opentrashmail_admission_data_active",
+    "Messages being received or processed (MAX_CONCURRENT_DATA)",
+)
+ADMISSION_BYTES_IN_FLIGHT = Gauge(
+    "opentrashmail_admission_inflight_bytes",
+    "Bytes of messages held in memory (MAX_INFLIGHT_BYTES)",
+)
+ADMISSION_LIMIT = Gauge(
+    "opentrashmail_admission_limit",
+    "Configured admission limits (0 = unlimited)",
+    ("limit",),
+)
+RATE_LIMIT_KEYS = Gauge(
+    "opentrashmail_rate_limit_keys",
+    "Client IPs / recipient domains tracked by the rate limiters, and those out of tokens",
+    ("kind", "state"),
+)
+
+# ingest stages
+PARSE_SECONDS = Histogram(
+    "opentrashmail_parse_seconds",
+    "Time to parse a message (including executor queueing)",
+)
+STORE_SECONDS = Histogram(
+    "opentrashmail_store_seconds",
+    "Time to write a message to all recipient mailboxes",
+)
+COMMIT_BATCH = Histogram(
+    "opentrashmail_commit_batch_messages",
+    "Messages flushed to disk together (FSYNC=batch)",
+    buckets=COUNT_BUCKETS,
+    threaded=True,
+)
+COMMIT_SECONDS = Histogram(
+    "opentrashmail_commit_seconds",
+    "Time to fsync and rename one batch of messages (FSYNC=batch)",
+    threaded=True,
+)
+FANOUT = Histogram(
+    "opentrashmail_recipients_stored",
+    "Mailboxes a message was stored in",
+    buckets=COUNT_BUCKETS,
+)
+
+SLOW_CALLBACKS = Counter(
+    "opentrashmail_slow_callbacks_total",
+    "Event loop callbacks that blocked the loop longer than SLOW_CALLBACK_MS",
+    threaded=True,
+)
+
+# webhooks
+WEBHOOK_SECONDS = Histogram(
+    "opentrashmail_webhook_seconds",
+    "Duration of webhook POST requests",
+    ("kind",),
+)
+WEBHOOK_REQUESTS = Counter(
+    "opentrashmail_webhook_requests_total",
+    "Webhook POST requests, by result",
+    ("kind", "result"),
+)
+WEBHOOK_RETRIES = Counter(
+    "opentrashmail_webhook_retries_total",
+    "Webhook deliveries scheduled for another attempt",
+)
+WEBHOOK_FAILURES = Counter(
+    "opentrashmail_webhook_failures_total",
+    "Webhook deliveries given up after their last attempt",
+)
+WEBHOOK_BATCH_SIZE = Histogram(
+    "opentrashmail_webhook_batch_size",
+    "Webhooks sent together in one batched request",
+    buckets=COUNT_BUCKETS,
+)
+WEBHOOK_PARKED = Counter(
+    "opentrashmail_webhook_parked_total",
+    "Webhook jobs put aside because their host was down (open, probe) or busy",
+    ("reason",),
+)
+WEBHOOK_JOBS_PARKED = Gauge(
+    "opentrashmail_webhook_jobs_parked", "Webhook jobs waiting for their host"
+)
+WEBHOOK_CIRCUITS = Gauge(
+    "opentrashmail_webhook_circuits",
+    "Webhook hosts by circuit breaker state",
+    ("state",),
+)
+WEBHOOK_CIRCUIT_OPENED = Counter(
+    "opentrashmail_webhook_circuit_opened_total",
+    "Times the circuit of a webhook host opened",
+)
+WEBHOOK_CONFIG_CACHE = Gauge(
+    "opentrashmail_webhook_config_cache",
+    "Webhook config cache statistics",
+    ("stat",),
+)
+
+# new-mail event stream
+EVENT_SUBSCRIBERS = Gauge(
+    "opentrashmail_event_subscribers", "Open connections to the event stream"
+)
+EVENTS_DROPPED = Counter(
+    "opentrashmail_events_dropped_total",
+    "Events not sent because a subscriber's queue was full",
+)
+
+# event loop
+LOOP_LAG = Histogram(
+    "opentrashmail_event_loop_lag_seconds",
+    "How late the event loop ran a timer scheduled at a fixed interval",
+)
+
+
+async def measure_loop_lag(interval: float = 0.5) -> None:
+    """Background task feeding LOOP_LAG."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - expected))
@@ -0,0 +1,285 @@
+"""
+On-demand profiling of a running mailserver process (PROFILING and
+SLOW_CALLBACK_MS in [MAILSERVER]).
+
+- Task dump: the stack of every asyncio task, logged and written to
+  PROFILE_DIR (SIGUSR1, or GET /debug/tasks next to the metrics).
+- CPU profile for N seconds (SIGUSR2 starts and stops one, or GET
+  /debug/profile?seconds=N&format=...): either the stacks of all threads
+  sampled every few milliseconds, written as collapsed stacks for
+  flamegraph.pl or speedscope, or cProfile of the event loop thread,
+  written as pstats.
+- Memory: GET /debug/tracemalloc starts tracemalloc, every further call
+  writes the difference to the previous snapshot (?stop=1 stops tracing).
+- Slow callback watchdog (SLOW_CALLBACK_MS): a thread logs the stack of the
+  event loop thread whenever one callback holds the loop longer than that.
+
+Nothing here is set up unless it is enabled, so disabled it costs nothing.
+Everything but the sampler and the watchdog threads runs on the event loop
+thread.
+"""
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL = 0.005
+TRACEMALLOC_FRAMES = 25
+TRACEMALLOC_TOP = 30
+FORMATS = ("collapsed", "pstats")
+
+
+class ProfilingError(Exception):
+    pass
+
+
+def format_tasks() -> str:
+    """The stacks of all asyncio tasks of the running loop."""
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+    out = io.StringIO()
+    out.write(f"{len(tasks)} task(s)\n")
+    for task in tasks:
+        out.write("\n")
+        task.print_stack(file=out)
+    return out.getvalue()
+
+
+def dump_tasks(directory: str) -> str:
+    """Log format_tasks() and write it to a file in directory. Returns the dump."""
+    dump = format_tasks()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"tasks-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+    with open(path, "w") as f:
+        f.write(dump)
+    logger.info("asyncio tasks (also written to %s):\n%s", path, dump.rstrip())
+    return dump
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Sampler:
+    """Counts the stacks of all threads, sampled from a thread of its own."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self) -> None:
+        me = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    """One CPU profile at a time, written to directory when it ends."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.profile: Sampler | cProfile.Profile | None = None
+        self.path = ""
+        self.timer: asyncio.TimerHandle | None = None
+        # resolved with the path once the running profile is written
+        self.finished: asyncio.Future | None = None
+
+    @property
+    def running(self) -> bool:
+        return self.profile is not None
+
+    def start(self, seconds: float, output: str = "collapsed") -> str:
+        """Start a profile that ends after seconds. Returns the file it goes to."""
+        if self.running:
+            raise ProfilingError(f"A profile is already running, it goes to {self.path}")
+        if output not in FORMATS:
+            raise ProfilingError(f"format must be one of {', '.join(FORMATS)}")
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(
+            self.directory,
+            f"cpu-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.{output}",
+        )
+        if output == "pstats":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            self.profile = Sampler()
+            self.profile.start()
+        loop = asyncio.get_running_loop()
+        self.timer = loop.call_later(seconds, self.stop)
+        self.finished = loop.create_future()
+        logger.info("CPU profile started for %g seconds, writing to %s", seconds, self.path)
+        return self.path
+
+    def stop(self) -> str | None:
+        """End the running profile and write it. Returns its file."""
+        if self.profile is None:
+            return None
+        profile, self.profile = self.profile, None
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if isinstance(profile, Sampler):
+            profile.stop()
+            profile.write(self.path)
+            logger.info("CPU profile written to %s (%d samples)", self.path, profile.samples)
+        else:
+            profile.disable()
+            profile.dump_stats(self.path)
+            logger.info("CPU profile written to %s", self.path)
+        self.finished.set_result(self.path)
+        return self.path
+
+    def toggle(self, seconds: float) -> None:
+        """Start a profile, or end the running one early (SIGUSR2)."""
+        if self.running:
+            self.stop()
+        else:
+            self.start(seconds)
+
+
+class MemoryTracker:
+    """tracemalloc snapshots, each compared to the one before."""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.previous: tracemalloc.Snapshot | None = None
+
+    def take_snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ))
+
+    def snapshot(self) -> str:
+        """
+        Start tracing, or compare a new snapshot to the previous one and write
+        the difference to directory. Returns the report. Blocks while the
+        snapshot is taken, so run it in a thread.
+        """
+        if self.previous is None or not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.previous = self.take_snapshot()
+            logger.info("tracemalloc started")
+            return "tracemalloc started, the next snapshot shows what changed since now\n"
+
+        snapshot = self.take_snapshot()
+        stats = snapshot.compare_to(self.previous, "lineno")
+        self.previous = snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"traced memory: {current / 1e6:.1f} MB (peak {peak / 1e6:.1f} MB)",
+            f"top {TRACEMALLOC_TOP} changes since the previous snapshot:",
+            *map(str, stats[:TRACEMALLOC_TOP]),
+        ]
+        report = "\n".join(lines) + "\n"
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(
+            self.directory, f"memory-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+        )
+        with open(path, "w") as f:
+            f.write(report)
+        logger.info("tracemalloc snapshot diff written to %s", path)
+        return report
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.previous = None
+        logger.info("tracemalloc stopped")
+
+
+class SlowCallbackWatchdog:
+    """
+    Logs what the event loop thread is doing when it hasn't run the
+    heartbeat callback for threshold seconds, i.e. one callback (or
+    coroutine step) has been holding the loop that long, and how long it
+    was blocked once it is back.
+    """
+
+    def __init__(self, threshold: float) -> None:
+        self.threshold = threshold
+        self.interval = max(0.01, threshold / 4)
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_thread = 0
+        self.beat = 0.0
+        self.handle: asyncio.TimerHandle | None = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="watchdog", daemon=True)
+
+    def start(self) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.heartbeat()
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.handle is not None:
+            self.handle.cancel()
+        self.thread.join()
+
+    def heartbeat(self) -> None:
+        self.beat = time.monotonic()
+        self.handle = self.loop.call_later(self.interval, self.heartbeat)
+
+    def run(self) -> None:
+        blocked_at = None
+        while not self.stopped.wait(self.interval):
+            beat = self.beat
+            if blocked_at is not None:
+                if beat != blocked_at:
+                    logger.warning(
+                        "Event loop was blocked for %.3f seconds",
+                        beat - blocked_at - self.interval,
+                    )
+                    blocked_at = None
+                continue
+            if time.monotonic() - beat - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            blocked_at = beat
+            metrics.SLOW_CALLBACKS.inc()
+            logger.warning(
+                "Event loop blocked for more than %.3f seconds in:\n%s",
+                self.threshold,
+                "".join(traceback.format_stack(frame)).rstrip(),
+            )
@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""
+Retention: delete expired messages and mailboxes.
+
+Expiries are kept in a time-bucketed index in data/_expiry: one append-only
+file per minute (``<minute>.txt``) listing what expires in that minute:
+
+    m<TAB><mailbox><TAB><message id>    a message (DELETE_OLDER_THAN_DAYS)
+    b<TAB><mailbox>                     a whole mailbox (MAILBOX_MAX_AGE_MINUTES)
+
+The mailserver appends to the index when it stores a message, the web UI when
+it creates an empty mailbox. A run only reads the buckets that are due, so
+its cost depends on the number of expired items, not on the size of data/.
+
+A mailbox expires MAILBOX_MAX_AGE_MINUTES after its last change (the
+directory's mtime, as shown by the web UI). Mailbox entries are checked
+against that when they are due and moved to a later bucket if the mailbox
+changed in the meantime. Message entries are checked against the current
+DELETE_OLDER_THAN_DAYS the same way, and everything stored is registered
+again whenever one of the ages changes (they are kept in data/_expiry/.indexed).
+
+With STORAGE=sqlite there is no bucket index: expired messages and
+mailboxes are found by indexed queries on the database (see storage.py).
+
+Run it from cron (``retention.py``) or as a service (``--interval 60``).
+"""
+import argparse
+import configparser
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+
+import compress
+import search
+from storage import SqliteStorage
+
+logger = logging.getLogger("retention")
+
+BUCKET_SECONDS = 60
+EXPIRY_DIR = "_expiry"
+RAW_STORE = "_raw"
+ATTACHMENT_STORE = "_attachments"
+MAILBOX_INDEX = "index.jsonl"
+
+# blobs younger than this may be about to be linked by an ingest in progress
+BLOB_GRACE_SECONDS = 60
+
+
+def parse_age(value, unit: int) -> int:
+    """Config value (false/empty/0 = never) in units -> seconds."""
+    if value is None:
+        return 0
+    value = str(value).strip().strip('"').lower()
+    if value in ("", "false", "no", "off", "never", "0"):
+        return 0
+    return int(float(value) * unit)
+
+
+def is_mailbox_name(name: str) -> bool:
+    return bool(name) and "@" in name and "/" not in name and not name.startswith((".", "_"))
+
+
+class ExpiryIndex:
+    def __init__(self, data_dir: str) -> None:
+        self.dir = os.path.join(data_dir, EXPIRY_DIR)
+
+    def bucket_path(self, bucket: int) -> str:
+        return os.path.join(self.dir, f"{bucket}.txt")
+
+    def add(self, expire_at: float, lines: list[str]) -> None:
+        """
+        Append entries to the bucket of expire_at. One O_APPEND write per
+        call, so concurrent writers (workers, PHP) don't interleave lines.
+        """
+        if not lines:
+            return
+        os.makedirs(self.dir, mode=0o770, exist_ok=True)
+        fd = os.open(
+            self.bucket_path(int(expire_at // BUCKET_SECONDS)),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+            0o660,
+        )
+        try:
+            os.write(fd, "".join(line + "\n" for line in lines).encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    def due_buckets(self, now: float) -> list[int]:
+        """Buckets whose minute has completely passed, oldest first."""
+        current = int(now // BUCKET_SECONDS)
+        buckets = []
+        for entry in os.listdir(self.dir):
+            name, ext = os.path.splitext(entry)
+            if ext == ".txt" and name.isdigit() and int(name) < current:
+                buckets.append(int(name))
+        return sorted(buckets)
+
+
+def register_message(
+    data_dir: str,
+    mailboxes: list[str],
+    message_id: str,
+    now: float,
+    message_max_age: int,
+    mailbox_max_age: int,
+) -> None:
+    """Record the expiries of a message just stored in these mailboxes."""
+    index = ExpiryIndex(data_dir)
+    if message_max_age:
+        index.add(
+            now + message_max_age,
+            [f"m\t{mailbox}\t{message_id}" for mailbox in mailboxes],
+        )
+    if mailbox_max_age:
+        index.add(now + mailbox_max_age, [f"b\t{mailbox}" for mailbox in mailboxes])
+
+
+def remove_index_entries(email_dir: str, message_ids: set[str]) -> None:
+    """Drop messages from a mailbox's index.jsonl (same locking as the writers)."""
+    path = os.path.join(email_dir, MAILBOX_INDEX)
+    try:
+        f = open(path, "r+", encoding="utf-8")
+    except FileNotFoundError:
+        return
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        kept = []
+        for line in f:
+            try:
+                entry_id = str(json.loads(line).get("id"))
+            except (ValueError, AttributeError):
+                continue
+            if entry_id not in message_ids:
+                kept.append(line)
+        f.seek(0)
+        f.truncate()
+        f.writelines(kept)
+
+
+class Retention:
+    """One retention pass over the due expiry buckets (see module docstring)."""
+
+    def __init__(
+        self,
+        data_dir: str,
+        message_max_age: int,
+        mailbox_max_age: int,
+        batch_size: int = 500,
+        batch_pause: float = 0.05,
+        max_batches: int = 0,
+        sweep_interval: int = 3600,
+    ) -> None:
+        self.data_dir = data_dir
+        self.index = ExpiryIndex(data_dir)
+        self.message_max_age = message_max_age
+        self.mailbox_max_age = mailbox_max_age
+        self.batch_size = max(1, batch_size)
+        self.batch_pause = batch_pause
+        self.max_batches = max_batches
+        self.sweep_interval = sweep_interval
+        self.batches = 0
+        # the search index, if SEARCH_INDEX has created one
+        self.search = (
+            search.SearchIndex(data_dir)
+            if os.path.exists(search.database_path(data_dir))
+            else None
+        )
+        self.stats = {
+            "messages": 0,
+            "mailboxes": 0,
+            "blobs": 0,
+            "bytes": 0,
+            "rescheduled": 0,
+        }
+
+    # ---- driving -------------------------------------------------------
+
+    def run_once(self, now: float | None = None) -> dict | None:
+        """Process everything that is due. Returns the stats, or None if
+        another run holds the lock."""
+        now = time.time() if now is None else now
+        os.makedirs(self.index.dir, mode=0o770, exist_ok=True)
+
+        with open(os.path.join(self.index.dir, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info("Another retention run is in progress")
+                return None
+
+            self.expire_due(now)
+            if self.search is not None:
+                self.prune_search(now)
+
+            if self.sweep_interval and self.sweep_due(now):
+                self.sweep_blobs(now)
+
+        return self.stats
+
+    def expire_due(self, now: float) -> None:
+        indexed_marker = os.path.join(self.index.dir, ".indexed")
+        ages = f"{self.message_max_age} {self.mailbox_max_age}\n"
+        try:
+            with open(indexed_marker, "r", encoding="utf-8") as f:
+                indexed = f.read()
+        except FileNotFoundError:
+            indexed = None
+        if indexed != ages:
+            self.reindex(now)
+            tmp_path = indexed_marker + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(ages)
+            os.replace(tmp_path, indexed_marker)
+
+        for bucket in self.index.due_buckets(now):
+            if not self.process_bucket(bucket, now):
+                break
+
+    def prune_search(self, now: float) -> None:
+        """
+        Drop expired messages from the search index (expired mailboxes are
+        dropped as they are deleted) and do some segment merging.
+        """
+        if self.message_max_age:
+            removed = self.search.delete_older_than(now - self.message_max_age)
+            if removed:
+                logger.info("Removed %d expired message(s) from the search index", removed)
+        self.search.merge()
+
+    def forget_mailboxes(self, mailboxes: list[str]) -> None:
+        if self.search is not None:
+            self.search.delete_mailboxes(mailboxes)
+
+    def batch_budget_left(self) -> bool:
+        return not self.max_batches or self.batches < self.max_batches
+
+    def process_bucket(self, bucket: int, now: float) -> bool:
+        """
+        Handle one bucket in batches of batch_size entries. Returns False if
+        the batch budget ran out; the rest of the bucket is written back and
+        handled by the next run.
+        """
+        path = self.index.bucket_path(bucket)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = list(dict.fromkeys(line.rstrip("\n") for line in f if line.strip()))
+        except FileNotFoundError:
+            return True
+
+        for start in range(0, len(entries), self.batch_size):
+            if not self.batch_budget_left():
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.writelines(entry + "\n" for entry in entries[start:])
+                os.replace(tmp_path, path)
+                return False
+            if self.batches and self.batch_pause:
+                time.sleep(self.batch_pause)
+            self.process_batch(entries[start:start + self.batch_size], now)
+            self.batches += 1
+
+        os.remove(path)
+        return True
+
+    def process_batch(self, entries: list[str], now: float) -> None:
+        messages: dict[str, set[str]] = {}
+        for entry in entries:
+            fields = entry.split("\t")
+            if fields[0] == "m" and len(fields) == 3 and is_mailbox_name(fields[1]):
+                messages.setdefault(fields[1], set()).add(fields[2])
+            elif fields[0] == "b" and len(fields) == 2 and is_mailbox_name(fields[1]):
+                self.expire_mailbox(fields[1], now)
+            else:
+                logger.warning("Ignoring malformed expiry entry: %r", entry)
+
+        for mailbox, message_ids in messages.items():
+            self.expire_messages(mailbox, message_ids, now)
+
+    # ---- deleting ------------------------------------------------------
+
+    def release_blob(self, link_path: str, blob_path: str | None) -> None:
+        """
+        Remove one mailbox link to a content-addressed blob, and the blob
+        itself if that was its last reference.
+        """
+        try:
+            st = os.stat(link_path)
+            os.remove(link_path)
+        except FileNotFoundError:
+            return
+        if st.st_nlink == 1:
+            self.stats["bytes"] += st.st_size
+
+        if blob_path is None or st.st_nlink != 2:
+            return
+        try:
+            blob = os.stat(blob_path)
+        except FileNotFoundError:
+            return
+        if (
+            blob.st_ino == st.st_ino
+            and blob.st_nlink == 1
+            and time.time() - blob.st_mtime > BLOB_GRACE_SECONDS
+        ):
+            os.remove(blob_path)
+            self.stats["blobs"] += 1
+            self.stats["bytes"] += blob.st_size
+
+    def delete_message_files(self, email_dir: str, message_id: str) -> bool:
+        json_path = os.path.join(email_dir, f"{message_id}.json")
+        try:
+            savedata = json.loads(compress.read_file(json_path))
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError):
+            savedata = {}
+
+        parsed = savedata.get("parsed") or {}
+        for details in parsed.get("attachments_details") or []:
+            file_id = os.path.basename(str(details.get("id", "")))
+            if not file_id:
+                continue
+            digest = details.get("sha256")
+            self.release_blob(
+                os.path.join(email_dir, "attachments", file_id),
+                os.path.join(self.data_dir, ATTACHMENT_STORE, digest) if digest else None,
+            )
+
+        raw_ref = savedata.get("raw_ref")
+        self.release_blob(
+            os.path.join(email_dir, f"{message_id}.eml"),
+            os.path.join(self.data_dir, RAW_STORE, f"{raw_ref}.eml") if raw_ref else None,
+        )
+
+        self.stats["bytes"] += os.path.getsize(json_path)
+        os.remove(json_path)
+        return True
+
+    def expire_messages(self, mailbox: str, message_ids: set[str], now: float) -> None:
+        if not self.message_max_age:
+            return
+        email_dir = os.path.join(self.data_dir, mailbox)
+        if not os.path.isdir(email_dir):
+            return
+
+        deleted = set()
+        for message_id in message_ids:
+            if not message_id.isdigit():
+                continue
+            # ids start with the time they were received at, in milliseconds
+            expires = int(message_id[:13]) / 1000 + self.message_max_age
+            if expires > now:
+                # DELETE_OLDER_THAN_DAYS was raised since this entry was written
+                self.index.add(expires, [f"m\t{mailbox}\t{message_id}"])
+                self.stats["rescheduled"] += 1
+            elif self.delete_message_files(email_dir, message_id):
+                deleted.add(message_id)
+        if deleted:
+            remove_index_entries(email_dir, deleted)
+            self.stats["messages"] += len(deleted)
+            logger.info("Deleted %d expired message(s) of %s", len(deleted), mailbox)
+
+    def expire_mailbox(self, mailbox: str, now: float) -> None:
+        if not self.mailbox_max_age:
+            return
+        email_dir = os.path.join(self.data_dir, mailbox)
+        try:
+            changed = os.stat(email_dir).st_mtime
+        except FileNotFoundError:
+            return
+
+        expires = changed + self.mailbox_max_age
+        if expires > now:
+            # changed since this entry was written: check again later
+            self.index.add(expires, [f"b\t{mailbox}"])
+            self.stats["rescheduled"] += 1
+            return
+
+        count = 0
+        for entry in os.listdir(email_dir):
+            if entry.endswith(".json") and entry[:-5].isdigit():
+                if self.delete_message_files(email_dir, entry[:-5]):
+                    count += 1
+
+        for root, dirs, files in os.walk(email_dir):
+            for name in files:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                if st.st_nlink == 1:
+                    self.stats["bytes"] += st.st_size
+        shutil.rmtree(email_dir, ignore_errors=True)
+        self.forget_mailboxes([mailbox])
+
+        self.stats["messages"] += count
+        self.stats["mailboxes"] += 1
+        logger.info("Deleted expired mailbox %s (%d message(s))", mailbox, count)
+
+    # ---- maintenance ---------------------------------------------------
+
+    def reindex(self, now: float) -> None:
+        """
+        Register everything that is already stored. Runs on the first run
+        after upgrading and whenever the ages differ from those in
+        data/_expiry/.indexed; entries of the old ages that become due
+        earlier are rescheduled or find nothing left to delete.
+        """
+        registered = 0
+        for mailbox in os.listdir(self.data_dir):
+            email_dir = os.path.join(self.data_dir, mailbox)
+            if not is_mailbox_name(mailbox) or not os.path.isdir(email_dir):
+                continue
+            if self.mailbox_max_age:
+                self.index.add(
+                    os.stat(email_dir).st_mtime + self.mailbox_max_age,
+                    [f"b\t{mailbox}"],
+                )
+            if self.message_max_age:
+                for entry in os.listdir(email_dir):
+                    if entry.endswith(".json") and entry[:-5].isdigit():
+                        received = os.stat(os.path.join(email_dir, entry)).st_mtime
+                        self.index.add(
+                            received + self.message_max_age,
+                            [f"m\t{mailbox}\t{entry[:-5]}"],
+                        )
+            registered += 1
+        logger.info("Built expiry index for %d existing mailbox(es)", registered)
+
+    def sweep_due(self, now: float) -> bool:
+        stamp = os.path.join(self.index.dir, ".last_sweep")
+        try:
+            if now - os.stat(stamp).st_mtime < self.sweep_interval:
+                return False
+        except FileNotFoundError:
+            pass
+        with open(stamp, "w"):
+            pass
+        return True
+
+    def sweep_blobs(self, now: float) -> None:
+        """
+        Remove blobs nobody links to any more, e.g. after messages were
+        deleted in the web UI. Full scan of the stores, so it only runs
+        every sweep_interval seconds.
+        """
+        for store in (RAW_STORE, ATTACHMENT_STORE):
+            store_dir = os.path.join(self.data_dir, store)
+            if not os.path.isdir(store_dir):
+                continue
+            with os.scandir(store_dir) as it:
+                for entry in it:
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    if st.st_nlink == 1 and now - st.st_mtime > BLOB_GRACE_SECONDS:
+                        os.remove(entry.path)
+                        self.stats["blobs"] += 1
+                        self.stats["bytes"] += st.st_size
+
+
+class SqliteRetention(Retention):
+    """
+    Retention for STORAGE=sqlite. Expired messages and mailboxes are selected
+    by indexed queries, a batch at a time; blobs are removed once no row
+    references them any more.
+    """
+
+    def __init__(
+        self, data_dir: str, message_max_age: int, mailbox_max_age: int, **kwargs
+    ) -> None:
+        super().__init__(data_dir, message_max_age, mailbox_max_age, **kwargs)
+        self.storage = SqliteStorage(data_dir)
+
+    def expire_due(self, now: float) -> None:
+        for max_age, select, delete in (
+            (self.mailbox_max_age, self.storage.expired_mailboxes, self.delete_mailboxes),
+            (self.message_max_age, self.storage.expired_messages, self.delete_messages),
+        ):
+            while max_age and self.batch_budget_left():
+                batch = select(now - max_age, self.batch_size)
+                if not batch:
+                    break
+                if self.batches and self.batch_pause:
+                    time.sleep(self.batch_pause)
+                delete(batch, now)
+                self.batches += 1
+
+    def delete_mailboxes(self, mailboxes: list[str], now: float) -> None:
+        deliveries, blobs = self.storage.delete_mailboxes(mailboxes)
+        for mailbox in mailboxes:
+            # webhook.json of the mailbox, if it has one
+            if is_mailbox_name(mailbox):
+                shutil.rmtree(os.path.join(self.data_dir, mailbox), ignore_errors=True)
+        self.forget_mailboxes(mailboxes)
+        self.release_blobs(blobs, now)
+        self.stats["messages"] += deliveries
+        self.stats["mailboxes"] += len(mailboxes)
+        logger.info("Deleted %d expired mailbox(es) (%d message(s))", len(mailboxes), deliveries)
+
+    def delete_messages(self, messages: list[int], now: float) -> None:
+        deliveries, blobs = self.storage.delete_messages(messages)
+        self.release_blobs(blobs, now)
+        self.stats["messages"] += deliveries
+        logger.info("Deleted %d expired message(s)", deliveries)
+
+    def release_blobs(self, blobs: set[tuple[str, str]], now: float) -> None:
+        for store, name in blobs:
+            if not self.storage.is_referenced(store, name):
+                self.remove_blob(os.path.join(self.data_dir, store, name), now)
+
+    def remove_blob(self, path: str, now: float) -> None:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        # still hardlinked into a mailbox of the file layout (before migrating)
+        if st.st_nlink == 1 and now - st.st_mtime > BLOB_GRACE_SECONDS:
+            os.remove(path)
+            self.stats["blobs"] += 1
+            self.stats["bytes"] += st.st_size
+
+    def sweep_blobs(self, now: float) -> None:
+        """Remove blobs no message references, e.g. after deletions in the web UI."""
+        for store in (RAW_STORE, ATTACHMENT_STORE):
+            store_dir = os.path.join(self.data_dir, store)
+            if not os.path.isdir(store_dir):
+                continue
+            with os.scandir(store_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith(".tmp") and not self.storage.is_referenced(
+                        store, entry.name
+                    ):
+                        self.remove_blob(entry.path, now)
+
+
+def load_config(path: str) -> configparser.ConfigParser:
+    config = configparser.ConfigParser(allow_no_value=True)
+    config.read(path)
+    return config
+
+
+def main() -> None:
+    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+    parser = argparse.ArgumentParser(description="Delete expired messages and mailboxes")
+    parser.add_argument("--config", default=os.path.join(base_dir, "config.ini"))
+    parser.add_argument("--data-dir", default=os.path.join(base_dir, "data"))
+    parser.add_argument(
+        "--interval", type=float, default=0, help="keep running, every N seconds"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] [Retention] %(levelname)s - %(message)s",
+        datefmt="%d-%b-%Y %H:%M:%S",
+    )
+
+    config = load_config(args.config)
+    message_max_age = parse_age(
+        config.get("CLEANUP", "DELETE_OLDER_THAN_DAYS", fallback="false"), 86400
+    )
+    mailbox_max_age = parse_age(
+        config.get("CLEANUP", "MAILBOX_MAX_AGE_MINUTES", fallback="false"), 60
+    )
+    batch_size = int(config.get("CLEANUP", "BATCH_SIZE", fallback="500") or 500)
+    max_batches = int(config.get("CLEANUP", "MAX_BATCHES", fallback="0") or 0)
+    storage = (config.get("GENERAL", "STORAGE", fallback="files") or "files").strip().lower()
+    retention_class = SqliteRetention if storage == "sqlite" else Retention
+
+    while True:
+        retention = retention_class(
+            os.path.abspath(args.data_dir),
+            message_max_age,
+            mailbox_max_age,
+            batch_size=batch_size,
+            max_batches=max_batches,
+        )
+        started = time.monotonic()
+        stats = retention.run_once()
+        if stats and (stats["messages"] or stats["mailboxes"] or stats["blobs"]):
+            logger.info(
+                "Removed %d message(s), %d mailbox(es), %d unreferenced blob(s), "
+                "%.1f MB in %.2fs",
+                stats["messages"],
+                stats["mailboxes"],
+                stats["blobs"],
+                stats["bytes"] / 1e6,
+                time.monotonic() - started,
+            )
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
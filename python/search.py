@@ -0,0 +1,163 @@
+"""
+Full-text search index (SEARCH_INDEX=true).
+
+Every stored copy of a message is added to an SQLite FTS5 index at ingest
+(data/_db/search.sqlite): subject, sender and text (plaintext body and the
+text of the HTML body). FTS5 writes each insert as a small segment and merges
+segments incrementally, so adding a message costs O(message), never a
+rebuild; the retention job does some extra merge work on every run.
+
+    documents  mailbox, message id and time of every indexed copy, for the
+               deletions by mailbox and by age
+    search     the FTS5 table, rowid = documents.id
+
+The web UI and API query it (src/Services/SearchIndex.php).
+"""
+import html.parser
+import os
+import sqlite3
+import threading
+import time
+
+DB_DIR = "_db"
+DB_FILE = "search.sqlite"
+
+# text indexed per message (beyond this a body is cut)
+MAX_TEXT = 65536
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id          INTEGER PRIMARY KEY,
+    mailbox     TEXT NOT NULL,
+    message_id  TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    UNIQUE (mailbox, message_id)
+);
+CREATE INDEX IF NOT EXISTS documents_received_at ON documents (received_at);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+    mailbox, subject, sender, body,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+
+def database_path(data_dir: str) -> str:
+    return os.path.join(data_dir, DB_DIR, DB_FILE)
+
+
+class TextExtractor(html.parser.HTMLParser):
+    """The visible text of an HTML body (without scripts and styles)."""
+
+    SKIP = {"script", "style", "head", "title"}
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.parts: list[str] = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs) -> None:
+        if tag in self.SKIP:
+            self.skipping += 1
+
+    def handle_endtag(self, tag) -> None:
+        if tag in self.SKIP and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data) -> None:
+        if not self.skipping:
+            self.parts.append(data)
+
+
+def html_text(content: str) -> str:
+    if not content:
+        return ""
+    parser = TextExtractor()
+    parser.feed(content)
+    parser.close()
+    return " ".join(" ".join(parser.parts).split())
+
+
+class SearchIndex:
+    """The search database; every thread gets its own connection."""
+
+    def __init__(self, data_dir: str, busy_timeout: float = 10.0) -> None:
+        self.path = database_path(data_dir)
+        self.busy_timeout = busy_timeout
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(self.path), mode=0o770, exist_ok=True)
+        with self.connection() as db:
+            if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                db.executescript(SCHEMA)
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def connection(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("PRAGMA synchronous = NORMAL")
+            self.local.db = db
+        return db
+
+    def add(
+        self,
+        mailboxes: list[str],
+        message_id: str,
+        subject: str,
+        sender: str,
+        plaintext: str,
+        htmlbody: str,
+        received_at: float | None = None,
+    ) -> None:
+        """Index a message for the given mailboxes (already indexed copies are skipped)."""
+        text = plaintext[:MAX_TEXT]
+        if htmlbody and len(text) < MAX_TEXT:
+            text = (text + "\n" + html_text(htmlbody))[:MAX_TEXT]
+        received_at = time.time() if received_at is None else received_at
+
+        db = self.connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            for mailbox in mailboxes:
+                cursor = db.execute(
+                    "INSERT OR IGNORE INTO documents (mailbox, message_id, received_at)"
+                    " VALUES (?, ?, ?)",
+                    (mailbox, message_id, received_at),
+                )
+                if cursor.rowcount:
+                    db.execute(
+                        "INSERT INTO search (rowid, mailbox, subject, sender, body)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (cursor.lastrowid, mailbox, subject, sender, text),
+                    )
+
+    def delete_documents(self, db: sqlite3.Connection, where: str, params: tuple) -> int:
+        ids = [row[0] for row in db.execute(f"SELECT id FROM documents WHERE {where}", params)]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            marks = ",".join("?" * len(chunk))
+            db.execute(f"DELETE FROM search WHERE rowid IN ({marks})", chunk)
+            db.execute(f"DELETE FROM documents WHERE id IN ({marks})", chunk)
+        return len(ids)
+
+    def delete_mailboxes(self, mailboxes: list[str]) -> int:
+        db = self.connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            return sum(
+                self.delete_documents(db, "mailbox = ?", (mailbox,)) for mailbox in mailboxes
+            )
+
+    def delete_older_than(self, cutoff: float) -> int:
+        db = self.connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            return self.delete_documents(db, "received_at < ?", (cutoff,))
+
+    def merge(self, pages: int = 500) -> None:
+        """Do some incremental segment merging (about pages pages of work)."""
+        db = self.connection()
+        with db:
+            db.execute("INSERT INTO search (search, rank) VALUES ('merge', ?)", (pages,))
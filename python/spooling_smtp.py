@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import uuid
+
+from aiosmtpd.smtp import MISSING, SMTP, Envelope, syntax
+
+import metrics
+from admission import IP_RATE_EXCEEDED, Admission, declared_size
+
+logger = logging.getLogger(__name__)
+
+
+class SpooledEnvelope(Envelope):
+    """
+    Envelope whose content may live on disk.
+
+    If the message was larger than the spool threshold, ``content`` is None
+    and ``spool_path`` names the file holding the (de-dot-stuffed) message.
+    ``content_sha256`` and ``content_size`` are computed while receiving, so
+    nobody has to read a spooled message again just to hash it.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.spool_path: str | None = None
+        self.content_sha256: str | None = None
+        self.content_size: int = 0
+
+
+class SpoolingSMTP(SMTP):
+    """
+    SMTP server that writes DATA to a file once it grows past spool_threshold
+    bytes instead of collecting every line in memory, and applies the limits
+    of admission (see admission.py) to MAIL FROM and DATA.
+
+    Mirrors aiosmtpd's SMTP.smtp_DATA (size limit, line length limit, dot
+    un-stuffing and status handling); with spool_threshold=0 and no
+    admission control the stock implementation is used.
+    """
+
+    def __init__(
+        self,
+        handler,
+        *args,
+        spool_threshold: int = 0,
+        spool_dir: str = "",
+        admission: Admission | None = None,
+        **kwargs,
+    ):
+        super().__init__(handler, *args, **kwargs)
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.admission = admission
+        # bytes of the current message accounted in admission
+        self.held = 0
+
+    def _create_envelope(self) -> SpooledEnvelope:
+        return SpooledEnvelope()
+
+    def connection_made(self, transport) -> None:
+        metrics.SMTP_SESSIONS.inc()
+        metrics.SMTP_SESSIONS_ACTIVE.inc()
+        super().connection_made(transport)
+
+    def connection_lost(self, exc) -> None:
+        metrics.SMTP_SESSIONS_ACTIVE.dec()
+        super().connection_lost(exc)
+
+    @syntax("MAIL FROM: <address>", extended=" [SP <mail-parameters>]")
+    async def smtp_MAIL(self, arg: str | None) -> None:
+        if self.admission is not None and not self.admission.allow_ip(self.session.peer[0]):
+            logger.info("%r is over IP_RATE_LIMIT, disconnecting", self.session.peer)
+            await self.push(IP_RATE_EXCEEDED)
+            self.transport.close()
+            return
+        await super().smtp_MAIL(arg)
+
+    @syntax("DATA")
+    async def smtp_DATA(self, arg: str) -> None:
+        if not self.spool_threshold and self.admission is None:
+            return await super().smtp_DATA(arg)
+
+        if await self.check_helo_needed():
+            return
+        if await self.check_auth_needed("DATA"):
+            return
+        assert self.envelope is not None
+        if not self.envelope.rcpt_tos:
+            await self.push("503 Error: need RCPT command")
+            return
+        if arg:
+            await self.push("501 Syntax: DATA")
+            return
+
+        if self.admission is None:
+            return await self.receive_data()
+
+        expected = declared_size(self.envelope.mail_options)
+        if self.spool_threshold:
+            expected = min(expected, self.spool_threshold)
+        status = self.admission.start_data(expected)
+        if status is not None:
+            logger.info("%r refused DATA: %s", self.session.peer, status)
+            await self.push(status)
+            return
+        self.held = 0
+        try:
+            await self.receive_data()
+        finally:
+            self.admission.end_data(self.held)
+            self.held = 0
+
+    def hold(self, size: int) -> str | None:
+        """Account size bytes kept in memory; the status to refuse the message with if too many."""
+        if self.admission is None:
+            return None
+        self.held += size
+        return self.admission.hold(size, self.held)
+
+    def release_held(self) -> None:
+        if self.admission is not None:
+            self.admission.release(self.held)
+            self.held = 0
+
+    async def receive_data(self) -> None:
+        await self.push("354 End data with <CR><LF>.<CR><LF>")
+
+        buffer = io.BytesIO()
+        spool_file = None
+        spool_path = None
+        digest = hashlib.sha256()
+        size = 0
+        num_bytes = 0
+        limit = self.data_size_limit
+        line_fragments: list[bytes] = []
+        error = None
+
+        try:
+            while self.transport is not None:
+                try:
+                    line = await self._reader.readuntil(b"\r\n")
+                except asyncio.CancelledError:
+                    logger.info("Connection lost during DATA")
+                    self._writer.close()
+                    raise
+                except asyncio.LimitOverrunError as e:
+                    error = error or "500 Line too long (see RFC5321 4.5.3.1.6)"
+                    line = await self._reader.read(e.consumed)
+
+                if not line_fragments and line == b".\r\n":
+                    break
+
+                num_bytes += len(line)
+                if error is None and limit and num_bytes > limit:
+                    error = "552 Error: Too much mail data"
+
+                line_fragments.append(line)
+                if not line.endswith(b"\r\n"):
+                    continue
+
+                line = b"".join(line_fragments)
+                line_fragments = []
+                if error is not None:
+                    continue
+                if len(line) > self.line_length_limit:
+                    error = "500 Line too long (see RFC5321 4.5.3.1.6)"
+                    continue
+
+                if line.startswith(b"."):
+                    line = line[1:]
+                digest.update(line)
+                size += len(line)
+
+                if spool_file is None and self.spool_threshold and size > self.spool_threshold:
+                    spool_path = os.path.join(self.spool_dir, f"{uuid.uuid4().hex}.eml")
+                    spool_file = open(spool_path, "wb")
+                    spool_file.write(buffer.getbuffer())
+                    buffer = io.BytesIO()
+                    self.release_held()
+                if spool_file is not None:
+                    spool_file.write(line)
+                else:
+                    buffer.write(line)
+                    error = self.hold(len(line))
+                    if error is not None:
+                        logger.info("%r refused message: %s", self.session.peer, error)
+                        # read the rest without keeping it
+                        buffer = io.BytesIO()
+                        self.release_held()
+        except BaseException:
+            if spool_file is not None:
+                spool_file.close()
+                os.remove(spool_path)
+            raise
+
+        if spool_file is not None:
+            spool_file.close()
+
+        if error is not None:
+            if spool_path is not None:
+                os.remove(spool_path)
+            await self.push(error)
+            self._set_post_data_state()
+            return
+
+        envelope = self.envelope
+        envelope.content_sha256 = digest.hexdigest()
+        envelope.content_size = size
+        if spool_path is None:
+            envelope.content = envelope.original_content = buffer.getvalue()
+        else:
+            envelope.spool_path = spool_path
+        buffer = None
+
+        try:
+            status = await self._call_handler_hook("DATA")
+        finally:
+            # the handler moves the file into the raw store; drop it otherwise
+            if spool_path is not None and os.path.exists(spool_path):
+                os.remove(spool_path)
+
+        self._set_post_data_state()
+        await self.push("250 OK" if status is MISSING else status)
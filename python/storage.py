@@ -0,0 +1,341 @@
+"""
+SQLite storage backend (STORAGE=sqlite).
+
+Instead of one JSON file per message and recipient in data/<email>/, message
+metadata lives in one database in WAL mode (data/_db/opentrashmail.sqlite),
+so listing, counting and expiry are indexed queries:
+
+    mailboxes    one row per address, with the time of its last delivery
+    messages     one row per received message (shared by all recipients)
+    recipients   which mailboxes a message was delivered to
+    attachments  attachment metadata of a message
+
+Raw messages and attachments stay in the content-addressed stores (data/_raw,
+data/_attachments); a blob is in use as long as a row references it.
+Per-email webhook configs stay in data/<email>/webhook.json.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+DB_DIR = "_db"
+DB_FILE = "opentrashmail.sqlite"
+RAW_STORE = "_raw"
+ATTACHMENT_STORE = "_attachments"
+
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailboxes (
+    address    TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS mailboxes_updated_at ON mailboxes (updated_at);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id          INTEGER PRIMARY KEY,
+    message_id  TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    sender_ip   TEXT NOT NULL DEFAULT '',
+    rcpts       TEXT NOT NULL DEFAULT '[]',
+    raw_ref     TEXT NOT NULL,
+    size        INTEGER NOT NULL,
+    digest      TEXT NOT NULL,
+    from_addr   TEXT NOT NULL DEFAULT '',
+    subject     TEXT NOT NULL DEFAULT '',
+    body        TEXT NOT NULL DEFAULT '',
+    htmlbody    TEXT NOT NULL DEFAULT ''
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_key ON messages (message_id, raw_ref);
+CREATE INDEX IF NOT EXISTS messages_received_at ON messages (received_at);
+CREATE INDEX IF NOT EXISTS messages_raw_ref ON messages (raw_ref);
+
+CREATE TABLE IF NOT EXISTS recipients (
+    mailbox    TEXT NOT NULL REFERENCES mailboxes (address) ON DELETE CASCADE,
+    message_id TEXT NOT NULL,
+    message    INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    PRIMARY KEY (mailbox, message_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS recipients_message ON recipients (message);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    message  INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    file_id  TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    cid      TEXT,
+    size     INTEGER NOT NULL,
+    sha256   TEXT NOT NULL,
+    PRIMARY KEY (message, position)
+);
+CREATE INDEX IF NOT EXISTS attachments_file_id ON attachments (file_id);
+CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256);
+"""
+
+
+def mailbox_name(email: str) -> str:
+    """Mailbox key (and data/ directory name) of an email address."""
+    return re.sub(r"[^a-z0-9@\._\-]+", "_", email.lower())
+
+
+def database_path(data_dir: str) -> str:
+    return os.path.join(data_dir, DB_DIR, DB_FILE)
+
+
+class SqliteStorage:
+    """
+    Message metadata in SQLite. Every thread gets its own connection; WAL
+    lets the web UI read while the mailserver (and its worker processes)
+    write, and busy_timeout serialises concurrent writers.
+    """
+
+    name = "sqlite"
+
+    # FSYNC mode -> PRAGMA synchronous. With batch, commits only write the
+    # WAL and the group commit fsyncs it once per batch.
+    SYNCHRONOUS = {"none": "NORMAL", "batch": "NORMAL", "always": "FULL"}
+
+    def __init__(self, data_dir: str, busy_timeout: float = 10.0, fsync: str = "none") -> None:
+        self.data_dir = data_dir
+        self.path = database_path(data_dir)
+        self.busy_timeout = busy_timeout
+        self.synchronous = self.SYNCHRONOUS.get(fsync, "NORMAL")
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(self.path), mode=0o770, exist_ok=True)
+        with self.connection() as db:
+            if db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                db.executescript(SCHEMA)
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def connection(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.busy_timeout)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute(f"PRAGMA synchronous = {self.synchronous}")
+            db.execute("PRAGMA foreign_keys = ON")
+            self.local.db = db
+        return db
+
+    def close(self) -> None:
+        db = getattr(self.local, "db", None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    # ---- writing -------------------------------------------------------
+
+    def save(
+        self,
+        message_id: str,
+        parsed: dict,
+        stored: list[str],
+        message,
+        raw_ref: str,
+        content: bytes | None,
+        size: int,
+        digest: str,
+        batch,
+    ) -> None:
+        """
+        Store a message delivered to the mailboxes in stored in one
+        transaction, once the raw message and attachments are in their stores
+        (the preceding changes of batch). message is the MessageTemplate,
+        whose mailbox-independent savedata (HTML with its cid: references) is
+        what the database keeps. parsed and content are unused (see
+        FileStorage in mailserver3).
+        """
+        batch.call(
+            self.insert,
+            [mailbox_name(email) for email in stored],
+            message_id,
+            time.time(),
+            message.savedata,
+            raw_ref,
+            size,
+            digest,
+        )
+
+    def insert(
+        self,
+        mailboxes: list[str],
+        message_id: str,
+        received_at: float,
+        savedata: dict,
+        raw_ref: str,
+        size: int,
+        digest: str,
+    ) -> None:
+        """
+        Add a message for the given mailboxes. A message that is already
+        stored (same id and raw message) only gets the new recipients, which
+        lets the migration merge the copies of a message.
+        """
+        edata = savedata.get("parsed") or {}
+        db = self.connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO messages (message_id, received_at, sender_ip,"
+                " rcpts, raw_ref, size, digest, from_addr, subject, body, htmlbody)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    message_id,
+                    received_at,
+                    savedata.get("sender_ip") or "",
+                    json.dumps(savedata.get("rcpts") or [], ensure_ascii=False),
+                    raw_ref,
+                    size,
+                    digest,
+                    edata.get("from") or savedata.get("from") or "",
+                    edata.get("subject") or "",
+                    edata.get("body") or "",
+                    edata.get("htmlbody") or "",
+                ),
+            )
+            if cursor.rowcount:
+                message = cursor.lastrowid
+                db.executemany(
+                    "INSERT INTO attachments (message, position, file_id, filename, cid,"
+                    " size, sha256) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            message,
+                            position,
+                            details["id"],
+                            details.get("filename") or "",
+                            details.get("cid"),
+                            details.get("size") or 0,
+                            details["sha256"],
+                        )
+                        for position, details in enumerate(
+                            edata.get("attachments_details") or []
+                        )
+                    ],
+                )
+            else:
+                message = db.execute(
+                    "SELECT id FROM messages WHERE message_id = ? AND raw_ref = ?",
+                    (message_id, raw_ref),
+                ).fetchone()[0]
+
+            db.executemany(
+                "INSERT INTO mailboxes (address, created_at, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (address) DO UPDATE SET"
+                " updated_at = max(updated_at, excluded.updated_at)",
+                [(mailbox, received_at, received_at) for mailbox in mailboxes],
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO recipients (mailbox, message_id, message)"
+                " VALUES (?, ?, ?)",
+                [(mailbox, message_id, message) for mailbox in mailboxes],
+            )
+
+    def add_mailbox(self, mailbox: str, created_at: float) -> None:
+        """Register a mailbox without messages (e.g. an empty one being migrated)."""
+        db = self.connection()
+        with db:
+            db.execute(
+                "INSERT INTO mailboxes (address, created_at, updated_at) VALUES (?, ?, ?)"
+                " ON CONFLICT (address) DO UPDATE SET"
+                " created_at = min(created_at, excluded.created_at),"
+                " updated_at = max(updated_at, excluded.updated_at)",
+                (mailbox, created_at, created_at),
+            )
+
+    # ---- expiry --------------------------------------------------------
+
+    def expired_mailboxes(self, cutoff: float, limit: int) -> list[str]:
+        return [
+            row[0]
+            for row in self.connection().execute(
+                "SELECT address FROM mailboxes WHERE updated_at < ? LIMIT ?",
+                (cutoff, limit),
+            )
+        ]
+
+    def expired_messages(self, cutoff: float, limit: int) -> list[int]:
+        return [
+            row[0]
+            for row in self.connection().execute(
+                "SELECT id FROM messages WHERE received_at < ? LIMIT ?",
+                (cutoff, limit),
+            )
+        ]
+
+    def delete_mailboxes(self, mailboxes: list[str]) -> tuple[int, set[tuple[str, str]]]:
+        """
+        Delete mailboxes with their deliveries, and messages left without a
+        recipient. Returns the number of deliveries removed and the
+        (store, name) of every blob that may have become unused.
+        """
+        db = self.connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            marks = ",".join("?" * len(mailboxes))
+            messages = [
+                row[0]
+                for row in db.execute(
+                    f"SELECT DISTINCT message FROM recipients WHERE mailbox IN ({marks})",
+                    mailboxes,
+                )
+            ]
+            deliveries = db.execute(
+                f"DELETE FROM recipients WHERE mailbox IN ({marks})", mailboxes
+            ).rowcount
+            db.execute(f"DELETE FROM mailboxes WHERE address IN ({marks})", mailboxes)
+            marks = ",".join("?" * len(messages))
+            orphans = [
+                row[0]
+                for row in db.execute(
+                    f"SELECT id FROM messages WHERE id IN ({marks}) AND NOT EXISTS"
+                    " (SELECT 1 FROM recipients WHERE message = messages.id)",
+                    messages,
+                )
+            ]
+            blobs = self.remove_messages(db, orphans)
+        return deliveries, blobs
+
+    def delete_messages(self, messages: list[int]) -> tuple[int, set[tuple[str, str]]]:
+        """Delete messages from all mailboxes; returns like delete_mailboxes()."""
+        db = self.connection()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            marks = ",".join("?" * len(messages))
+            deliveries = db.execute(
+                f"SELECT count(*) FROM recipients WHERE message IN ({marks})", messages
+            ).fetchone()[0]
+            blobs = self.remove_messages(db, messages)
+        return deliveries, blobs
+
+    def remove_messages(self, db: sqlite3.Connection, messages: list[int]) -> set[tuple[str, str]]:
+        if not messages:
+            return set()
+        marks = ",".join("?" * len(messages))
+        blobs = {
+            (RAW_STORE, f"{row[0]}.eml")
+            for row in db.execute(
+                f"SELECT raw_ref FROM messages WHERE id IN ({marks})", messages
+            )
+        }
+        blobs.update(
+            (ATTACHMENT_STORE, row[0])
+            for row in db.execute(
+                f"SELECT sha256 FROM attachments WHERE message IN ({marks})", messages
+            )
+        )
+        db.execute(f"DELETE FROM messages WHERE id IN ({marks})", messages)
+        return blobs
+
+    def is_referenced(self, store: str, name: str) -> bool:
+        db = self.connection()
+        if store == RAW_STORE:
+            query = "SELECT 1 FROM messages WHERE raw_ref = ? LIMIT 1"
+            name = name.removesuffix(".eml")
+        else:
+            query = "SELECT 1 FROM attachments WHERE sha256 = ? LIMIT 1"
+        return db.execute(query, (name,)).fetchone() is not None
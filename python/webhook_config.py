@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def read_webhook_config(path: str, email: str) -> dict | None:
+    """Load and validate one webhook.json. Returns None if missing or invalid."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return None
+    except json.JSONDecodeError as e:
+        logger.error("Invalid JSON in webhook config for %s: %s", email, str(e))
+        return None
+    except Exception as e:
+        logger.error("Error loading webhook config for %s: %s", email, str(e))
+        return None
+
+    if not isinstance(config, dict):
+        logger.error("Invalid webhook config format for %s: not a dict", email)
+        return None
+    return config
+
+
+def file_signature(path: str) -> tuple | None:
+    """What a cached config is validated against; None if the file is missing."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class CachedWebhookConfig:
+    __slots__ = ("config", "signature", "checked")
+
+    def __init__(self, config: dict | None, signature: tuple | None, checked: float):
+        self.config = config
+        self.signature = signature
+        self.checked = checked
+
+
+class WebhookConfigCache:
+    """
+    LRU cache of parsed per-mailbox webhook.json files.
+
+    Mailboxes without (or with an invalid) config are cached too. An entry
+    is trusted for ``ttl`` seconds; after that a single stat() tells whether
+    the file was created, changed or removed, and only then it is re-read.
+    So a config saved in the web UI is picked up within ``ttl`` seconds.
+
+    Thread-safe, as it is used from the event loop and the I/O executor.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 2.0) -> None:
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.entries: OrderedDict[str, CachedWebhookConfig] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path: str, email: str) -> dict | None:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and now - entry.checked < self.ttl:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry.config
+
+        signature = file_signature(path)
+        with self.lock:
+            if entry is not None and entry.signature == signature:
+                entry.checked = now
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry.config
+            self.misses += 1
+
+        config = read_webhook_config(path, email) if signature is not None else None
+
+        with self.lock:
+            self.entries[path] = CachedWebhookConfig(config, signature, now)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return config
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
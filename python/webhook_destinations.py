@@ -0,0 +1,209 @@
+"""
+Per-host limits for webhook deliveries.
+
+- WEBHOOK_HOST_CONCURRENCY: requests in progress at once per receiving host
+  (scheme, host and port of the URL). Jobs over it are parked until one of
+  them finishes, instead of holding a spool worker.
+- WEBHOOK_CIRCUIT_FAILURES / WEBHOOK_CIRCUIT_COOLDOWN: a circuit breaker per
+  host. After that many consecutive failed requests (connection errors,
+  timeouts, 429 and 5xx responses) the circuit opens and the host's jobs are
+  parked without being attempted, so they keep their attempts. After the
+  cool-down one job is let through as a probe: if it gets through the
+  circuit closes and the parked jobs are sent, otherwise it opens again and
+  the probe is parked with the others. A failed probe doesn't count as an
+  attempt of its job, so jobs don't run out of attempts while a host stays
+  down for several cool-downs.
+
+Parked jobs wait in memory; they are still in the spool on disk, so a
+restart resumes them. Everything runs on the event loop thread.
+"""
+import asyncio
+import logging
+import random
+from collections import deque
+from urllib.parse import urlsplit
+
+import metrics
+from webhook_spool import Parked
+
+logger = logging.getLogger(__name__)
+
+# idle hosts are forgotten beyond this many
+MAX_HOSTS = 10000
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def backoff_delay(attempt: int, multiplier: float, cap: float = 0) -> float:
+    """
+    Seconds before the retry after attempt (counted from 0): multiplier**attempt,
+    at most cap (0 = no cap), of which a random 50-100% so that jobs that
+    failed together don't all come back at once.
+    """
+    delay = float(multiplier) ** attempt
+    if cap:
+        delay = min(cap, delay)
+    return random.uniform(delay / 2, delay)
+
+
+def host_failed(status: int) -> bool:
+    """Whether a response means the host is in trouble (not just this request)."""
+    return status == 429 or status >= 500
+
+
+def host_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme.lower()}://{parts.netloc.lower()}"
+
+
+class Destination:
+    def __init__(self, host: str, max_active: int, threshold: int, cooldown: float) -> None:
+        self.host = host
+        self.max_active = max_active
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.active = 0
+        self.failures = 0
+        self.state = CLOSED
+        self.probing = False
+        self.timer: asyncio.TimerHandle | None = None
+        # callbacks that queue the parked jobs again
+        self.parked: deque = deque()
+
+    def idle(self) -> bool:
+        return self.state == CLOSED and not self.active and not self.parked
+
+    def acquire(self) -> bool:
+        """
+        Take a request slot for the host, or raise Parked. Returns whether the
+        request is the probe of a half-open circuit.
+        """
+        if self.state == OPEN or (self.state == HALF_OPEN and self.probing):
+            self.park("open")
+        if self.max_active and self.active >= self.max_active:
+            self.park("busy")
+        probe = self.state == HALF_OPEN
+        if probe:
+            self.probing = True
+        self.active += 1
+        return probe
+
+    def park(self, reason: str) -> None:
+        metrics.WEBHOOK_PARKED.labels(reason).inc()
+        raise Parked(self.parked.append)
+
+    def release(self, ok: bool, probe: bool = False) -> None:
+        """
+        Return the slot of a request; ok unless the host failed it (see
+        host_failed). Raises Parked for a failed probe, its job waits for the
+        next one without using up an attempt.
+        """
+        self.active -= 1
+        if ok:
+            self.succeeded()
+        else:
+            self.failed()
+        self.wake()
+        if probe and not ok:
+            self.park("probe")
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self.probing = False
+        if self.state != CLOSED:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.state = CLOSED
+            logger.info(
+                "Webhook host %s is back, circuit closed (%d parked job(s))",
+                self.host,
+                len(self.parked),
+            )
+
+    def failed(self) -> None:
+        self.failures += 1
+        self.probing = False
+        if self.state == HALF_OPEN or (
+            self.state == CLOSED and self.threshold and self.failures >= self.threshold
+        ):
+            self.open()
+
+    def open(self) -> None:
+        self.state = OPEN
+        metrics.WEBHOOK_CIRCUIT_OPENED.inc()
+        cooldown = random.uniform(self.cooldown * 0.9, self.cooldown * 1.1)
+        logger.warning(
+            "Webhook host %s failed %d time(s) in a row, circuit open: "
+            "parking its webhooks for %d seconds",
+            self.host,
+            self.failures,
+            cooldown,
+        )
+        self.timer = asyncio.get_running_loop().call_later(cooldown, self.half_open)
+
+    def half_open(self) -> None:
+        self.timer = None
+        self.state = HALF_OPEN
+        logger.info("Webhook host %s: cool-down over, trying one webhook", self.host)
+        self.wake()
+
+    def wake(self) -> None:
+        """Queue as many parked jobs as the host can take now."""
+        if self.state == OPEN:
+            return
+        if self.state == HALF_OPEN:
+            free = 0 if self.probing else 1
+        elif self.max_active:
+            free = self.max_active - self.active
+        else:
+            free = len(self.parked)
+        while free > 0 and self.parked:
+            self.parked.popleft()()
+            free -= 1
+
+    def close(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class Destinations:
+    """The Destination of every host webhooks are sent to."""
+
+    def __init__(self, max_active: int = 0, threshold: int = 5, cooldown: float = 60) -> None:
+        self.max_active = max_active
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.hosts: dict[str, Destination] = {}
+
+    def get(self, url: str) -> Destination:
+        key = host_key(url)
+        destination = self.hosts.get(key)
+        if destination is None:
+            if len(self.hosts) >= MAX_HOSTS:
+                self.hosts = {k: d for k, d in self.hosts.items() if not d.idle()}
+            destination = self.hosts[key] = Destination(
+                key, self.max_active, self.threshold, self.cooldown
+            )
+        return destination
+
+    def parked(self) -> int:
+        return sum(len(d.parked) for d in self.hosts.values())
+
+    def in_state(self, state: str) -> int:
+        return sum(1 for d in self.hosts.values() if d.state == state)
+
+    def close(self) -> None:
+        for destination in self.hosts.values():
+            destination.close()
+
+    def register_metrics(self) -> None:
+        """Export the current state as gauges (read when scraped)."""
+        metrics.WEBHOOK_JOBS_PARKED.set_function(self.parked)
+        for state in (CLOSED, OPEN, HALF_OPEN):
+            metrics.WEBHOOK_CIRCUITS.labels(state).set_function(
+                lambda state=state: self.in_state(state)
+            )
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+
+from group_commit import GroupCommit
+
+logger = logging.getLogger(__name__)
+
+
+class Parked(Exception):
+    """
+    Raised by deliver (or deliver_batch) for a job that cannot be tried now,
+    e.g. because its host is down. The job keeps its attempt count and is
+    queued again when the callback given to wake_up is called.
+    """
+
+    def __init__(self, wake_up) -> None:
+        super().__init__()
+        self.wake_up = wake_up
+
+
+class Batch:
+    """Jobs for the same target, sent together in one request."""
+
+    def __init__(self, key, max_size: int) -> None:
+        self.key = key
+        self.max_size = max_size
+        self.jobs: list[dict] = []
+        self.timer: asyncio.TimerHandle | None = None
+
+    @property
+    def attempt(self) -> int:
+        return max(job["attempt"] for job in self.jobs)
+
+
+class WebhookSpool:
+    """
+    Durable on-disk queue for webhook deliveries.
+
+    Every job is one JSON file in the spool directory, written atomically
+    through committer (a GroupCommit, so it is flushed to disk according to
+    the FSYNC mode, like the messages; by default fsynced every time) before
+    the SMTP transaction is acknowledged. A pool of async workers
+    drains the spool; a job file is only removed once its delivery finished
+    (successfully or after its last attempt), so pending jobs survive a
+    restart and are picked up again by start().
+
+    The actual delivery is done by the ``deliver(email, data, attempt)``
+    coroutine passed to start(). It returns None when the job is finished,
+    or the number of seconds to wait before the next attempt.
+
+    Jobs for which ``batch_key(email, data)`` returns a (key, window,
+    max_size) are collected per key instead, for up to window seconds or
+    max_size jobs, and handed to ``deliver_batch(key, items, attempt)``
+    together. It returns the seconds to wait before the next attempt (None
+    for no retry) and the positions of the items to try again; a batch is
+    retried as a whole, with the items that failed. Every job stays on disk
+    until its delivery finished, so after a restart pending jobs are
+    batched again. Both may raise Parked to put a job aside for later.
+    """
+
+    def __init__(
+        self, spool_dir: str, workers: int = 4, committer: GroupCommit | None = None
+    ) -> None:
+        self.spool_dir = spool_dir
+        self.workers = max(1, workers)
+        self.committer = committer or GroupCommit("always")
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.queue: asyncio.Queue[str | Batch] | None = None
+        self.tasks: list[asyncio.Task] = []
+        self.timers: set[asyncio.TimerHandle] = set()
+        self.batches: dict = {}
+        self.batch_key = None
+        self.deliver_batch = None
+
+    def job_path(self, job_id: str) -> str:
+        return os.path.join(self.spool_dir, f"{job_id}.json")
+
+    def write_jobs(self, jobs: list[dict]) -> None:
+        """Write (or replace) job files and wait until they are committed."""
+        batch = self.committer.begin()
+        for job in jobs:
+            data = json.dumps(job, ensure_ascii=False).encode("utf-8")
+            batch.write(self.job_path(job["id"]), data)
+        batch.commit().result()
+
+    def write_job(self, job: dict) -> None:
+        self.write_jobs([job])
+
+    def read_job(self, job_id: str) -> dict | None:
+        try:
+            with open(self.job_path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error("Dropping unreadable webhook job %s: %s", job_id, e)
+            self.remove_job(job_id)
+            return None
+
+    def remove_job(self, job_id: str) -> None:
+        try:
+            os.remove(self.job_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def enqueue(self, email: str, data: dict) -> None:
+        self.enqueue_many([(email, data)])
+
+    def enqueue_many(self, items: list[tuple[str, dict]]) -> None:
+        """
+        Persist a job for every (email, data) and hand them to the workers.
+
+        Safe to call from executor threads; the jobs are committed together
+        and on disk when this returns.
+        """
+        jobs = [
+            {
+                "id": f"{time.time_ns()}-{uuid.uuid4().hex[:8]}",
+                "email": email,
+                "data": data,
+                "attempt": 0,
+                "next_attempt": 0,
+            }
+            for email, data in items
+        ]
+        if not jobs:
+            return
+        self.write_jobs(jobs)
+        if self.loop is not None:
+            for job in jobs:
+                self.loop.call_soon_threadsafe(self.queue.put_nowait, job["id"])
+
+    def schedule(self, item: str | Batch, delay: float) -> None:
+        """Queue a job id (or a batch) for the workers after delay seconds."""
+        if delay <= 0:
+            self.queue.put_nowait(item)
+            return
+
+        def wake() -> None:
+            self.timers.discard(timer)
+            self.queue.put_nowait(item)
+
+        timer = self.loop.call_later(delay, wake)
+        self.timers.add(timer)
+
+    def resume(self) -> int:
+        """Queue all jobs left on disk by a previous run."""
+        now = time.time()
+        resumed = 0
+        for entry in sorted(os.listdir(self.spool_dir)):
+            if entry.endswith(".tmp"):
+                os.remove(os.path.join(self.spool_dir, entry))
+                continue
+            if not entry.endswith(".json"):
+                continue
+            job_id = entry[: -len(".json")]
+            job = self.read_job(job_id)
+            if job is None:
+                continue
+            self.schedule(job_id, job.get("next_attempt", 0) - now)
+            resumed += 1
+        return resumed
+
+    async def start(self, deliver, batch_key=None, deliver_batch=None) -> None:
+        os.makedirs(self.spool_dir, mode=0o755, exist_ok=True)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.deliver = deliver
+        self.batch_key = batch_key
+        self.deliver_batch = deliver_batch
+
+        resumed = self.resume()
+        if resumed:
+            logger.info("Resuming %d pending webhook job(s)", resumed)
+
+        self.tasks = [
+            asyncio.create_task(self.worker()) for _ in range(self.workers)
+        ]
+
+    async def stop(self) -> None:
+        """Stop the workers. Unfinished jobs stay on disk for the next start."""
+        for timer in self.timers:
+            timer.cancel()
+        self.timers.clear()
+        # their jobs are still on disk
+        for batch in self.batches.values():
+            if batch.timer is not None:
+                batch.timer.cancel()
+        self.batches.clear()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        self.loop = None
+
+    async def worker(self) -> None:
+        while True:
+            item = await self.queue.get()
+            try:
+                if isinstance(item, Batch):
+                    await self.process_batch(item)
+                else:
+                    await self.process(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Unexpected error in webhook job %s: %s", item, e)
+            finally:
+                self.queue.task_done()
+
+    async def process(self, job_id: str) -> None:
+        job = await asyncio.to_thread(self.read_job, job_id)
+        if job is None:
+            return
+
+        batching = self.batch_key(job["email"], job["data"]) if self.batch_key else None
+        if batching is not None:
+            self.add_to_batch(job, *batching)
+            return
+
+        try:
+            retry_in = await self.deliver(job["email"], job["data"], job["attempt"])
+        except Parked as parked:
+            parked.wake_up(lambda: self.queue.put_nowait(job_id))
+            return
+
+        if retry_in is None:
+            await asyncio.to_thread(self.remove_job, job_id)
+            return
+
+        job["attempt"] += 1
+        job["next_attempt"] = time.time() + retry_in
+        await asyncio.to_thread(self.write_job, job)
+        self.schedule(job_id, retry_in)
+
+    def add_to_batch(self, job: dict, key, window: float, max_size: int) -> None:
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = Batch(key, max_size)
+            batch.timer = self.loop.call_later(window, self.flush, key)
+        batch.jobs.append(job)
+        if len(batch.jobs) >= batch.max_size:
+            self.flush(key)
+
+    def flush(self, key) -> None:
+        batch = self.batches.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        self.queue.put_nowait(batch)
+
+    async def process_batch(self, batch: Batch) -> None:
+        items = [(job["email"], job["data"]) for job in batch.jobs]
+        try:
+            retry_in, retry = await self.deliver_batch(batch.key, items, batch.attempt)
+        except Parked as parked:
+            parked.wake_up(lambda: self.queue.put_nowait(batch))
+            return
+
+        retry = set(retry) if retry_in is not None else set()
+        done = [job["id"] for i, job in enumerate(batch.jobs) if i not in retry]
+        if done:
+            await asyncio.to_thread(lambda: [self.remove_job(job_id) for job_id in done])
+        if not retry:
+            return
+
+        again = Batch(batch.key, batch.max_size)
+        again.jobs = [job for i, job in enumerate(batch.jobs) if i in retry]
+        next_attempt = time.time() + retry_in
+        for job in again.jobs:
+            job["attempt"] += 1
+            job["next_attempt"] = next_attempt
+        await asyncio.to_thread(self.write_jobs, again.jobs)
+        self.schedule(again, retry_in)
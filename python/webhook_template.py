@@ -0,0 +1,76 @@
+import functools
+import json
+import re
+
+VARIABLES = ("to", "from", "subject", "body", "htmlbody", "sender_ip", "attachments")
+VARIABLE_RE = re.compile(r"\{\{(" + "|".join(VARIABLES) + r")\}\}")
+
+# stand-ins used to check once that a template renders to valid JSON
+SAMPLE_VALUES = {name: "x" for name in VARIABLES}
+SAMPLE_VALUES["attachments"] = json.dumps([{"filename": "x", "size": 1}])
+
+
+def json_escape(value) -> str:
+    """Escape a value for use inside a JSON string literal."""
+    if value is None:
+        return ""
+    return json.dumps(str(value), ensure_ascii=False)[1:-1]
+
+
+VALUE_GETTERS = {
+    "to": lambda data, parsed: json_escape(
+        data["rcpts"][0] if data.get("rcpts") else ""
+    ),
+    "from": lambda data, parsed: json_escape(parsed.get("from", "")),
+    "subject": lambda data, parsed: json_escape(parsed.get("subject", "")),
+    "body": lambda data, parsed: json_escape(parsed.get("body", "")),
+    "htmlbody": lambda data, parsed: json_escape(parsed.get("htmlbody", "")),
+    "sender_ip": lambda data, parsed: json_escape(data.get("sender_ip", "")),
+    "attachments": lambda data, parsed: json.dumps(
+        parsed.get("attachments_details", []), ensure_ascii=False
+    ),
+}
+
+
+class PayloadTemplate:
+    """
+    A webhook payload template split into a render plan: the literal text
+    between placeholders and the variable that goes into each gap. Unknown
+    {{placeholders}} are kept as literal text.
+    """
+
+    def __init__(self, template: str) -> None:
+        parts = VARIABLE_RE.split(template)
+        self.literals = parts[0::2]
+        self.variables = parts[1::2]
+        self.used = frozenset(self.variables)
+        self.error: str | None = None
+        try:
+            json.loads(self.render_str(SAMPLE_VALUES))
+        except json.JSONDecodeError as e:
+            self.error = str(e)
+
+    def render_str(self, values: dict) -> str:
+        out = [self.literals[0]]
+        for name, literal in zip(self.variables, self.literals[1:]):
+            out.append(values[name])
+            out.append(literal)
+        return "".join(out)
+
+    def render(self, data: dict) -> bytes:
+        """
+        The final payload, exactly as it is signed and sent. Every variable
+        the template uses is escaped once, however often it appears.
+        """
+        parsed = data.get("parsed", {})
+        values = {name: VALUE_GETTERS[name](data, parsed) for name in self.used}
+        return self.render_str(values).encode("utf-8")
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(template: str) -> PayloadTemplate:
+    """
+    Compile a template once. Keyed by the template text, so a changed
+    webhook.json simply compiles (and caches) its new template.
+    """
+    return PayloadTemplate(template)
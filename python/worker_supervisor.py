@@ -0,0 +1,122 @@
+import logging
+import os
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerSupervisor:
+    """
+    Fork and supervise a fixed number of worker processes.
+
+    Every worker runs ``target(worker_id)`` in a forked child, with worker ids
+    0..workers-1. A worker that exits while the supervisor is not stopping is
+    restarted with the same id (so it picks up its own on-disk state again),
+    after a delay that grows while workers keep dying right after start-up.
+
+    SIGINT and SIGTERM are forwarded to all workers; run() returns once every
+    worker has exited. The relay_signals are forwarded as well, without
+    stopping anything (workers ignore them until they install a handler).
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        target,
+        restart_delay: float = 1.0,
+        max_restart_delay: float = 30.0,
+        min_uptime: float = 10.0,
+        relay_signals: tuple = (),
+    ) -> None:
+        self.workers = workers
+        self.target = target
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.min_uptime = min_uptime
+        self.relay_signals = relay_signals
+        self.pids: dict[int, int] = {}
+        self.started: dict[int, float] = {}
+        self.delays: dict[int, float] = {}
+        self.stopping = False
+
+    def spawn(self, worker_id: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                for signum in self.relay_signals:
+                    signal.signal(signum, signal.SIG_IGN)
+                self.target(worker_id)
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                logger.exception("Worker %d failed", worker_id)
+            finally:
+                logging.shutdown()
+                os._exit(code)
+
+        self.pids[pid] = worker_id
+        self.started[worker_id] = time.monotonic()
+        logger.info("Started worker %d (pid %d)", worker_id, pid)
+
+    def relay(self, signum, frame=None) -> None:
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self, signum, frame=None) -> None:
+        if not self.stopping:
+            logger.info("Stopping %d worker(s)", len(self.pids))
+        self.stopping = True
+        self.relay(signum)
+
+    def restart(self, worker_id: int) -> None:
+        uptime = time.monotonic() - self.started[worker_id]
+        if uptime >= self.min_uptime:
+            delay = self.restart_delay
+        else:
+            delay = min(
+                self.delays.get(worker_id, self.restart_delay / 2) * 2,
+                self.max_restart_delay,
+            )
+        self.delays[worker_id] = delay
+
+        logger.info("Restarting worker %d in %.1fs", worker_id, delay)
+        time.sleep(delay)
+        if not self.stopping:
+            self.spawn(worker_id)
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for signum in self.relay_signals:
+            signal.signal(signum, self.relay)
+
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker_id = self.pids.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping:
+                logger.info("Worker %d (pid %d) exited", worker_id, pid)
+                continue
+
+            logger.warning(
+                "Worker %d (pid %d) died with exit code %d", worker_id, pid, code
+            )
+            self.restart(worker_id)
@@ -247,10 +247,7 @@ final class ApiController extends AbstractController
             return $this->error('Invalid email address');
         }
 
-        $path = Mailbox::getDirForEmail($email);
-        if (is_dir($path)) {
-            Mailbox::deleteTree($path);
-        }
+        Mailbox::deleteMailbox($email);
 
         return '';
     }
@@ -359,12 +356,8 @@ final class ApiController extends AbstractController
             return $this->error('Attachment not found');
         }
 
-        if (!Mailbox::attachmentExists($email, $attachment)) {
-            return $this->error('Attachment not found');
-        }
-
-        $file = Mailbox::getDirForEmail($email) . DS . 'attachments' . DS . $attachment;
-        if (!is_file($file)) {
+        $file = Mailbox::attachmentPath($email, $attachment);
+        if ($file === null) {
             return $this->error('Attachment not found');
         }
 
@@ -393,18 +386,13 @@ final class ApiController extends AbstractController
             return '<div class="uk-alert uk-alert-danger"><p>Invalid email address: ' . $safeEmail . '</p></div>';
         }
 
-        $dir = Mailbox::ensureMailboxDir($email) ?? Mailbox::getDirForEmail($email);
+        Mailbox::ensureMailboxDir($email);
         $emails = Mailbox::getEmailsOfEmail($email);
 
-        $createdAt = time();
-        if (is_dir($dir)) {
-            $mtime = filemtime($dir);
-            if ($mtime !== false) {
-                $createdAt = $mtime;
-            }
-        }
+        $createdAt = Mailbox::lastActivity($email) ?? time();
 
-        $expiresAt = $createdAt + (15 * 60); // expire after 15 minutes
+        $maxAge    = Mailbox::mailboxMaxAge();
+        $expiresAt = $maxAge > 0 ? $createdAt + $maxAge : null;
 
         return $this->renderTemplate('email-table.html', [
             'isadmin' => !empty($this->settings['ADMIN']) && $this->settings['ADMIN'] === $email,
@@ -571,6 +559,19 @@ final class ApiController extends AbstractController
             return $this->jsonResponse(['success' => false, 'message' => 'Backoff multiplier must be between 1 and 5']);
         }
 
+        $batchEnabled = filter_var($data['batch_enabled'] ?? false, FILTER_VALIDATE_BOOLEAN, FILTER_NULL_ON_FAILURE)
+            ?? false;
+
+        $batchWindow = isset($data['batch_window_ms']) ? (int) $data['batch_window_ms'] : 1000;
+        if ($batchWindow < 10 || $batchWindow > 60000) {
+            return $this->jsonResponse(['success' => false, 'message' => 'Batch window must be between 10 and 60000 ms']);
+        }
+
+        $batchMaxSize = isset($data['batch_max_size']) ? (int) $data['batch_max_size'] : 100;
+        if ($batchMaxSize < 1 || $batchMaxSize > 1000) {
+            return $this->jsonResponse(['success' => false, 'message' => 'Batch size must be between 1 and 1000']);
+        }
+
         $enabled = filter_var($data['enabled'] ?? false, FILTER_VALIDATE_BOOLEAN, FILTER_NULL_ON_FAILURE) ?? false;
 
         $config = [
@@ -581,6 +582,11 @@ final class ApiController extends AbstractController
                 'max_attempts' => $maxAttempts,
                 'backoff_multiplier' => $backoffMultiplier,
             ],
+            'batch_config' => [
+                'enabled' => $batchEnabled,
+                'window_ms' => $batchWindow,
+                'max_size' => $batchMaxSize,
+            ],
             'secret_key' => isset($data['secret_key'])
                 ? substr((string) $data['secret_key'], 0, 255)
                 : '',
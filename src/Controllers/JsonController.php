@@ -6,6 +6,7 @@ namespace OpenTrashmail\Controllers;
 
 use JsonException;
 use OpenTrashmail\Services\Mailbox;
+use OpenTrashmail\Services\SearchIndex;
 
 final class JsonController extends AbstractController
 {
@@ -19,6 +20,7 @@ final class JsonController extends AbstractController
         return match ($routeName) {
             'json_listaccounts' => $this->listAccounts(),
             'json_email' => $this->handleEmailRequest($vars),
+            'json_search' => $this->search($vars),
             default => $this->jsonError(404, 'Not Found'),
         };
     }
@@ -82,6 +84,32 @@ final class JsonController extends AbstractController
         return $this->jsonOk(Mailbox::getEmailsOfEmail($email, true, true));
     }
 
+    /**
+     * @param array<string, mixed> $vars
+     */
+    private function search(array $vars): string
+    {
+        if (!SearchIndex::enabled()) {
+            return $this->jsonError(404, 'Search is not enabled');
+        }
+
+        $email = $this->resolveEmail($vars);
+        if ($email === null || filter_var($email, FILTER_VALIDATE_EMAIL) === false) {
+            return $this->jsonError(404, 'Email not found');
+        }
+
+        $query = $_REQUEST['q'] ?? null;
+        if (!is_string($query) || trim($query) === '') {
+            return $this->jsonError(400, 'Missing query (q)');
+        }
+
+        $limit = filter_var($_REQUEST['limit'] ?? null, FILTER_VALIDATE_INT, [
+            'options' => ['default' => 50, 'min_range' => 1, 'max_range' => 500],
+        ]);
+
+        return $this->jsonOk(SearchIndex::search($email, $query, $limit));
+    }
+
     /**
      * @param array<string, mixed> $vars
      */
@@ -0,0 +1,59 @@
+<?php
+declare(strict_types=1);
+
+namespace OpenTrashmail\Services;
+
+/**
+ * Reads message files the mailserver stored compressed ([MAILSERVER]
+ * COMPRESSION, see python/compress.py): "\x89OTM", a codec byte, the data.
+ * Files without that header are returned as they are.
+ */
+class Compression
+{
+    private const string MAGIC = "\x89OTM";
+
+    private const int STORED = 0;
+    private const int ZLIB   = 1;
+    private const int LZMA   = 2;
+    private const int ZSTD   = 3;
+
+    public static function decode(string $data): ?string
+    {
+        $headerSize = strlen(self::MAGIC) + 1;
+        if (strlen($data) < $headerSize || !str_starts_with($data, self::MAGIC)) {
+            return $data;
+        }
+
+        $codec   = ord($data[$headerSize - 1]);
+        $payload = substr($data, $headerSize);
+
+        $decoded = match ($codec) {
+            self::STORED => $payload,
+            self::ZLIB   => @gzuncompress($payload),
+            // pecl xz
+            self::LZMA   => function_exists('xzdecode') ? @xzdecode($payload) : null,
+            // pecl zstd
+            self::ZSTD   => function_exists('zstd_uncompress') ? @zstd_uncompress($payload) : null,
+            default      => null,
+        };
+
+        if (!is_string($decoded)) {
+            error_log(sprintf(
+                '[OpenTrashmail] Cannot decompress message file (codec %d)%s',
+                $codec,
+                $decoded === null ? ': PHP extension missing' : ''
+            ));
+
+            return null;
+        }
+
+        return $decoded;
+    }
+
+    public static function readFile(string $file): ?string
+    {
+        $data = @file_get_contents($file);
+
+        return $data === false ? null : self::decode($data);
+    }
+}
@@ -7,10 +7,55 @@ use JsonException;
 
 class Mailbox
 {
+    /**
+     * Per-mailbox summary index, appended by the mailserver for every stored
+     * message (one JSON object per line).
+     */
+    private const string INDEX_FILE = 'index.jsonl';
+
+    /**
+     * Content-addressed store (below data/) for raw messages, see resolveRaw().
+     */
+    private const string RAW_STORE = '_raw';
+
+    /**
+     * Content-addressed store (below data/) for attachments, read directly
+     * with STORAGE=sqlite.
+     */
+    private const string ATTACHMENT_STORE = '_attachments';
+
+    /**
+     * Expiry index of python/retention.py (below data/), one file per minute.
+     */
+    private const string EXPIRY_DIR = '_expiry';
+    private const int EXPIRY_BUCKET_SECONDS = 60;
+
+    /**
+     * Message ids start with the receive time in milliseconds, followed by
+     * the worker id and a sequence number (ids of older versions are only
+     * the time).
+     */
+    private const int ID_TIME_DIGITS = 13;
+
+    /**
+     * Time a message was received, in unix milliseconds, from its id.
+     */
+    public static function receivedAt(string $id): int
+    {
+        return ctype_digit($id) ? (int)substr($id, 0, self::ID_TIME_DIGITS) : 0;
+    }
+
     public static function ensureMailboxDir(string $email): ?string
     {
         $dir = self::getDirForEmail($email);
 
+        if (SqliteStore::enabled()) {
+            // mailboxes are rows; the directory is only created for a webhook.json
+            SqliteStore::touchMailbox($email);
+
+            return $dir;
+        }
+
         if (is_dir($dir)) {
             return $dir;
         }
@@ -20,9 +65,58 @@ class Mailbox
             return null;
         }
 
+        self::registerMailboxExpiry($dir);
+
         return $dir;
     }
 
+    /**
+     * Seconds after its last change until a mailbox is deleted
+     * ([CLEANUP] MAILBOX_MAX_AGE_MINUTES), 0 if mailboxes never expire.
+     */
+    public static function mailboxMaxAge(): int
+    {
+        $settings = Settings::load();
+        $minutes  = is_array($settings) ? ($settings['MAILBOX_MAX_AGE_MINUTES'] ?? '') : '';
+
+        if (!is_numeric($minutes)) {
+            return 0;
+        }
+
+        return max(0, (int) round((float) $minutes * 60));
+    }
+
+    /**
+     * Tell the retention job about a mailbox created without a message
+     * (the mailserver registers mailboxes when it stores mail).
+     */
+    public static function registerMailboxExpiry(string $dir): void
+    {
+        if (SqliteStore::enabled()) {
+            SqliteStore::touchMailbox(basename($dir));
+
+            return;
+        }
+
+        $maxAge = self::mailboxMaxAge();
+        if ($maxAge === 0) {
+            return;
+        }
+
+        $expiryDir = ROOT . DS . 'data' . DS . self::EXPIRY_DIR;
+        if (!is_dir($expiryDir) && !@mkdir($expiryDir, 0o770, true) && !is_dir($expiryDir)) {
+            error_log(sprintf('[OpenTrashmail] Failed to create expiry dir "%s"', $expiryDir));
+            return;
+        }
+
+        $bucket = intdiv(time() + $maxAge, self::EXPIRY_BUCKET_SECONDS);
+        file_put_contents(
+            $expiryDir . DS . $bucket . '.txt',
+            "b\t" . basename($dir) . "\n",
+            FILE_APPEND | LOCK_EX
+        );
+    }
+
     public static function getDirForEmail(string $email): string
     {
         static $baseDir     = null;
@@ -62,14 +156,18 @@ class Mailbox
 
     private static function loadEmailJson(string $email, string $id): ?array
     {
+        if (SqliteStore::enabled()) {
+            return SqliteStore::getMessage($email, $id);
+        }
+
         $file = self::getDirForEmail($email) . DS . $id . '.json';
 
         if (!is_file($file)) {
             return null;
         }
 
-        $json = file_get_contents($file);
-        if ($json === false || $json === '') {
+        $json = Compression::readFile($file);
+        if ($json === null || $json === '') {
             return null;
         }
 
@@ -82,24 +180,66 @@ class Mailbox
         return is_array($data) ? $data : null;
     }
 
+    /**
+     * Raw message of a decoded message JSON. Older messages carry it inline in
+     * "raw", newer ones reference the raw store by sha256 ("raw_ref") and have
+     * the blob hardlinked as <id>.eml next to the JSON.
+     */
+    private static function resolveRaw(string $dir, string $id, array $data): ?string
+    {
+        if (array_key_exists('raw', $data)) {
+            return is_string($data['raw']) ? $data['raw'] : (string)$data['raw'];
+        }
+
+        $ref = $data['raw_ref'] ?? null;
+        if (!is_string($ref)) {
+            return null;
+        }
+
+        $candidates = [$dir . DS . $id . '.eml'];
+        if (preg_match('/^[0-9a-f]{64}$/', $ref) === 1) {
+            $candidates[] = ROOT . DS . 'data' . DS . self::RAW_STORE . DS . $ref . '.eml';
+        }
+
+        foreach ($candidates as $file) {
+            if (is_file($file)) {
+                return Compression::readFile($file);
+            }
+        }
+
+        return null;
+    }
+
     public static function getEmail(string $email, string $id): ?array
     {
-        return self::loadEmailJson($email, $id);
+        $data = self::loadEmailJson($email, $id);
+
+        if ($data !== null && !array_key_exists('raw', $data)) {
+            $raw = self::resolveRaw(self::getDirForEmail($email), $id, $data);
+            $data['raw'] = $raw === null ? '' : mb_scrub($raw, 'UTF-8');
+            unset($data['raw_ref']);
+        }
+
+        return $data;
     }
 
     public static function getRawEmail(string $email, string $id): ?string
     {
         $data = self::loadEmailJson($email, $id);
 
-        if ($data === null || !array_key_exists('raw', $data)) {
+        if ($data === null) {
             return null;
         }
 
-        return is_string($data['raw']) ? $data['raw'] : (string)$data['raw'];
+        return self::resolveRaw(self::getDirForEmail($email), $id, $data);
     }
 
     public static function emailIdExists(string $email, string $id): bool
     {
+        if (SqliteStore::enabled()) {
+            return SqliteStore::messageExists($email, $id);
+        }
+
         $file = self::getDirForEmail($email) . DS . $id . '.json';
 
         return is_file($file);
@@ -129,13 +269,48 @@ class Mailbox
             $addresses = [$email];
         }
 
+        $useIndex = !$includeBody && !$includeAttachments;
+        $useDb    = SqliteStore::enabled();
+
         foreach ($addresses as $address) {
+            if ($useDb) {
+                foreach (SqliteStore::listMessages($address, $includeBody, $includeAttachments) as $row) {
+                    $attachments = $row['attachments'] ?? [];
+                    unset($row['attachments']);
+
+                    $row = ['email' => $address] + $row;
+                    if ($attachments !== []) {
+                        $row['attachments'] = self::attachmentUrls($settings, $address, $attachments);
+                    }
+
+                    $result[$row['id']] = $row;
+                }
+                continue;
+            }
+
             $dir = self::getDirForEmail($address);
 
             if (!is_dir($dir)) {
                 continue;
             }
 
+            $indexed = $useIndex ? self::readIndex($dir) : null;
+            if ($indexed !== null) {
+                foreach ($indexed as $entry) {
+                    $time = (string)$entry['id'];
+
+                    $result[$time] = [
+                        'email'   => $address,
+                        'id'      => $time,
+                        'from'    => (string)($entry['from'] ?? ''),
+                        'subject' => (string)($entry['subject'] ?? ''),
+                        'md5'     => (string)($entry['digest'] ?? ''),
+                        'maillen' => (int)($entry['size'] ?? 0),
+                    ];
+                }
+                continue;
+            }
+
             $handle = opendir($dir);
             if ($handle === false) {
                 continue;
@@ -149,9 +324,14 @@ class Mailbox
                 $time     = substr($entry, 0, -5);
                 $filePath = $dir . DS . $entry;
 
-                $raw = @file_get_contents($filePath) ?: '';
+                $raw = Compression::readFile($filePath) ?? '';
                 $json = json_decode($raw, true);
-                if (!is_array($json) || !isset($json['parsed'], $json['raw'])) {
+                if (!is_array($json) || !isset($json['parsed'])) {
+                    continue;
+                }
+
+                $rawMail = self::resolveRaw($dir, $time, $json);
+                if ($rawMail === null) {
                     continue;
                 }
 
@@ -162,8 +342,8 @@ class Mailbox
                     'id'      => $time,
                     'from'    => $parsed['from']    ?? '',
                     'subject' => $parsed['subject'] ?? '',
-                    'md5'     => md5($time . $json['raw']),
-                    'maillen' => strlen($json['raw']),
+                    'md5'     => md5($time . $rawMail),
+                    'maillen' => strlen($rawMail),
                 ];
 
                 if ($includeBody) {
@@ -175,16 +355,7 @@ class Mailbox
                     !empty($parsed['attachments']) &&
                     is_array($parsed['attachments'])
                 ) {
-                    $row['attachments'] = array_map(
-                        static function ($attachment) use ($settings, $address) {
-                            $baseUrl = is_array($settings) && !empty($settings['URL'])
-                                ? $settings['URL']
-                                : '';
-
-                            return rtrim((string)$baseUrl, '/') . '/api/attachment/' . $address . '/' . $attachment;
-                        },
-                        $parsed['attachments']
-                    );
+                    $row['attachments'] = self::attachmentUrls($settings, $address, $parsed['attachments']);
                 }
 
                 $result[$time] = $row;
@@ -200,8 +371,82 @@ class Mailbox
         return $result;
     }
 
+    private static function attachmentUrls(array|false $settings, string $address, array $attachments): array
+    {
+        $baseUrl = is_array($settings) && !empty($settings['URL'])
+            ? $settings['URL']
+            : '';
+
+        return array_map(
+            static fn($attachment) => rtrim((string)$baseUrl, '/') . '/api/attachment/' . $address . '/' . $attachment,
+            $attachments
+        );
+    }
+
+    /**
+     * Read the summary index of a mailbox directory.
+     * Returns null if the mailbox has no index (yet), so callers can fall back
+     * to scanning the message files.
+     *
+     * @return list<array<string, mixed>>|null
+     */
+    private static function readIndex(string $dir): ?array
+    {
+        $handle = @fopen($dir . DS . self::INDEX_FILE, 'rb');
+        if ($handle === false) {
+            return null;
+        }
+
+        $entries = [];
+
+        if (flock($handle, LOCK_SH)) {
+            while (($line = fgets($handle)) !== false) {
+                $entry = json_decode($line, true);
+                if (is_array($entry) && isset($entry['id']) && ctype_digit((string)$entry['id'])) {
+                    $entries[] = $entry;
+                }
+            }
+            flock($handle, LOCK_UN);
+        }
+
+        fclose($handle);
+
+        return $entries;
+    }
+
+    private static function removeFromIndex(string $dir, string $id): void
+    {
+        $handle = @fopen($dir . DS . self::INDEX_FILE, 'r+b');
+        if ($handle === false) {
+            return;
+        }
+
+        if (flock($handle, LOCK_EX)) {
+            $kept = '';
+            while (($line = fgets($handle)) !== false) {
+                $entry = json_decode($line, true);
+                if (is_array($entry) && (string)($entry['id'] ?? '') === $id) {
+                    continue;
+                }
+                $kept .= $line;
+            }
+
+            ftruncate($handle, 0);
+            rewind($handle);
+            fwrite($handle, $kept);
+            fflush($handle);
+            flock($handle, LOCK_UN);
+        }
+
+        fclose($handle);
+    }
+
     public static function listEmailAddresses(): array
     {
+        if (SqliteStore::enabled()) {
+            return SqliteStore::listMailboxes();
+        }
+
         $out  = [];
         $base = ROOT . DS . 'data' . DS;
 
@@ -219,27 +464,31 @@ class Mailbox
 
     public static function attachmentExists(string $email, string $attachment): bool
     {
-        $file = self::getDirForEmail($email) . DS . 'attachments' . DS . $attachment;
-
-        return is_file($file);
+        return self::attachmentPath($email, $attachment) !== null;
     }
 
-    public static function listAttachmentsOfMailId(string $email, string $id): array
+    /**
+     * File holding an attachment of this mailbox, null if there is none.
+     */
+    public static function attachmentPath(string $email, string $attachment): ?string
     {
-        $file = self::getDirForEmail($email) . DS . $id . '.json';
-
-        if (!is_file($file)) {
-            return [];
+        if (SqliteStore::enabled()) {
+            $sha256 = SqliteStore::attachmentSha256($email, $attachment);
+            if ($sha256 === null || preg_match('/^[0-9a-f]{64}$/', $sha256) !== 1) {
+                return null;
+            }
+            $file = ROOT . DS . 'data' . DS . self::ATTACHMENT_STORE . DS . $sha256;
+        } else {
+            $file = self::getDirForEmail($email) . DS . 'attachments' . DS . $attachment;
         }
 
-        $json = file_get_contents($file);
-        if ($json === false) {
-            return [];
-        }
+        return is_file($file) ? $file : null;
+    }
 
-        try {
-            $data = json_decode($json, true, 512, JSON_THROW_ON_ERROR);
-        } catch (JsonException) {
+    public static function listAttachmentsOfMailId(string $email, string $id): array
+    {
+        $data = self::loadEmailJson($email, $id);
+        if ($data === null) {
             return [];
         }
 
@@ -250,18 +499,32 @@ class Mailbox
 
     public static function deleteEmail(string $email, string $id): bool
     {
+        SearchIndex::deleteMessage($email, $id);
+
+        if (SqliteStore::enabled()) {
+            return SqliteStore::deleteMessage($email, $id);
+        }
+
         $dir         = self::getDirForEmail($email);
         $attachments = self::listAttachmentsOfMailId($email, $id);
 
+        // every message has its own attachment links (their ids start with the message id)
         foreach ($attachments as $attachment) {
             @unlink($dir . DS . 'attachments' . DS . $attachment);
         }
 
+        self::removeFromIndex($dir, $id);
+        @unlink($dir . DS . $id . '.eml');
+
         return @unlink($dir . DS . $id . '.json');
     }
 
     public static function countEmailsOfAddress(string $email): int
     {
+        if (SqliteStore::enabled()) {
+            return SqliteStore::countMessages($email);
+        }
+
         $count = 0;
         $dir   = self::getDirForEmail($email);
 
@@ -277,6 +540,37 @@ class Mailbox
         return $count;
     }
 
+    /**
+     * Delete a mailbox with all its messages (and its webhook config).
+     */
+    public static function deleteMailbox(string $email): void
+    {
+        SearchIndex::deleteMailbox($email);
+
+        if (SqliteStore::enabled()) {
+            SqliteStore::deleteMailbox($email);
+        }
+
+        $dir = self::getDirForEmail($email);
+        if (is_dir($dir)) {
+            self::deleteTree($dir);
+        }
+    }
+
+    /**
+     * Unix time of the last delivery to a mailbox (or of its creation).
+     */
+    public static function lastActivity(string $email): ?int
+    {
+        if (SqliteStore::enabled()) {
+            return SqliteStore::lastActivity($email);
+        }
+
+        $mtime = @filemtime(self::getDirForEmail($email));
+
+        return $mtime === false ? null : $mtime;
+    }
+
     public static function deleteTree(string $dir): bool
     {
         if (!is_dir($dir)) {
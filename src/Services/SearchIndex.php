@@ -0,0 +1,159 @@
+<?php
+declare(strict_types=1);
+
+namespace OpenTrashmail\Services;
+
+use PDO;
+use PDOException;
+
+/**
+ * Full-text search over the index the mailserver builds at ingest
+ * ([GENERAL] SEARCH_INDEX=true, schema in python/search.py).
+ */
+class SearchIndex
+{
+    private const string DB_DIR  = '_db';
+    private const string DB_FILE = 'search.sqlite';
+
+    private const int MAX_TERMS = 16;
+
+    private static ?PDO $db = null;
+
+    public static function enabled(): bool
+    {
+        $settings = Settings::load();
+
+        return is_array($settings)
+            && filter_var($settings['SEARCH_INDEX'] ?? false, FILTER_VALIDATE_BOOLEAN);
+    }
+
+    private static function db(): ?PDO
+    {
+        if (self::$db !== null) {
+            return self::$db;
+        }
+
+        $file = ROOT . DS . 'data' . DS . self::DB_DIR . DS . self::DB_FILE;
+        if (!is_file($file)) {
+            return null;
+        }
+
+        try {
+            $db = new PDO('sqlite:' . $file, null, null, [
+                PDO::ATTR_ERRMODE            => PDO::ERRMODE_EXCEPTION,
+                PDO::ATTR_DEFAULT_FETCH_MODE => PDO::FETCH_ASSOC,
+            ]);
+            $db->exec('PRAGMA busy_timeout = 5000');
+        } catch (PDOException $e) {
+            error_log(sprintf('[OpenTrashmail] Cannot open search index "%s": %s', $file, $e->getMessage()));
+            return null;
+        }
+
+        self::$db = $db;
+
+        return $db;
+    }
+
+    /**
+     * FTS5 query for free text: every word has to occur, a trailing * matches
+     * words starting with it. Words are quoted, so FTS5 syntax in the input
+     * is searched for literally.
+     */
+    public static function matchExpression(string $query): ?string
+    {
+        $terms = [];
+        foreach (preg_split('/\s+/u', trim($query), -1, PREG_SPLIT_NO_EMPTY) ?: [] as $word) {
+            $prefix = str_ends_with($word, '*');
+            $word   = trim($word, '*');
+            if ($word === '') {
+                continue;
+            }
+
+            $terms[] = '"' . str_replace('"', '""', $word) . '"' . ($prefix ? '*' : '');
+            if (count($terms) >= self::MAX_TERMS) {
+                break;
+            }
+        }
+
+        return $terms === [] ? null : implode(' ', $terms);
+    }
+
+    /**
+     * Messages of a mailbox matching $query, best matches first.
+     *
+     * @return list<array{id: string, from: string, subject: string, snippet: string}>
+     */
+    public static function search(string $email, string $query, int $limit): array
+    {
+        $terms = self::matchExpression($query);
+        $db    = self::db();
+        if ($terms === null || $db === null) {
+            return [];
+        }
+
+        $mailbox = SqliteStore::mailboxName($email);
+        // the mailbox column narrows the match down, the join makes it exact
+        $match = 'mailbox : "' . $mailbox . '" AND {subject sender body} : (' . $terms . ')';
+
+        try {
+            $statement = $db->prepare(
+                "SELECT d.message_id, search.sender, search.subject,
+                        snippet(search, 3, '', '', '…', 16) AS snippet
+                 FROM search JOIN documents d ON d.id = search.rowid
+                 WHERE search MATCH ? AND d.mailbox = ?
+                 ORDER BY rank LIMIT ?"
+            );
+            $statement->execute([$match, $mailbox, $limit]);
+            $rows = $statement->fetchAll();
+        } catch (PDOException $e) {
+            error_log('[OpenTrashmail] Search failed: ' . $e->getMessage());
+            return [];
+        }
+
+        return array_map(static fn(array $row): array => [
+            'id'      => (string)$row['message_id'],
+            'from'    => (string)$row['sender'],
+            'subject' => (string)$row['subject'],
+            'snippet' => (string)$row['snippet'],
+        ], $rows);
+    }
+
+    public static function deleteMessage(string $email, string $id): void
+    {
+        self::delete('mailbox = ? AND message_id = ?', [SqliteStore::mailboxName($email), $id]);
+    }
+
+    public static function deleteMailbox(string $email): void
+    {
+        self::delete('mailbox = ?', [SqliteStore::mailboxName($email)]);
+    }
+
+    /**
+     * @param list<string> $params
+     */
+    private static function delete(string $where, array $params): void
+    {
+        $db = self::db();
+        if ($db === null) {
+            return;
+        }
+
+        try {
+            $db->beginTransaction();
+            $select = $db->prepare('SELECT id FROM documents WHERE ' . $where);
+            $select->execute($params);
+            $removeText     = $db->prepare('DELETE FROM search WHERE rowid = ?');
+            $removeDocument = $db->prepare('DELETE FROM documents WHERE id = ?');
+            foreach ($select->fetchAll(PDO::FETCH_COLUMN) as $documentId) {
+                $removeText->execute([$documentId]);
+                $removeDocument->execute([$documentId]);
+            }
+            $db->commit();
+        } catch (PDOException $e) {
+            if ($db->inTransaction()) {
+                $db->rollBack();
+            }
+            error_log('[OpenTrashmail] Cannot update search index: ' . $e->getMessage());
+        }
+    }
+}
@@ -0,0 +1,348 @@
+<?php
+declare(strict_types=1);
+
+namespace OpenTrashmail\Services;
+
+use PDO;
+use PDOException;
+
+/**
+ * Mailboxes in the SQLite storage backend ([GENERAL] STORAGE=sqlite, schema
+ * in python/storage.py). The mailserver creates the database; until it
+ * exists every mailbox is empty.
+ */
+class SqliteStore
+{
+    private const string DB_DIR  = '_db';
+    private const string DB_FILE = 'opentrashmail.sqlite';
+
+    private static ?PDO $db = null;
+
+    public static function enabled(): bool
+    {
+        $settings = Settings::load();
+
+        return is_array($settings)
+            && strtolower(trim((string)($settings['STORAGE'] ?? ''))) === 'sqlite';
+    }
+
+    private static function db(): ?PDO
+    {
+        if (self::$db !== null) {
+            return self::$db;
+        }
+
+        $file = ROOT . DS . 'data' . DS . self::DB_DIR . DS . self::DB_FILE;
+        if (!is_file($file)) {
+            return null;
+        }
+
+        try {
+            $db = new PDO('sqlite:' . $file, null, null, [
+                PDO::ATTR_ERRMODE            => PDO::ERRMODE_EXCEPTION,
+                PDO::ATTR_DEFAULT_FETCH_MODE => PDO::FETCH_ASSOC,
+            ]);
+            $db->exec('PRAGMA busy_timeout = 5000');
+            $db->exec('PRAGMA foreign_keys = ON');
+        } catch (PDOException $e) {
+            error_log(sprintf('[OpenTrashmail] Cannot open database "%s": %s', $file, $e->getMessage()));
+            return null;
+        }
+
+        self::$db = $db;
+
+        return $db;
+    }
+
+    /**
+     * Mailbox key of an address, the same as the mailserver derives it.
+     */
+    public static function mailboxName(string $email): string
+    {
+        return preg_replace('/[^a-z0-9@._-]+/', '_', strtolower($email)) ?? '';
+    }
+
+    /**
+     * @param list<scalar> $params
+     * @return list<array<string, mixed>>
+     */
+    private static function query(string $sql, array $params): array
+    {
+        $db = self::db();
+        if ($db === null) {
+            return [];
+        }
+
+        $statement = $db->prepare($sql);
+        $statement->execute($params);
+
+        return $statement->fetchAll();
+    }
+
+    /**
+     * Run $callback in a write transaction. BEGIN IMMEDIATE waits for other
+     * writers (busy_timeout) instead of failing when upgrading a read lock.
+     */
+    private static function write(callable $callback): bool
+    {
+        $db = self::db();
+        if ($db === null) {
+            return false;
+        }
+
+        $began = false;
+        try {
+            $db->exec('BEGIN IMMEDIATE');
+            $began = true;
+            $callback($db);
+            $db->exec('COMMIT');
+        } catch (PDOException $e) {
+            if ($began) {
+                try {
+                    $db->exec('ROLLBACK');
+                } catch (PDOException) {
+                }
+            }
+            error_log('[OpenTrashmail] Database write failed: ' . $e->getMessage());
+
+            return false;
+        }
+
+        return true;
+    }
+
+    public static function touchMailbox(string $email): void
+    {
+        $now = microtime(true);
+
+        self::write(static function (PDO $db) use ($email, $now): void {
+            $db->prepare(
+                'INSERT INTO mailboxes (address, created_at, updated_at) VALUES (?, ?, ?)
+                 ON CONFLICT (address) DO NOTHING'
+            )->execute([self::mailboxName($email), $now, $now]);
+        });
+    }
+
+    public static function lastActivity(string $email): ?int
+    {
+        $rows = self::query(
+            'SELECT updated_at FROM mailboxes WHERE address = ?',
+            [self::mailboxName($email)]
+        );
+
+        return $rows === [] ? null : (int)$rows[0]['updated_at'];
+    }
+
+    /**
+     * @return list<string>
+     */
+    public static function listMailboxes(): array
+    {
+        $rows = self::query('SELECT address FROM mailboxes ORDER BY address', []);
+
+        return array_values(array_filter(
+            array_column($rows, 'address'),
+            static fn($address) => filter_var($address, FILTER_VALIDATE_EMAIL) !== false
+        ));
+    }
+
+    public static function countMessages(string $email): int
+    {
+        $rows = self::query(
+            'SELECT count(*) AS n FROM recipients WHERE mailbox = ?',
+            [self::mailboxName($email)]
+        );
+
+        return $rows === [] ? 0 : (int)$rows[0]['n'];
+    }
+
+    public static function messageExists(string $email, string $id): bool
+    {
+        return self::query(
+            'SELECT 1 FROM recipients WHERE mailbox = ? AND message_id = ?',
+            [self::mailboxName($email), $id]
+        ) !== [];
+    }
+
+    /**
+     * Summaries of all messages of a mailbox, ordered by id.
+     *
+     * @return list<array<string, mixed>>
+     */
+    public static function listMessages(string $email, bool $includeBody, bool $includeAttachments): array
+    {
+        $mailbox = self::mailboxName($email);
+        $rows    = self::query(
+            'SELECT r.message_id, m.id, m.from_addr, m.subject, m.digest, m.size'
+            . ($includeBody ? ', m.body' : '')
+            . ' FROM recipients r JOIN messages m ON m.id = r.message
+             WHERE r.mailbox = ? ORDER BY r.message_id',
+            [$mailbox]
+        );
+
+        $attachments = [];
+        if ($includeAttachments) {
+            $attachmentRows = self::query(
+                'SELECT a.message, a.file_id FROM recipients r
+                 JOIN attachments a ON a.message = r.message
+                 WHERE r.mailbox = ? ORDER BY a.message, a.position',
+                [$mailbox]
+            );
+            foreach ($attachmentRows as $row) {
+                $attachments[(int)$row['message']][] = (string)$row['file_id'];
+            }
+        }
+
+        $result = [];
+        foreach ($rows as $row) {
+            $summary = [
+                'id'      => (string)$row['message_id'],
+                'from'    => (string)$row['from_addr'],
+                'subject' => (string)$row['subject'],
+                'md5'     => (string)$row['digest'],
+                'maillen' => (int)$row['size'],
+            ];
+            if ($includeBody) {
+                $summary['body'] = (string)$row['body'];
+            }
+            if ($includeAttachments) {
+                $summary['attachments'] = $attachments[(int)$row['id']] ?? [];
+            }
+            $result[] = $summary;
+        }
+
+        return $result;
+    }
+
+    /**
+     * A message in the shape of the file layout's <id>.json (with raw_ref).
+     *
+     * @return array<string, mixed>|null
+     */
+    public static function getMessage(string $email, string $id): ?array
+    {
+        $rows = self::query(
+            'SELECT m.* FROM recipients r JOIN messages m ON m.id = r.message
+             WHERE r.mailbox = ? AND r.message_id = ?',
+            [self::mailboxName($email), $id]
+        );
+        if ($rows === []) {
+            return null;
+        }
+        $message = $rows[0];
+
+        $settings = Settings::load();
+        $baseUrl  = is_array($settings) ? rtrim((string)($settings['URL'] ?? ''), '/') : '';
+        $address  = strtolower($email);
+        $htmlbody = (string)$message['htmlbody'];
+        $ids      = [];
+        $details  = [];
+
+        $attachmentRows = self::query(
+            'SELECT file_id, filename, cid, size, sha256 FROM attachments
+             WHERE message = ? ORDER BY position',
+            [(int)$message['id']]
+        );
+        foreach ($attachmentRows as $attachment) {
+            $fileId = (string)$attachment['file_id'];
+            $path   = '/api/attachment/' . $address . '/' . $fileId;
+
+            if ($attachment['cid'] !== null && $attachment['cid'] !== '') {
+                $htmlbody = str_replace('cid:' . $attachment['cid'], $path, $htmlbody);
+            }
+
+            $ids[]     = $fileId;
+            $details[] = [
+                'filename'     => (string)$attachment['filename'],
+                'cid'          => $attachment['cid'],
+                'id'           => $fileId,
+                'download_url' => $baseUrl . $path,
+                'size'         => (int)$attachment['size'],
+                'sha256'       => (string)$attachment['sha256'],
+            ];
+        }
+
+        $rcpts = json_decode((string)$message['rcpts'], true);
+
+        return [
+            'sender_ip' => (string)$message['sender_ip'],
+            'from'      => (string)$message['from_addr'],
+            'rcpts'     => is_array($rcpts) ? $rcpts : [],
+            'raw_ref'   => (string)$message['raw_ref'],
+            'parsed'    => [
+                'subject'             => (string)$message['subject'],
+                'body'                => (string)$message['body'],
+                'htmlbody'            => $htmlbody,
+                'from'                => (string)$message['from_addr'],
+                'attachments'         => $ids,
+                'attachments_details' => $details,
+            ],
+        ];
+    }
+
+    /**
+     * Content hash of an attachment delivered to this mailbox, null if unknown.
+     */
+    public static function attachmentSha256(string $email, string $fileId): ?string
+    {
+        $rows = self::query(
+            'SELECT a.sha256 FROM attachments a
+             JOIN recipients r ON r.message = a.message
+             WHERE a.file_id = ? AND r.mailbox = ? LIMIT 1',
+            [$fileId, self::mailboxName($email)]
+        );
+
+        return $rows === [] ? null : (string)$rows[0]['sha256'];
+    }
+
+    /**
+     * Remove a message from a mailbox, and the message itself once no
+     * mailbox has it any more. Its stored files are left to the cleanup.
+     */
+    public static function deleteMessage(string $email, string $id): bool
+    {
+        $mailbox = self::mailboxName($email);
+        $deleted = false;
+
+        $ok = self::write(static function (PDO $db) use ($mailbox, $id, &$deleted): void {
+            $select = $db->prepare('SELECT message FROM recipients WHERE mailbox = ? AND message_id = ?');
+            $select->execute([$mailbox, $id]);
+            $message = $select->fetchColumn();
+            if ($message === false) {
+                return;
+            }
+
+            $db->prepare('DELETE FROM recipients WHERE mailbox = ? AND message_id = ?')
+                ->execute([$mailbox, $id]);
+            $db->prepare(
+                'DELETE FROM messages WHERE id = ?
+                 AND NOT EXISTS (SELECT 1 FROM recipients WHERE message = ?)'
+            )->execute([$message, $message]);
+            $deleted = true;
+        });
+
+        return $ok && $deleted;
+    }
+
+    public static function deleteMailbox(string $email): void
+    {
+        $mailbox = self::mailboxName($email);
+
+        self::write(static function (PDO $db) use ($mailbox): void {
+            $select = $db->prepare('SELECT DISTINCT message FROM recipients WHERE mailbox = ?');
+            $select->execute([$mailbox]);
+            $messages = $select->fetchAll(PDO::FETCH_COLUMN);
+
+            $db->prepare('DELETE FROM recipients WHERE mailbox = ?')->execute([$mailbox]);
+            $db->prepare('DELETE FROM mailboxes WHERE address = ?')->execute([$mailbox]);
+
+            $orphan = $db->prepare(
+                'DELETE FROM messages WHERE id = ?
+                 AND NOT EXISTS (SELECT 1 FROM recipients WHERE message = ?)'
+            );
+            foreach ($messages as $message) {
+                $orphan->execute([$message, $message]);
+            }
+        });
+    }
+}
@@ -37,8 +37,11 @@ class Webhook
 
         $dir = Mailbox::getDirForEmail($email);
 
-        if (!is_dir($dir) && !mkdir($dir, 0o755, true) && !is_dir($dir)) {
-            return false;
+        if (!is_dir($dir)) {
+            if (!mkdir($dir, 0o755, true) && !is_dir($dir)) {
+                return false;
+            }
+            Mailbox::registerMailboxExpiry($dir);
         }
 
         $webhookFile = $dir . \DS . 'webhook.json';
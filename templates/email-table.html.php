@@ -1,6 +1,7 @@
 <?php
 declare(strict_types=1);
 
+use OpenTrashmail\Services\Mailbox;
 use OpenTrashmail\Utils\View;
 
 $email      = isset($email) ? (string)$email : '';
@@ -85,7 +86,7 @@ $colspanEmails = $isadmin ? 6 : 5;
 
         <?php $i = 0; ?>
 
-        <?php foreach ($emails as $unixtime => $ed): ?>
+        <?php foreach ($emails as $mailid => $ed): ?>
             <?php
             $i++;
             $rowEmail   = isset($ed['email']) ? (string)$ed['email'] : $email;
@@ -94,7 +95,7 @@ $colspanEmails = $isadmin ? 6 : 5;
             $rowIdEsc    = View::escape($rowId);
             $fromEsc     = View::escape((string)($ed['from'] ?? ''));
             $subjectEsc  = View::escape((string)($ed['subject'] ?? ''));
-            $tsNumeric   = is_numeric((string)$unixtime) ? (int)$unixtime : 0;
+            $receivedAt  = Mailbox::receivedAt((string)$mailid);
             ?>
             <tr>
                 <th scope="row" class="otm-row-index"><?= $i ?></th>
@@ -103,7 +104,7 @@ $colspanEmails = $isadmin ? 6 : 5;
                         (function () {
                             var el = document.getElementById('date-td-<?= $i ?>');
                             if (!el || typeof moment === 'undefined') return;
-                            el.innerHTML = moment.unix(<?= $tsNumeric ?> / 1000)
+                            el.innerHTML = moment(<?= $receivedAt ?>)
                                 .format(<?= $dateformatJs ?>);
                         })();
                     </script>
@@ -269,6 +270,37 @@ $colspanEmails = $isadmin ? 6 : 5;
                             </div>
                         </div>
 
+                        <div class="uk-margin">
+                            <label class="uk-form-label">
+                                <input class="uk-checkbox" type="checkbox" id="batchEnabled" name="batch_enabled"/>
+                                <span class="uk-margin-small-left">Send webhooks in batches</span>
+                            </label>
+                            <div class="uk-text-meta uk-margin-small-top">
+                                Emails arriving within the batch window are sent together as one JSON array
+                                of payloads, signed once.
+                            </div>
+                        </div>
+
+                        <div class="uk-margin">
+                            <label for="batchWindow" class="uk-form-label">
+                                Batch Window (ms)
+                            </label>
+                            <div class="uk-form-controls">
+                                <input type="number" class="uk-input" id="batchWindow" name="batch_window_ms"
+                                       min="10" max="60000" value="1000"/>
+                            </div>
+                        </div>
+
+                        <div class="uk-margin">
+                            <label for="batchMaxSize" class="uk-form-label">
+                                Max Batch Size
+                            </label>
+                            <div class="uk-form-controls">
+                                <input type="number" class="uk-input" id="batchMaxSize" name="batch_max_size"
+                                       min="1" max="1000" value="100"/>
+                            </div>
+                        </div>
+
                     </div>
                 </li>
             </ul>
@@ -469,6 +501,12 @@ $colspanEmails = $isadmin ? 6 : 5;
                     (currentWebhookConfig.retry_config && currentWebhookConfig.retry_config.backoff_multiplier) || 2;
                 document.getElementById('secretKey').value =
                     currentWebhookConfig.secret_key || '';
+                document.getElementById('batchEnabled').checked =
+                    (currentWebhookConfig.batch_config && currentWebhookConfig.batch_config.enabled) || false;
+                document.getElementById('batchWindow').value =
+                    (currentWebhookConfig.batch_config && currentWebhookConfig.batch_config.window_ms) || 1000;
+                document.getElementById('batchMaxSize').value =
+                    (currentWebhookConfig.batch_config && currentWebhookConfig.batch_config.max_size) || 100;
             }
         } catch (error) {
             console.error('Error loading webhook config:', error);
@@ -486,7 +524,10 @@ $colspanEmails = $isadmin ? 6 : 5;
             payload_template: formData.get('payload_template') || '',
             max_attempts: parseInt(formData.get('max_attempts'), 10),
             backoff_multiplier: parseFloat(formData.get('backoff_multiplier')),
-            secret_key: formData.get('secret_key') || ''
+            secret_key: formData.get('secret_key') || '',
+            batch_enabled: formData.get('batch_enabled') === 'on',
+            batch_window_ms: parseInt(formData.get('batch_window_ms'), 10),
+            batch_max_size: parseInt(formData.get('batch_max_size'), 10)
         };
 
         try {
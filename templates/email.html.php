@@ -1,6 +1,7 @@
 <?php
 declare(strict_types=1);
 
+use OpenTrashmail\Services\Mailbox;
 use OpenTrashmail\Utils\View;
 
 $emailData = isset($emailData) && is_array($emailData) ? $emailData : [];
@@ -43,7 +44,7 @@ $dateformatJs = json_encode($dateformat, JSON_UNESCAPED_SLASHES | JSON_UNESCAPED
 $emailJs = json_encode($email, JSON_UNESCAPED_SLASHES | JSON_UNESCAPED_UNICODE);
 $mailidJs = json_encode($mailid, JSON_UNESCAPED_SLASHES | JSON_UNESCAPED_UNICODE);
 
-$mailidNumeric = is_numeric($mailid) ? $mailid : '0';
+$receivedAt = Mailbox::receivedAt($mailid);
 ?>
 
 <nav aria-label="breadcrumb" class="uk-margin-small-bottom">
@@ -79,7 +80,7 @@ $mailidNumeric = is_numeric($mailid) ? $mailid : '0';
                         if (!el || typeof moment === 'undefined') {
                             return;
                         }
-                        el.innerHTML = moment.unix(<?= $mailidNumeric ?> / 1000)
+                        el.innerHTML = moment(<?= $receivedAt ?>)
                             .format(<?= $dateformatJs ?>);
                     })();
                 </script>
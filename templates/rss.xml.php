@@ -46,10 +46,7 @@ $formatRfc2822 = static fn (int $timestamp): string => new \DateTimeImmutable()
             $rcpts = is_array($data['rcpts'] ?? null) ? $data['rcpts'] : [];
             $from = (string) ($d['from'] ?? '');
 
-            $timestamp = 0;
-            if ($id !== '' && ctype_digit($id) && strlen($id) > 3) {
-                $timestamp = (int) substr($id, 0, -3);
-            }
+            $timestamp = intdiv(Mailbox::receivedAt($id), 1000);
 
             $attLinks = [];
             foreach ($attachments as $filenameRaw) {
@@ -0,0 +1,199 @@
+"""
+Admission control and spooling of the SMTP listener. Run with: python -m pytest tests
+"""
+import asyncio
+import contextlib
+import os
+import smtplib
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import metrics  # noqa: E402
+from admission import BUSY, NO_RESOURCES, TOO_LARGE, Admission, RateLimiter  # noqa: E402
+from spooling_smtp import SpoolingSMTP  # noqa: E402
+
+
+def rejected(reason: str) -> float:
+    return metrics.ADMISSION_REJECTED.labels(reason).value
+
+
+def test_concurrency_limit():
+    admission = Admission(max_data=2)
+    assert admission.start_data() is None
+    assert admission.start_data() is None
+    before = rejected("concurrency")
+    assert admission.start_data() == BUSY
+    assert rejected("concurrency") == before + 1
+
+    admission.end_data(0)
+    assert admission.start_data() is None
+    assert admission.data_active == 2
+
+
+def test_declared_size_selects_451_or_552():
+    admission = Admission(max_bytes=1000)
+    before = rejected("size"), rejected("bytes")
+    # can never fit: permanent
+    assert admission.start_data(1001) == TOO_LARGE
+    assert admission.data_active == 0
+
+    assert admission.start_data(600) is None
+    assert admission.hold(600, 600) is None
+    # fits once the other message is done: try again later
+    assert admission.start_data(600) == NO_RESOURCES
+    assert (rejected("size"), rejected("bytes")) == (before[0] + 1, before[1] + 1)
+
+    admission.end_data(600)
+    assert admission.bytes_in_flight == 0
+    assert admission.start_data(600) is None
+
+
+def test_undeclared_size_selects_451_or_552():
+    admission = Admission(max_bytes=1000)
+    admission.start_data()
+    admission.start_data()
+    assert admission.hold(500, 500) is None
+    # the two messages together are over the limit
+    assert admission.hold(600, 600) == NO_RESOURCES
+    # this one alone is
+    assert admission.hold(500, 1100) == TOO_LARGE
+    assert admission.bytes_in_flight == 1600
+
+    admission.release(1600)
+    assert admission.bytes_in_flight == 0
+
+
+def test_rate_limiter_refills():
+    limiter = RateLimiter(60, burst=2)
+    assert limiter.allow("10.0.0.1", now=0)
+    assert limiter.allow("10.0.0.1", now=0)
+    assert not limiter.allow("10.0.0.1", now=0)
+    assert limiter.allow("10.0.0.2", now=0)
+    assert limiter.limited_keys(now=0) == 1
+    # one token a second
+    assert limiter.allow("10.0.0.1", now=1)
+    assert not limiter.allow("10.0.0.1", now=1)
+
+
+class Handler:
+    def __init__(self) -> None:
+        self.received: list[tuple[bytes | None, str | None, bytes]] = []
+        self.release = asyncio.Event()
+        self.release.set()
+        self.fail = False
+
+    async def handle_DATA(self, server, session, envelope):
+        content = envelope.content
+        spooled = None
+        if envelope.spool_path is not None:
+            with open(envelope.spool_path, "rb") as f:
+                spooled = f.read()
+        self.received.append((content, envelope.spool_path, spooled))
+        await self.release.wait()
+        if self.fail:
+            raise RuntimeError("handler failed")
+        return "250 OK"
+
+
+@contextlib.asynccontextmanager
+async def serve(handler, **kwargs):
+    server = await asyncio.get_running_loop().create_server(
+        lambda: SpoolingSMTP(handler, **kwargs), "127.0.0.1", 0
+    )
+    try:
+        yield server.sockets[0].getsockname()[1]
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+def message(size: int) -> bytes:
+    line = b"x" * 70 + b"\r\n"
+    return b"Subject: test\r\n\r\n" + line * (size // len(line))
+
+
+def send(port: int, content: bytes, size: int | None = None) -> tuple[int, bytes]:
+    """MAIL (with SIZE=size), RCPT and DATA; the status of DATA or of the message."""
+    with smtplib.SMTP("127.0.0.1", port) as client:
+        client.ehlo()
+        client.mail("a@example.com", [f"SIZE={size}"] if size is not None else [])
+        client.rcpt("b@example.com")
+        code, reply = client.docmd("DATA")
+        if code != 354:
+            return code, reply
+        # content ends with CRLF
+        client.send(content.replace(b"\r\n.", b"\r\n..") + b".\r\n")
+        return client.getreply()
+
+
+def test_large_message_is_spooled_and_removed(tmp_path):
+    handler = Handler()
+    admission = Admission(max_bytes=100_000)
+    content = message(200_000)
+
+    async def main():
+        async with serve(
+            handler, spool_threshold=10_000, spool_dir=str(tmp_path), admission=admission
+        ) as port:
+            return await asyncio.to_thread(send, port, content)
+
+    code, _ = asyncio.run(main())
+    assert code == 250
+    ((in_memory, spool_path, spooled),) = handler.received
+    assert in_memory is None and spool_path.startswith(str(tmp_path))
+    assert spooled == content
+    assert os.listdir(tmp_path) == []
+    assert admission.bytes_in_flight == 0 and admission.data_active == 0
+
+
+def test_bytes_are_released_after_success_and_failure(tmp_path):
+    handler = Handler()
+    admission = Admission(max_bytes=100_000)
+
+    async def main():
+        async with serve(handler, spool_dir=str(tmp_path), admission=admission) as port:
+            ok = await asyncio.to_thread(send, port, message(50_000))
+            handler.fail = True
+            failed = await asyncio.to_thread(send, port, message(50_000))
+            return ok[0], failed[0]
+
+    assert asyncio.run(main()) == (250, 500)
+    assert admission.bytes_in_flight == 0 and admission.data_active == 0
+
+
+def test_status_of_messages_over_the_byte_limit(tmp_path):
+    handler = Handler()
+    admission = Admission(max_bytes=10_000)
+
+    async def main():
+        async with serve(handler, spool_dir=str(tmp_path), admission=admission) as port:
+            declared = await asyncio.to_thread(send, port, message(100), 20_000)
+            undeclared = await asyncio.to_thread(send, port, message(20_000))
+            return declared, undeclared
+
+    declared, undeclared = asyncio.run(main())
+    assert declared == (552, TOO_LARGE[4:].encode())
+    assert undeclared == (552, TOO_LARGE[4:].encode())
+    assert handler.received == []
+    assert admission.bytes_in_flight == 0 and admission.data_active == 0
+
+
+def test_data_over_the_concurrency_limit_gets_451(tmp_path):
+    handler = Handler()
+    handler.release.clear()
+    admission = Admission(max_data=1)
+
+    async def main():
+        async with serve(handler, spool_dir=str(tmp_path), admission=admission) as port:
+            first = asyncio.create_task(asyncio.to_thread(send, port, message(100)))
+            while not handler.received:
+                await asyncio.sleep(0.01)
+            second = await asyncio.to_thread(send, port, message(100))
+            handler.release.set()
+            return await first, second
+
+    first, second = asyncio.run(main())
+    assert first[0] == 250
+    assert second == (451, BUSY[4:].encode())
+    assert admission.data_active == 0
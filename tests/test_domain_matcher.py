@@ -0,0 +1,78 @@
+"""
+DomainMatcher against the DOMAINS loop it replaces. Run with: python -m pytest tests
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+from mailserver3 import DomainMatcher  # noqa: E402
+
+DOMAINS = ["domain.tld", " spaced.tld ", "", "*.mydom.com", "*example.org", "mail.*.net"]
+
+
+def loop_match(domains: list[str], domain: str) -> bool:
+    """The lookup DomainMatcher replaces, as handle_DATA used to do it."""
+    for x in domains:
+        x = x.strip()
+        if not x:
+            continue
+        if "*" in x and domain.endswith(x.replace("*", "")):
+            return True
+        if domain == x:
+            return True
+    return False
+
+
+@pytest.mark.parametrize(
+    "domain",
+    [
+        "domain.tld",
+        "sub.domain.tld",
+        "spaced.tld",
+        "a.mydom.com",
+        "a.b.mydom.com",
+        "mydom.com",
+        "xmydom.com",
+        "example.org",
+        "myexample.org",
+        "example.org.evil",
+        "mail..net",
+        "x.mail..net",
+        "mail.x.net",
+        "",
+        "tld",
+    ],
+)
+def test_agrees_with_the_loop(domain):
+    assert DomainMatcher(DOMAINS).match(domain) == loop_match(DOMAINS, domain)
+
+
+def test_wildcard_alone_matches_everything():
+    matcher = DomainMatcher(["*"])
+    assert matcher.match("anything.tld") and matcher.match("")
+
+
+def test_no_domains_match_nothing():
+    assert not DomainMatcher([]).match("domain.tld")
+
+
+def test_agrees_with_the_loop_on_random_domains():
+    rng = random.Random(1)
+    labels = ["a", "b", "ab", "ba", "x"]
+
+    def name() -> str:
+        return ".".join(rng.choice(labels) for _ in range(rng.randint(1, 3)))
+
+    for _ in range(200):
+        domains = [
+            rng.choice(["", "*", "*.", "x*"]) + name() if rng.random() < 0.5 else name()
+            for _ in range(rng.randint(0, 6))
+        ]
+        matcher = DomainMatcher(domains)
+        for _ in range(20):
+            domain = name()
+            assert matcher.match(domain) == loop_match(domains, domain), (domains, domain)
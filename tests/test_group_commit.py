@@ -0,0 +1,113 @@
+"""
+GroupCommit in the three FSYNC modes. Run with: python -m pytest tests
+"""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import group_commit  # noqa: E402
+from group_commit import GroupCommit  # noqa: E402
+
+
+@pytest.fixture
+def synced(monkeypatch) -> list[str]:
+    paths = []
+    real = group_commit.fsync_path
+
+    def fsync_path(path: str) -> None:
+        paths.append(path)
+        real(path)
+
+    monkeypatch.setattr(group_commit, "fsync_path", fsync_path)
+    return paths
+
+
+@pytest.fixture
+def committer(request):
+    committer = GroupCommit(request.param, window=0.2)
+    committer.start()
+    yield committer
+    committer.stop()
+
+
+@pytest.mark.parametrize("committer", group_commit.MODES, indirect=True)
+def test_files_are_visible_only_after_the_rename(tmp_path, committer, synced):
+    path = tmp_path / "1.json"
+    batch = committer.begin()
+    batch.write(str(path), b"new")
+    batch.append(str(tmp_path / "index.jsonl"), b"line\n")
+    # written under a temporary name, nothing is visible yet
+    assert all(name.endswith(".tmp") for name in os.listdir(tmp_path))
+
+    future = batch.commit()
+    if committer.mode == "batch":
+        # waits for the window to collect other batches
+        assert not path.exists()
+    future.result(timeout=5)
+
+    assert path.read_bytes() == b"new"
+    assert (tmp_path / "index.jsonl").read_bytes() == b"line\n"
+    assert sorted(os.listdir(tmp_path)) == ["1.json", "index.jsonl"]
+    if committer.mode == "none":
+        assert synced == []
+    else:
+        # the file before its rename, then the appended file and the directory
+        assert synced[0].endswith(".tmp")
+        assert str(tmp_path / "index.jsonl") in synced and str(tmp_path) in synced
+
+
+def test_batch_mode_syncs_each_directory_once_per_batch(tmp_path, synced):
+    committer = GroupCommit("batch", window=0.2)
+    committer.start()
+    try:
+        futures = []
+        lock = threading.Lock()
+
+        def submit(i: int) -> None:
+            batch = committer.begin()
+            batch.write(str(tmp_path / f"{i}.json"), b"%d" % i)
+            with lock:
+                futures.append(batch.commit())
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for future in futures:
+            future.result(timeout=5)
+    finally:
+        committer.stop()
+
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{i}.json" for i in range(10))
+    assert synced.count(str(tmp_path)) == 1
+    assert len([path for path in synced if path.endswith(".tmp")]) == 10
+
+
+def test_publish_keeps_an_existing_blob(tmp_path):
+    committer = GroupCommit("always")
+    blob = tmp_path / "blob"
+    for data in (b"first", b"second"):
+        batch = committer.begin()
+        batch.publish(str(blob), data)
+        batch.link(str(blob), str(tmp_path / f"link-{data.decode()}"))
+        batch.commit().result()
+
+    assert blob.read_bytes() == b"first"
+    assert os.stat(blob).st_nlink == 3
+    assert sorted(os.listdir(tmp_path)) == ["blob", "link-first", "link-second"]
+
+
+def test_failed_batch_leaves_no_temporary_files(tmp_path):
+    committer = GroupCommit("always")
+    batch = committer.begin()
+    batch.write(str(tmp_path / "1.json"), b"data")
+    batch.link(str(tmp_path / "missing"), str(tmp_path / "link"))
+    with pytest.raises(FileNotFoundError):
+        batch.commit().result()
+    # the rename before the failed link was applied, nothing else is left over
+    assert os.listdir(tmp_path) == ["1.json"]
@@ -0,0 +1,91 @@
+"""
+Message ids of the mailserver. Run with: python -m pytest tests
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import mailserver3  # noqa: E402
+from mailserver3 import MessageIds  # noqa: E402
+
+
+def received_at(message_id: str) -> int:
+    """Mailbox::receivedAt() of the web UI: the first 13 digits, in milliseconds."""
+    return int(message_id[:13]) if message_id.isdigit() else 0
+
+
+def test_ids_are_unique_and_increasing_per_worker():
+    workers = [MessageIds(worker_id) for worker_id in range(4)]
+    ids: dict[int, list[str]] = {worker_id: [] for worker_id in range(4)}
+
+    def generate(worker_id: int) -> None:
+        for _ in range(5000):
+            ids[worker_id].append(workers[worker_id].next())
+
+    threads = [threading.Thread(target=generate, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    everything = [message_id for worker_ids in ids.values() for message_id in worker_ids]
+    assert len(set(everything)) == len(everything)
+    for worker_id, worker_ids in ids.items():
+        assert all(len(message_id) == 19 and message_id.isdigit() for message_id in worker_ids)
+        assert all(message_id[13:15] == f"{worker_id:02d}" for message_id in worker_ids)
+        assert [int(message_id) for message_id in worker_ids] == sorted(
+            int(message_id) for message_id in set(worker_ids)
+        )
+
+
+def test_threads_of_one_worker_share_the_sequence():
+    ids = MessageIds(3)
+    generated = []
+    lock = threading.Lock()
+
+    def generate() -> None:
+        for _ in range(2000):
+            message_id = ids.next()
+            with lock:
+                generated.append(message_id)
+
+    threads = [threading.Thread(target=generate) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(generated)) == 8000
+
+
+def test_ids_sort_by_receive_time_across_workers():
+    before = time.time_ns() // 1_000_000
+    generated = [MessageIds(worker_id % 3).next() for worker_id in range(30)]
+    after = time.time_ns() // 1_000_000
+
+    times = [received_at(message_id) for message_id in generated]
+    assert times == sorted(times)
+    assert before <= times[0] and times[-1] <= after
+    # newer than the plain millisecond ids of older versions
+    assert int(generated[0]) > int(str(after))
+
+
+def test_clock_stepping_back_and_sequence_overflow(monkeypatch):
+    clock = [1_700_000_000_000 * 1_000_000]
+    monkeypatch.setattr(mailserver3.time, "time_ns", lambda: clock[0])
+    ids = MessageIds(1)
+
+    first = ids.next()
+    clock[0] -= 5_000 * 1_000_000
+    stepped_back = ids.next()
+    assert int(stepped_back) > int(first)
+    assert received_at(stepped_back) == received_at(first)
+
+    generated = [ids.next() for _ in range(10_000)]
+    assert int(generated[0]) > int(stepped_back)
+    # the 10000 ids of the millisecond are used up: the next one is borrowed
+    assert received_at(generated[-1]) == received_at(first) + 1
+    assert generated[-3].endswith("9999") and generated[-2].endswith("0000")
+    assert len(set(generated)) == len(generated)
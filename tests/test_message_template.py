@@ -0,0 +1,106 @@
+"""
+MessageTemplate against the per-recipient serialization it replaces. Run with:
+python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+from message_template import MessageTemplate  # noqa: E402
+
+URL = "https://mail.example.com"
+
+# (filename, cid, id)
+ATTACHMENTS = [
+    ("logo.png", "logo@example", "1_aa_logo.png"),
+    ("Bericht ü.pdf", "part2.0304@mail", "1_bb_Bericht_.pdf"),
+    ("no-cid.txt", None, "1_cc_no-cid.txt"),
+]
+HTML = (
+    '<p>Grüße ☃ "quoted" \\ back</p><img src="cid:logo@example">'
+    '<a href="cid:part2.0304@mail">pdf</a><img src="cid:logo@example"><p>cid:unknown</p>'
+)
+RECIPIENTS = ["plain@example.com", 'we"ird\\name@example.com', "ünicode@exämple.com"]
+
+
+def savedata(html: str = HTML, attachments=ATTACHMENTS) -> dict:
+    return {
+        "sender_ip": "127.0.0.1",
+        "from": "Sender <sender@example.com>",
+        "rcpts": RECIPIENTS,
+        "raw_ref": "0" * 64,
+        "parsed": {
+            "subject": "Test ☃",
+            "body": "plain text",
+            "htmlbody": html,
+            "from": "Sender <sender@example.com>",
+            "attachments": [fid for _, _, fid in attachments],
+            "attachments_details": [
+                {
+                    "filename": filename,
+                    "cid": cid,
+                    "id": fid,
+                    "download_url": None,
+                    "size": 10,
+                    "sha256": "f" * 64,
+                }
+                for filename, cid, fid in attachments
+            ],
+        },
+    }
+
+
+def per_recipient(data: dict, email: str, attachments=ATTACHMENTS) -> dict:
+    """How every copy used to be built: cid: references replaced one by one."""
+    html = data["parsed"]["htmlbody"]
+    for _, cid, fid in attachments:
+        if cid:
+            html = html.replace(f"cid:{cid}", f"/api/attachment/{email}/{fid}")
+    parsed = dict(data["parsed"], htmlbody=html)
+    parsed["attachments_details"] = [
+        dict(details, download_url=f"{URL}/api/attachment/{email}/{details['id']}")
+        for details in data["parsed"]["attachments_details"]
+    ]
+    return dict(data, parsed=parsed)
+
+
+def template(data: dict, attachments=ATTACHMENTS) -> MessageTemplate:
+    return MessageTemplate(data, {cid: fid for _, cid, fid in attachments if cid}, URL)
+
+
+@pytest.mark.parametrize("email", RECIPIENTS)
+def test_render_is_byte_identical_to_per_recipient_serialization(email):
+    data = savedata()
+    message = template(data)
+    expected = per_recipient(data, email)
+    assert message.for_mailbox(email) == expected
+    assert message.render(email) == json.dumps(expected, ensure_ascii=False).encode("utf-8")
+
+
+def test_message_without_html_or_attachments():
+    data = savedata(html="", attachments=[])
+    message = template(data, [])
+    for email in RECIPIENTS:
+        expected = per_recipient(data, email, [])
+        assert message.render(email) == json.dumps(expected, ensure_ascii=False).encode("utf-8")
+
+
+def test_savedata_is_left_mailbox_independent():
+    data = savedata()
+    template(data).render(RECIPIENTS[0])
+    assert data["parsed"]["htmlbody"] == HTML
+    assert all(d["download_url"] is None for d in data["parsed"]["attachments_details"])
+
+
+def test_cid_that_is_a_prefix_of_another():
+    attachments = [("a.png", "img", "1_aa_a.png"), ("b.png", "img2", "1_bb_b.png")]
+    data = savedata('<img src="cid:img2"><img src="cid:img">', attachments)
+    html = template(data, attachments).for_mailbox("a@example.com")["parsed"]["htmlbody"]
+    assert html == (
+        '<img src="/api/attachment/a@example.com/1_bb_b.png">'
+        '<img src="/api/attachment/a@example.com/1_aa_a.png">'
+    )
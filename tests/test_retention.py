@@ -0,0 +1,104 @@
+"""
+Retention of the files storage. Run with: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+import time
+from email.message import EmailMessage
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import mailserver3  # noqa: E402
+from retention import ATTACHMENT_STORE, Retention  # noqa: E402
+
+MAILBOX = "shared@example.com"
+
+
+def attachment_message(subject: str) -> bytes:
+    msg = EmailMessage()
+    msg["From"] = "sender@example.com"
+    msg["To"] = MAILBOX
+    msg["Subject"] = subject
+    msg.set_content("see attachment")
+    msg.add_attachment(b"same content\n" * 100, maintype="text", subtype="plain", filename="a.txt")
+    return msg.as_bytes()
+
+
+async def deliver(content: bytes) -> None:
+    handler = mailserver3.CustomHandler("Test", None, None)
+    session = type("Session", (), {"peer": ("127.0.0.1", 0)})()
+    envelope = type(
+        "Envelope", (), {"mail_from": "sender@example.com", "rcpt_tos": [MAILBOX], "content": content}
+    )()
+    await handler.handle_DATA(None, session, envelope)
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(mailserver3, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(mailserver3, "URL", "http://localhost")
+    monkeypatch.setattr(mailserver3, "_storage", None)
+    monkeypatch.setattr(mailserver3, "_group_commit", None)
+    return tmp_path
+
+
+def stored_ids(data_dir) -> list[str]:
+    return sorted(p.name[:-5] for p in (data_dir / MAILBOX).glob("*.json") if p.name[:-5].isdigit())
+
+
+def test_expiring_a_message_keeps_attachments_shared_with_others(data_dir):
+    tmp_path = data_dir
+    asyncio.run(deliver(attachment_message("first")))
+    asyncio.run(deliver(attachment_message("second")))
+
+    email_dir = tmp_path / MAILBOX
+    first, second = sorted(p.name[:-5] for p in email_dir.glob("*.json") if p.name[:-5].isdigit())
+    # every message links the shared blob under its own name
+    first_link, second_link = sorted(os.listdir(email_dir / "attachments"))
+    assert first_link.startswith(first + "_") and second_link.startswith(second + "_")
+
+    retention = Retention(str(tmp_path), 60, 0)
+    later = time.time() + 3600
+    retention.expire_messages(MAILBOX, {first}, later)
+    retention.sweep_blobs(time.time() + 3600)
+
+    assert not (email_dir / f"{first}.json").exists()
+    assert (email_dir / f"{second}.json").exists()
+    assert os.listdir(email_dir / "attachments") == [second_link]
+    assert len(os.listdir(tmp_path / ATTACHMENT_STORE)) == 1
+
+    retention.expire_messages(MAILBOX, {second}, later)
+    retention.sweep_blobs(time.time() + 3600)
+
+    assert os.listdir(email_dir / "attachments") == []
+    assert os.listdir(tmp_path / ATTACHMENT_STORE) == []
+
+
+def test_messages_stored_before_expiry_was_enabled_expire(data_dir):
+    asyncio.run(deliver(attachment_message("before")))
+    now = time.time()
+    Retention(str(data_dir), 0, 0).run_once(now)
+    assert len(stored_ids(data_dir)) == 1
+
+    # enabling DELETE_OLDER_THAN_DAYS registers what is already stored
+    Retention(str(data_dir), 60, 0).run_once(now + 3600)
+    assert stored_ids(data_dir) == []
+
+
+def test_raising_the_age_reschedules_registered_messages(data_dir):
+    asyncio.run(deliver(attachment_message("kept")))
+    (message_id,) = stored_ids(data_dir)
+    now = time.time()
+    Retention(str(data_dir), 60, 0).run_once(now)
+
+    # the entry of the old age is due, but the message is younger than the new one
+    retention = Retention(str(data_dir), 7200, 0)
+    retention.run_once(now + 3600)
+    assert stored_ids(data_dir) == [message_id]
+    assert retention.stats["rescheduled"] == 1
+
+    Retention(str(data_dir), 7200, 0).run_once(now + 7300)
+    assert stored_ids(data_dir) == []
@@ -0,0 +1,120 @@
+"""
+Per-host webhook limits and circuit breaker. Run with: python -m pytest tests
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+from webhook_destinations import CLOSED, HALF_OPEN, OPEN, Destinations  # noqa: E402
+from webhook_spool import Parked, WebhookSpool  # noqa: E402
+
+URL = "https://hooks.example.com/a"
+COOLDOWN = 0.05
+
+
+def park(destination, woken: list) -> None:
+    with pytest.raises(Parked) as parked:
+        destination.acquire()
+    parked.value.wake_up(lambda: woken.append(len(woken)))
+
+
+def test_concurrency_is_limited_per_host():
+    destinations = Destinations(max_active=2)
+    destination = destinations.get(URL)
+    assert destinations.get("HTTPS://Hooks.Example.com/b") is destination
+    assert destinations.get("https://other.example.com/") is not destination
+
+    destination.acquire()
+    destination.acquire()
+    woken = []
+    park(destination, woken)
+    park(destination, woken)
+    destinations.get("https://other.example.com/").acquire()
+    assert destinations.parked() == 2
+
+    destination.release(True)
+    assert woken == [0]
+    destination.release(True)
+    assert woken == [0, 1]
+    assert destination.state == CLOSED
+
+
+def test_circuit_opens_probes_and_closes():
+    async def main():
+        destination = Destinations(threshold=2, cooldown=COOLDOWN).get(URL)
+        woken = []
+        for _ in range(2):
+            assert destination.acquire() is False
+            destination.release(False)
+        assert destination.state == OPEN
+        park(destination, woken)
+        park(destination, woken)
+
+        await asyncio.sleep(COOLDOWN * 2)
+        assert destination.state == HALF_OPEN
+        # only one of the parked jobs is let through as the probe
+        assert woken == [0]
+        assert destination.acquire() is True
+        park(destination, woken)
+
+        destination.release(True, True)
+        assert destination.state == CLOSED
+        assert woken == [0, 1, 2]
+        assert destination.failures == 0
+
+    asyncio.run(main())
+
+
+def test_failed_probe_parks_its_job_and_reopens():
+    async def main():
+        destination = Destinations(threshold=1, cooldown=COOLDOWN).get(URL)
+        destination.acquire()
+        destination.release(False)
+        await asyncio.sleep(COOLDOWN * 2)
+        assert destination.state == HALF_OPEN
+
+        probe = destination.acquire()
+        with pytest.raises(Parked) as parked:
+            destination.release(False, probe)
+        woken = []
+        parked.value.wake_up(lambda: woken.append(0))
+        assert destination.state == OPEN
+
+        await asyncio.sleep(COOLDOWN * 2)
+        assert woken == [0]
+        assert destination.acquire() is True
+        destination.release(True, True)
+        assert destination.state == CLOSED
+
+    asyncio.run(main())
+
+
+def test_jobs_keep_their_attempts_while_the_host_is_down(tmp_path):
+    attempts = []
+
+    async def main():
+        destination = Destinations(threshold=1, cooldown=COOLDOWN).get(URL)
+
+        async def deliver(email, data, attempt):
+            probe = destination.acquire()
+            attempts.append(attempt)
+            destination.release(False, probe)
+            # two attempts, as with max_attempts=2
+            return 0.001 if attempt < 1 else None
+
+        spool = WebhookSpool(str(tmp_path), workers=1)
+        await spool.start(deliver)
+        spool.enqueue("test@example.com", {})
+        await asyncio.sleep(COOLDOWN * 8)
+        await spool.stop()
+        destination.close()
+
+    asyncio.run(main())
+    # the first attempt opened the circuit, every probe of the last attempt failed
+    assert attempts[0] == 0 and len(attempts) > 2
+    assert set(attempts[1:]) == {1}
+    assert len(os.listdir(tmp_path)) == 1
@@ -0,0 +1,78 @@
+"""
+Durability of the webhook spool. Run with: python -m pytest tests
+"""
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import group_commit  # noqa: E402
+from group_commit import GroupCommit  # noqa: E402
+from webhook_spool import WebhookSpool  # noqa: E402
+
+
+def recorded_fsyncs(monkeypatch) -> list[str]:
+    synced = []
+    real = group_commit.fsync_path
+
+    def fsync_path(path: str) -> None:
+        synced.append(path)
+        real(path)
+
+    monkeypatch.setattr(group_commit, "fsync_path", fsync_path)
+    return synced
+
+
+def test_jobs_are_fsynced_with_their_directory(tmp_path, monkeypatch):
+    synced = recorded_fsyncs(monkeypatch)
+    spool = WebhookSpool(str(tmp_path))
+    spool.enqueue_many([("a@example.com", {"n": 1}), ("b@example.com", {"n": 2})])
+
+    jobs = sorted(os.listdir(tmp_path))
+    assert len(jobs) == 2 and all(job.endswith(".json") for job in jobs)
+    # the temporary files before the rename, then the directory once
+    assert len([path for path in synced if path.endswith(".tmp")]) == 2
+    assert synced.count(str(tmp_path)) == 1
+    emails = {json.loads((tmp_path / job).read_text())["email"] for job in jobs}
+    assert emails == {"a@example.com", "b@example.com"}
+
+
+def test_jobs_follow_the_fsync_mode(tmp_path, monkeypatch):
+    synced = recorded_fsyncs(monkeypatch)
+    os.makedirs(tmp_path / "none")
+    WebhookSpool(str(tmp_path / "none"), committer=GroupCommit("none")).enqueue(
+        "a@example.com", {}
+    )
+    assert synced == []
+
+    committer = GroupCommit("batch", window=0.001)
+    committer.start()
+    try:
+        os.makedirs(tmp_path / "batch")
+        WebhookSpool(str(tmp_path / "batch"), committer=committer).enqueue("a@example.com", {})
+    finally:
+        committer.stop()
+    assert str(tmp_path / "batch") in synced
+    assert len(os.listdir(tmp_path / "batch")) == 1
+
+
+def test_resume_drops_unfinished_writes_and_queues_jobs(tmp_path):
+    spool = WebhookSpool(str(tmp_path))
+    spool.enqueue("a@example.com", {})
+    (tmp_path / "1-dead.json.0123abcd.tmp").write_text("{")
+    delivered = []
+
+    async def deliver(email, data, attempt):
+        delivered.append(email)
+        return None
+
+    async def main():
+        await spool.start(deliver)
+        await asyncio.sleep(0.1)
+        await spool.stop()
+
+    asyncio.run(main())
+    assert delivered == ["a@example.com"]
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Compare the COMPRESSION codecs of the mailserver: disk usage of the message
+files (the JSON per mailbox and the raw messages), the CPU cost of ingest
+and the cost of reading the messages back, as the web UI does.
+
+The corpus is a directory of .eml files (e.g. a copy of data/_raw, which may
+itself be compressed) or, by default, a generated mix of plain, HTML
+newsletter and attachment messages. Every message is run through
+CustomHandler.handle_DATA once per codec, into a temporary data directory.
+
+Example:
+    python tools/bench_compression.py
+    python tools/bench_compression.py --corpus /var/www/opentrashmail/data/_raw --recipients 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import compress  # noqa: E402
+import mailserver3  # noqa: E402
+from bench_ingest import deliver  # noqa: E402
+from send import (  # noqa: E402
+    build_attachment_message,
+    build_html_message,
+    build_multipart_message,
+    build_plain_message,
+)
+
+WORDS = (
+    "account order invoice shipping update newsletter offer discount member "
+    "password reset confirm subscription weekly digest product support team "
+    "unsubscribe privacy policy customer service delivery tracking"
+).split()
+
+
+def build_newsletter_message(rng: random.Random) -> EmailMessage:
+    msg = build_multipart_message()
+    del msg["Subject"]
+    msg["Subject"] = "Your weekly " + " ".join(rng.choices(WORDS, k=3))
+    rows = "".join(
+        f'<tr><td style="padding:8px;font-family:Arial,sans-serif;color:#333">'
+        f'<a href="https://example.com/item/{rng.randrange(10**6)}?utm_source=mail">'
+        f"{' '.join(rng.choices(WORDS, k=6))}</a></td>"
+        f'<td style="text-align:right">{rng.randrange(100, 9999) / 100:.2f} EUR</td></tr>'
+        for _ in range(rng.randrange(40, 400))
+    )
+    msg.get_body(("html",)).set_content(
+        f"<html><body><table width='600'>{rows}</table></body></html>", subtype="html"
+    )
+    return msg
+
+
+def build_report_message(rng: random.Random) -> EmailMessage:
+    msg = build_attachment_message()
+    lines = [
+        f"{rng.randrange(10**9)},{rng.choice(WORDS)},{rng.randrange(10**4)},"
+        f"2026-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+        for _ in range(rng.randrange(1000, 20000))
+    ]
+    msg.add_attachment(
+        "\n".join(lines).encode(), maintype="text", subtype="csv", filename="report.csv"
+    )
+    return msg
+
+
+def build_image_message(rng: random.Random) -> EmailMessage:
+    msg = build_html_message()
+    msg.add_attachment(
+        rng.randbytes(rng.randrange(20_000, 400_000)),
+        maintype="image",
+        subtype="jpeg",
+        filename="photo.jpg",
+    )
+    return msg
+
+
+def generated_corpus(count: int) -> list[bytes]:
+    rng = random.Random(42)
+    builders = [
+        lambda: build_plain_message(),
+        lambda: build_multipart_message(),
+        lambda: build_newsletter_message(rng),
+        lambda: build_newsletter_message(rng),
+        lambda: build_newsletter_message(rng),
+        lambda: build_report_message(rng),
+        lambda: build_image_message(rng),
+    ]
+    return [builders[i % len(builders)]().as_bytes() for i in range(count)]
+
+
+def load_corpus(path: str, limit: int) -> list[bytes]:
+    messages = []
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if name.endswith(".eml"):
+                messages.append(compress.read_file(os.path.join(root, name)))
+                if len(messages) >= limit:
+                    return messages
+    return messages
+
+
+def stored_files(data_dir: str) -> list[str]:
+    """Message JSON files and raw messages (each blob once, not its hardlinks)."""
+    paths = []
+    for mailbox in os.listdir(data_dir):
+        email_dir = os.path.join(data_dir, mailbox)
+        if "@" in mailbox and os.path.isdir(email_dir):
+            paths += [
+                os.path.join(email_dir, name)
+                for name in os.listdir(email_dir)
+                if mailserver3.MESSAGE_FILE_RE.match(name)
+            ]
+    raw_dir = mailserver3.raw_store_dir()
+    if os.path.isdir(raw_dir):
+        paths += [os.path.join(raw_dir, name) for name in os.listdir(raw_dir)]
+    return paths
+
+
+def read_back(data_dir: str) -> int:
+    """Read every message with its raw source, like the web UI. Returns the count."""
+    count = 0
+    for mailbox in os.listdir(data_dir):
+        email_dir = os.path.join(data_dir, mailbox)
+        if "@" not in mailbox or not os.path.isdir(email_dir):
+            continue
+        for name in os.listdir(email_dir):
+            match = mailserver3.MESSAGE_FILE_RE.match(name)
+            if match:
+                savedata = json.loads(compress.read_file(os.path.join(email_dir, name)))
+                mailserver3.load_raw_bytes(email_dir, match.group(1), savedata)
+                count += 1
+    return count
+
+
+async def bench_codec(name: str, corpus: list[bytes], args) -> dict:
+    mailserver3.COMPRESSION = name
+    mailserver3._storage = None
+    mailserver3._group_commit = None
+    handler = mailserver3.CustomHandler("Bench", None, None)
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for i, content in enumerate(corpus):
+        await deliver(handler, content, f"bench{i % args.mailboxes}@example.com")
+    ingest = time.perf_counter() - start
+    ingest_cpu = time.process_time() - cpu
+
+    size = sum(os.path.getsize(path) for path in stored_files(mailserver3.DATA_DIR))
+
+    start = time.perf_counter()
+    read = read_back(mailserver3.DATA_DIR)
+    read_time = time.perf_counter() - start
+
+    return {
+        "codec": name,
+        "size": size,
+        "ingest_ms": ingest / len(corpus) * 1000,
+        "ingest_cpu_ms": ingest_cpu / len(corpus) * 1000,
+        "read_ms": read_time / read * 1000,
+    }
+
+
+async def main(args) -> None:
+    corpus = load_corpus(args.corpus, args.messages) if args.corpus else generated_corpus(args.messages)
+    if not corpus:
+        sys.exit("No .eml files found")
+    mailserver3.URL = "http://localhost"
+    total = sum(map(len, corpus))
+    print(
+        f"{len(corpus)} messages, {total / 1e6:.1f} MB raw "
+        f"(avg {total / len(corpus) / 1e3:.1f} kB), {args.mailboxes} mailboxes"
+    )
+    print(f"{'codec':<6} {'stored':>9} {'ratio':>6} {'ingest':>9} {'cpu':>9} {'read':>9}")
+
+    baseline = None
+    for name in args.codecs:
+        if name != "none" and compress.get_codec(name) is None:
+            print(f"{name:<6} not available")
+            continue
+        with tempfile.TemporaryDirectory(dir=args.data_dir) as tmp:
+            mailserver3.DATA_DIR = tmp
+            r = await bench_codec(name, corpus, args)
+        baseline = baseline or r["size"]
+        print(
+            f"{r['codec']:<6} {r['size'] / 1e6:>7.1f}MB {baseline / r['size']:>5.2f}x "
+            f"{r['ingest_ms']:>7.2f}ms {r['ingest_cpu_ms']:>7.2f}ms {r['read_ms']:>7.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark COMPRESSION codecs")
+    parser.add_argument("--corpus", help="directory of .eml files (default: generated)")
+    parser.add_argument("--messages", type=int, default=700, help="messages to use at most")
+    parser.add_argument("--mailboxes", type=int, default=10, help="distinct recipients")
+    parser.add_argument(
+        "--data-dir", default=None, help="where to create the temporary data directories"
+    )
+    parser.add_argument(
+        "--codecs", nargs="+", default=["none", "zlib", "lzma", "zstd"],
+        choices=["none", "zlib", "lzma", "zstd"],
+    )
+    asyncio.run(main(parser.parse_args()))
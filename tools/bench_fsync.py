@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Measure what the FSYNC modes of the mailserver cost in ingest throughput.
+
+Messages are fed into CustomHandler.handle_DATA by a number of concurrent
+senders, once per mode. Run it on the disk the data directory lives on:
+/tmp is often a tmpfs, where fsync is free and all modes look the same.
+
+Example:
+    python tools/bench_fsync.py --data-dir ./data --messages 500 --concurrency 32
+    python tools/bench_fsync.py --data-dir ./data --storage sqlite --modes none batch
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import mailserver3  # noqa: E402
+from bench_ingest import deliver, percentile  # noqa: E402
+from send import build_attachment_message  # noqa: E402
+
+
+async def bench_mode(mode: str, content: bytes, args) -> dict:
+    mailserver3.FSYNC = mode
+    mailserver3.FSYNC_BATCH_WINDOW = args.window
+    mailserver3._group_commit = None
+    mailserver3._storage = None
+    committer = mailserver3.group_commit()
+    committer.start()
+    parse_executor, io_executor = mailserver3.create_ingest_executors("thread", args.workers)
+    handler = mailserver3.CustomHandler("Bench", parse_executor, io_executor)
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for i in range(args.messages):
+        queue.put_nowait(f"bench{i % args.mailboxes}@example.com")
+    latencies: list[float] = []
+
+    async def sender() -> None:
+        while not queue.empty():
+            latencies.append(await deliver(handler, content, queue.get_nowait()))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    for executor in {parse_executor, io_executor} - {None}:
+        executor.shutdown(wait=True)
+    committer.stop()
+
+    return {
+        "mode": mode,
+        "rate": args.messages / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+async def main(args) -> None:
+    content = build_attachment_message().as_bytes()
+    mailserver3.STORAGE = args.storage
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    print(
+        f"{args.messages} messages of {len(content) / 1e3:.1f} kB, "
+        f"concurrency {args.concurrency}, storage {args.storage}, "
+        f"batch window {args.window:g}ms"
+    )
+    print(f"{'mode':<8} {'msg/s':>8} {'p50':>9} {'p99':>9}")
+
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory(dir=args.data_dir) as tmp:
+            mailserver3.DATA_DIR = tmp
+            r = await bench_mode(mode, content, args)
+        print(
+            f"{r['mode']:<8} {r['rate']:>8.0f} {r['p50_ms']:>7.1f}ms {r['p99_ms']:>7.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark FSYNC modes")
+    parser.add_argument(
+        "--data-dir", default=".", help="where to create the temporary data directories"
+    )
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent senders")
+    parser.add_argument("--mailboxes", type=int, default=10, help="distinct recipients")
+    parser.add_argument("--window", type=float, default=5, help="FSYNC_BATCH_WINDOW in ms")
+    parser.add_argument("--workers", type=int, default=0, help="executor workers (0 = auto)")
+    parser.add_argument("--storage", default="files", choices=["files", "sqlite"])
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["none", "batch", "always"],
+        choices=["none", "batch", "always"],
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Compare ingest latency of the mailserver's INGEST_EXECUTOR modes.
+
+Large messages and small "probe" messages are fed into CustomHandler.handle_DATA
+concurrently, while a ticker measures how long the event loop is blocked. The
+inline mode shows how one big message stalls everyone else; the thread and
+process modes should keep the small-message latency and loop lag low.
+
+Everything is written to a temporary data directory, no SMTP socket or network
+is involved.
+
+Example:
+    python tools/bench_ingest.py --large 4 --large-size 20 --small 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import mailserver3  # noqa: E402
+from send import build_attachment_message, build_plain_message  # noqa: E402
+
+
+def build_large_message(size_mb: int) -> bytes:
+    msg = build_attachment_message()
+    msg.add_attachment(
+        os.urandom(size_mb * 1024 * 1024),
+        maintype="application",
+        subtype="octet-stream",
+        filename="large.bin",
+    )
+    return msg.as_bytes()
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def deliver(handler, content: bytes, rcpt: str, arrived: float | None = None) -> float:
+    """Run one message through handle_DATA, latency counted from its arrival."""
+    session = SimpleNamespace(peer=("127.0.0.1", 0))
+    envelope = SimpleNamespace(
+        mail_from="bench@example.com", rcpt_tos=[rcpt], content=content
+    )
+    start = arrived if arrived is not None else time.perf_counter()
+    await handler.handle_DATA(None, session, envelope)
+    return time.perf_counter() - start
+
+
+async def measure_lag(stop: asyncio.Event, lags: list[float], interval: float = 0.005):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def bench_mode(mode: str, workers: int, large: bytes, small: bytes, args) -> dict:
+    parse_executor, io_executor = mailserver3.create_ingest_executors(mode, workers)
+    handler = mailserver3.CustomHandler("Bench", parse_executor, io_executor)
+
+    # warm up pools (process start-up must not be part of the measurement)
+    await deliver(handler, small, "warmup@example.com")
+
+    lags: list[float] = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(measure_lag(stop, lags))
+
+    start = time.perf_counter()
+    large_tasks = [
+        asyncio.create_task(deliver(handler, large, f"large{i}@example.com"))
+        for i in range(args.large)
+    ]
+    # small messages "arrive" at a steady rate while the large ones are ingested
+    small_tasks = []
+    for i in range(args.small):
+        small_tasks.append(
+            asyncio.create_task(
+                deliver(handler, small, f"small{i % 10}@example.com", time.perf_counter())
+            )
+        )
+        await asyncio.sleep(args.interval / 1000)
+    small_latencies = await asyncio.gather(*small_tasks)
+    large_latencies = await asyncio.gather(*large_tasks)
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await ticker
+    for executor in {parse_executor, io_executor} - {None}:
+        executor.shutdown(wait=True)
+
+    return {
+        "mode": mode,
+        "elapsed_s": elapsed,
+        "small_p50_ms": percentile(small_latencies, 50) * 1000,
+        "small_p99_ms": percentile(small_latencies, 99) * 1000,
+        "large_mean_ms": statistics.mean(large_latencies) * 1000 if large_latencies else 0.0,
+        "loop_lag_max_ms": max(lags, default=0.0) * 1000,
+    }
+
+
+async def main(args) -> None:
+    large = build_large_message(args.large_size)
+    small = build_plain_message().as_bytes()
+
+    print(
+        f"{args.large} x {len(large) / 1e6:.1f} MB messages, "
+        f"{args.small} small messages, workers={args.workers or 'auto'}"
+    )
+    print(
+        f"{'mode':<8} {'total s':>8} {'small p50':>10} {'small p99':>10} "
+        f"{'large avg':>10} {'max lag':>9}"
+    )
+
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as tmp:
+            mailserver3.DATA_DIR = tmp
+            r = await bench_mode(mode, args.workers, large, small, args)
+        print(
+            f"{r['mode']:<8} {r['elapsed_s']:>8.2f} {r['small_p50_ms']:>8.1f}ms "
+            f"{r['small_p99_ms']:>8.1f}ms {r['large_mean_ms']:>8.1f}ms "
+            f"{r['loop_lag_max_ms']:>7.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark INGEST_EXECUTOR modes")
+    parser.add_argument("--large", type=int, default=4, help="number of large messages")
+    parser.add_argument("--large-size", type=int, default=20, help="size of large attachment in MB")
+    parser.add_argument("--small", type=int, default=200, help="number of small messages")
+    parser.add_argument("--interval", type=float, default=5, help="ms between small messages")
+    parser.add_argument("--workers", type=int, default=0, help="executor workers (0 = auto)")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["inline", "thread", "process"],
+        choices=["inline", "thread", "process"],
+    )
+    asyncio.run(main(parser.parse_args()))
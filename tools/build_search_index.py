@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Add the mail that is already stored to the full-text search index
+(SEARCH_INDEX=true), e.g. after enabling it. Works with both STORAGE
+backends and can run while the mailserver is running: messages that are
+already indexed are skipped.
+
+Example:
+    python tools/build_search_index.py
+    python tools/build_search_index.py --data-dir /var/www/opentrashmail/data
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import compress  # noqa: E402
+import mailserver3  # noqa: E402
+from search import SearchIndex  # noqa: E402
+from storage import SqliteStorage, database_path  # noqa: E402
+
+
+def index_files(index: SearchIndex, data_dir: str) -> int:
+    total = 0
+    for mailbox in sorted(os.listdir(data_dir)):
+        email_dir = os.path.join(data_dir, mailbox)
+        if "@" not in mailbox or mailbox.startswith("_") or not os.path.isdir(email_dir):
+            continue
+        for name in sorted(os.listdir(email_dir)):
+            match = mailserver3.MESSAGE_FILE_RE.match(name)
+            if not match:
+                continue
+            path = os.path.join(email_dir, name)
+            try:
+                parsed = json.loads(compress.read_file(path))["parsed"]
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"  {mailbox}/{name}: unreadable ({e}), skipped")
+                continue
+            index.add(
+                [mailbox],
+                match.group(1),
+                parsed.get("subject") or "",
+                parsed.get("from") or "",
+                parsed.get("body") or "",
+                parsed.get("htmlbody") or "",
+                os.stat(path).st_mtime,
+            )
+            total += 1
+    return total
+
+
+def index_sqlite(index: SearchIndex, data_dir: str) -> int:
+    db = SqliteStorage(data_dir).connection()
+    rows = db.execute(
+        "SELECT r.mailbox, m.message_id, m.subject, m.from_addr, m.body, m.htmlbody,"
+        " m.received_at FROM recipients r JOIN messages m ON m.id = r.message"
+        " ORDER BY m.id"
+    )
+    total = 0
+    for mailbox, message_id, subject, sender, body, htmlbody, received_at in rows:
+        index.add([mailbox], message_id, subject, sender, body, htmlbody, received_at)
+        total += 1
+    return total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Add stored mail to the search index")
+    parser.add_argument(
+        "--data-dir", default=mailserver3.DATA_DIR, help="data directory (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+    index = SearchIndex(data_dir)
+    total = index_files(index, data_dir)
+    if os.path.exists(database_path(data_dir)):
+        total += index_sqlite(index, data_dir)
+    index.merge()
+
+    print(f"Indexed {total} message(s) in {index.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Import the mailboxes of the file layout (data/<email>/<id>.json) into the
+SQLite storage backend, before switching to STORAGE=sqlite. Stop the
+mailserver first. Running it again skips messages that were already imported.
+
+Copies of a message delivered to several mailboxes become one message with
+several recipients. Raw messages and attachments that are not yet in the
+content-addressed stores (mail from older versions) are added to them.
+
+Example:
+    python tools/migrate_to_sqlite.py                  # keep the files
+    python tools/migrate_to_sqlite.py --remove-files   # delete what was imported
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import compress  # noqa: E402
+import mailserver3  # noqa: E402
+from storage import SqliteStorage  # noqa: E402
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def import_attachments(email_dir: str, edata: dict) -> list[dict]:
+    """Attachment details with their sha256, making sure every blob is stored."""
+    details_by_id = {d.get("id"): d for d in edata.get("attachments_details") or []}
+    store_dir = mailserver3.attachment_store_dir()
+    result = []
+    for file_id in edata.get("attachments") or []:
+        details = dict(details_by_id.get(file_id) or {"id": file_id, "filename": file_id})
+        path = os.path.join(email_dir, "attachments", os.path.basename(file_id))
+        digest = details.get("sha256")
+        if not (digest and os.path.exists(os.path.join(store_dir, digest))):
+            if not os.path.isfile(path):
+                print(f"  {file_id}: attachment file missing, skipped")
+                continue
+            digest = file_sha256(path)
+            with open(path, "rb") as f:
+                mailserver3.store_blob(store_dir, digest, f.read())
+        details["sha256"] = digest
+        details.setdefault("size", os.path.getsize(os.path.join(store_dir, digest)))
+        result.append(details)
+    return result
+
+
+def import_message(
+    storage: SqliteStorage, mailbox: str, email_dir: str, message_id: str
+) -> bool:
+    json_path = os.path.join(email_dir, f"{message_id}.json")
+    try:
+        savedata = json.loads(compress.read_file(json_path))
+    except (OSError, ValueError) as e:
+        print(f"  {message_id}: unreadable ({e}), skipped")
+        return False
+    if not isinstance(savedata, dict) or "parsed" not in savedata:
+        return False
+
+    raw = mailserver3.load_raw_bytes(email_dir, message_id, savedata)
+    raw_ref = savedata.get("raw_ref") or ""
+    if not mailserver3.BLOB_RE.match(raw_ref):
+        raw_ref = hashlib.sha256(raw).hexdigest()
+    mailserver3.store_blob(mailserver3.raw_store_dir(), f"{raw_ref}.eml", raw)
+    size, digest = mailserver3.message_digest(message_id, raw)
+
+    edata = dict(savedata["parsed"])
+    edata["attachments_details"] = import_attachments(email_dir, edata)
+    # the database keeps the HTML with its cid: references, see Mailbox.php
+    htmlbody = edata.get("htmlbody") or ""
+    for details in edata["attachments_details"]:
+        if details.get("cid"):
+            htmlbody = htmlbody.replace(
+                f"/api/attachment/{mailbox}/{details['id']}", f"cid:{details['cid']}"
+            )
+    edata["htmlbody"] = htmlbody
+
+    savedata = {k: v for k, v in savedata.items() if k != "raw"}
+    savedata["parsed"] = edata
+    storage.insert(
+        [mailbox],
+        message_id,
+        os.stat(json_path).st_mtime,
+        savedata,
+        raw_ref,
+        size,
+        digest,
+    )
+    return True
+
+
+def remove_imported(email_dir: str, message_ids: list[str], complete: bool) -> None:
+    for message_id in message_ids:
+        for name in (f"{message_id}.json", f"{message_id}.eml"):
+            try:
+                os.remove(os.path.join(email_dir, name))
+            except FileNotFoundError:
+                pass
+    if not complete:
+        # attachments of the skipped messages are still needed
+        return
+    shutil.rmtree(os.path.join(email_dir, "attachments"), ignore_errors=True)
+    try:
+        os.remove(os.path.join(email_dir, mailserver3.MAILBOX_INDEX))
+    except FileNotFoundError:
+        pass
+    try:
+        # unless it holds a webhook.json
+        os.rmdir(email_dir)
+    except OSError:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Import mailboxes into the SQLite storage")
+    parser.add_argument(
+        "--data-dir", default=mailserver3.DATA_DIR, help="data directory (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--remove-files",
+        action="store_true",
+        help="delete the message files of every imported mailbox (keeps webhook.json)",
+    )
+    args = parser.parse_args()
+
+    mailserver3.DATA_DIR = os.path.abspath(args.data_dir)
+    storage = SqliteStorage(mailserver3.DATA_DIR)
+
+    mailboxes = total = 0
+    for mailbox in sorted(os.listdir(mailserver3.DATA_DIR)):
+        email_dir = os.path.join(mailserver3.DATA_DIR, mailbox)
+        if "@" not in mailbox or mailbox.startswith("_") or not os.path.isdir(email_dir):
+            continue
+
+        message_ids = sorted(
+            match.group(1)
+            for match in map(mailserver3.MESSAGE_FILE_RE.match, os.listdir(email_dir))
+            if match
+        )
+        imported = [
+            message_id
+            for message_id in message_ids
+            if import_message(storage, mailbox, email_dir, message_id)
+        ]
+        storage.add_mailbox(mailbox, os.stat(email_dir).st_mtime)
+
+        if args.remove_files:
+            remove_imported(email_dir, imported, len(imported) == len(message_ids))
+        mailboxes += 1
+        total += len(imported)
+        print(f"{mailbox}: {len(imported)} message(s)")
+
+    print(f"Imported {mailboxes} mailbox(es) with {total} message(s) into {storage.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Regenerate the per-mailbox index files (index.jsonl) from the stored message
+JSON files. Run it once after upgrading, or whenever an index is suspected to
+be out of sync. Safe to run while the mailserver is receiving mail.
+
+Example:
+    python tools/rebuild_index.py                 # all mailboxes
+    python tools/rebuild_index.py b@domain.tld    # selected mailboxes
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python"))
+
+import mailserver3  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuild mailbox index files")
+    parser.add_argument("emails", nargs="*", help="only rebuild these mailboxes")
+    parser.add_argument(
+        "--data-dir", default=mailserver3.DATA_DIR, help="data directory (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    mailserver3.DATA_DIR = os.path.abspath(args.data_dir)
+
+    if args.emails:
+        dirs = [mailserver3.safe_email_dir(email) for email in args.emails]
+    else:
+        dirs = [
+            os.path.join(mailserver3.DATA_DIR, entry)
+            for entry in sorted(os.listdir(mailserver3.DATA_DIR))
+            if "@" in entry and not entry.startswith("_")
+        ]
+
+    total = 0
+    for email_dir in dirs:
+        if not os.path.isdir(email_dir):
+            print(f"Skipping {email_dir}: not a mailbox")
+            continue
+        count = mailserver3.rebuild_mailbox_index(email_dir)
+        total += count
+        print(f"{os.path.basename(email_dir)}: {count} message(s)")
+
+    print(f"Rebuilt {len(dirs)} index(es) with {total} message(s)")
+
+
+if __name__ == "__main__":
+    main()
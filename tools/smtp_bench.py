@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+SMTP load generator for capacity planning.
+
+Opens many concurrent SMTP sessions against a running mailserver and replays
+a weighted mix of message profiles (message type, attachment count and size,
+recipient count). Reports messages per second, the latency from DATA to the
+final 250 reply (p50/p99/p999) and, if the server's pid is given, its peak
+memory. Results can be written as JSON to compare runs across versions.
+
+Start the mailserver locally first (e.g. MAILPORT=2525, DOMAINS=domain.tld),
+then for example:
+
+    python tools/smtp_bench.py --messages 2000 --concurrency 32 \\
+        --profile weight=80,kind=plain \\
+        --profile weight=15,kind=attachment,attachments=2,size=256K,rcpts=3 \\
+        --profile weight=5,kind=multipart,attachments=1,size=8M \\
+        --server-pid $(pgrep -f mailserver3.py | head -1) --output run.json
+
+Every message gets a unique header, so the content-addressed stores of the
+server don't turn repeated messages into cheap duplicates.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import smtplib
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from send import (  # noqa: E402
+    build_attachment_message,
+    build_html_message,
+    build_multipart_message,
+    build_plain_message,
+)
+
+BUILDERS = {
+    "plain": build_plain_message,
+    "html": build_html_message,
+    "multipart": build_multipart_message,
+    "attachment": build_attachment_message,
+}
+
+DEFAULT_PROFILES = [
+    "weight=70,kind=plain",
+    "weight=20,kind=multipart,rcpts=2",
+    "weight=10,kind=attachment,attachments=2,size=512K,rcpts=3",
+]
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper()
+    for suffix, factor in (("K", 1024), ("M", 1024**2), ("G", 1024**3)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+
+def parse_profile(spec: str) -> dict:
+    """weight=..,kind=..,attachments=..,size=..,rcpts=.. -> profile dict"""
+    profile = {"weight": 1, "kind": "plain", "attachments": 0, "size": 0, "rcpts": 1}
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key not in profile:
+            raise argparse.ArgumentTypeError(f"unknown profile key: {key}")
+        if key == "kind":
+            if value not in BUILDERS:
+                raise argparse.ArgumentTypeError(f"unknown message kind: {value}")
+            profile[key] = value
+        elif key == "size":
+            profile[key] = parse_size(value)
+        else:
+            profile[key] = int(value)
+    profile["name"] = spec
+    return profile
+
+
+def build_profile_message(profile: dict) -> bytes:
+    msg = BUILDERS[profile["kind"]]()
+    for i in range(profile["attachments"]):
+        msg.add_attachment(
+            os.urandom(profile["size"]),
+            maintype="application",
+            subtype="octet-stream",
+            filename=f"bench-{i}.bin",
+        )
+    return msg.as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def process_tree(pid: int) -> list[int]:
+    pids = [pid]
+    for parent in pids:
+        try:
+            with open(f"/proc/{parent}/task/{parent}/children") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def memory_kb(pid: int, field: str) -> int:
+    """Sum of a /proc/<pid>/status field (VmRSS, VmHWM) over the process tree."""
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith(field + ":"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Samples the server's resident memory while the benchmark runs."""
+
+    def __init__(self, pid: int, interval: float = 0.2) -> None:
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            self.peak_kb = max(self.peak_kb, memory_kb(self.pid, "VmRSS"))
+            self.stopped.wait(self.interval)
+
+
+class Worker(threading.Thread):
+    def __init__(self, bench: "Benchmark", index: int) -> None:
+        super().__init__(daemon=True)
+        self.bench = bench
+        self.index = index
+        self.latencies: list[float] = []
+        self.errors: dict[str, int] = {}
+
+    def connect(self) -> smtplib.SMTP:
+        client = smtplib.SMTP(self.bench.args.host, self.bench.args.port, timeout=120)
+        client.ehlo("bench.local")
+        return client
+
+    def run(self) -> None:
+        args = self.bench.args
+        rng = random.Random(args.seed + self.index)
+        client = None
+        while True:
+            seq = self.bench.next_seq()
+            if seq is None:
+                break
+            profile = rng.choices(self.bench.profiles, self.bench.weights)[0]
+            content = b"X-Bench-Seq: %d-%d\r\n" % (os.getpid(), seq) + profile["content"]
+            rcpts = [
+                f"bench{(seq + i) % args.mailboxes}@{args.domain}"
+                for i in range(profile["rcpts"])
+            ]
+            try:
+                if client is None:
+                    client = self.connect()
+                else:
+                    client.rset()
+                client.mail("bench@example.com")
+                for rcpt in rcpts:
+                    client.rcpt(rcpt)
+                start = time.perf_counter()
+                code, _ = client.data(content)
+                latency = time.perf_counter() - start
+                if code == 250:
+                    self.latencies.append(latency)
+                else:
+                    self.error(f"DATA {code}")
+            except (smtplib.SMTPException, OSError) as e:
+                self.error(type(e).__name__)
+                if client is not None:
+                    client.close()
+                client = None
+                continue
+            if args.new_connection:
+                client.quit()
+                client = None
+        if client is not None:
+            try:
+                client.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class Benchmark:
+    def __init__(self, args) -> None:
+        self.args = args
+        self.profiles = [parse_profile(spec) for spec in args.profile or DEFAULT_PROFILES]
+        for profile in self.profiles:
+            profile["content"] = build_profile_message(profile)
+        self.weights = [p["weight"] for p in self.profiles]
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.deadline = None
+
+    def next_seq(self) -> int | None:
+        with self.lock:
+            if self.args.duration:
+                if time.monotonic() >= self.deadline:
+                    return None
+            elif self.seq >= self.args.messages:
+                return None
+            self.seq += 1
+            return self.seq
+
+    def run(self) -> dict:
+        args = self.args
+        sampler = RssSampler(args.server_pid) if args.server_pid else None
+        if sampler:
+            sampler.start()
+
+        workers = [Worker(self, i) for i in range(args.concurrency)]
+        start = time.perf_counter()
+        self.deadline = time.monotonic() + args.duration
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        latencies = [lat for w in workers for lat in w.latencies]
+        errors: dict[str, int] = {}
+        for worker in workers:
+            for kind, count in worker.errors.items():
+                errors[kind] = errors.get(kind, 0) + count
+
+        result = {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "version": git_revision(),
+            "python": platform.python_version(),
+            "host": f"{args.host}:{args.port}",
+            "concurrency": args.concurrency,
+            "new_connection": args.new_connection,
+            "profiles": [
+                {k: v for k, v in p.items() if k != "content"} | {"bytes": len(p["content"])}
+                for p in self.profiles
+            ],
+            "messages": len(latencies),
+            "errors": errors,
+            "elapsed_s": elapsed,
+            "messages_per_s": len(latencies) / elapsed if elapsed else 0.0,
+            "latency_ms": {
+                "p50": percentile(latencies, 50) * 1000,
+                "p99": percentile(latencies, 99) * 1000,
+                "p999": percentile(latencies, 99.9) * 1000,
+                "max": max(latencies, default=0.0) * 1000,
+            },
+        }
+
+        if sampler:
+            sampler.stopped.set()
+            sampler.join()
+            result["server_rss_peak_kb"] = sampler.peak_kb
+            result["server_hwm_kb"] = memory_kb(args.server_pid, "VmHWM")
+        return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="SMTP throughput and latency benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--concurrency", type=int, default=16, help="parallel SMTP sessions")
+    parser.add_argument("--messages", type=int, default=1000, help="messages to send in total")
+    parser.add_argument(
+        "--duration", type=float, default=0, help="run for this many seconds instead of --messages"
+    )
+    parser.add_argument(
+        "--profile",
+        action="append",
+        help="message profile, e.g. weight=10,kind=attachment,attachments=2,size=1M,rcpts=3 "
+        f"(kinds: {', '.join(BUILDERS)}; repeat for a mix)",
+    )
+    parser.add_argument("--domain", default="domain.tld", help="recipient domain")
+    parser.add_argument("--mailboxes", type=int, default=100, help="distinct recipient mailboxes")
+    parser.add_argument(
+        "--new-connection", action="store_true", help="one SMTP session per message"
+    )
+    parser.add_argument("--server-pid", type=int, help="mailserver pid, to report its memory")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    result = Benchmark(args).run()
+
+    lat = result["latency_ms"]
+    print(
+        f"{result['messages']} messages in {result['elapsed_s']:.2f}s "
+        f"({result['messages_per_s']:.1f} msg/s), concurrency {args.concurrency}"
+    )
+    print(
+        f"DATA -> 250: p50 {lat['p50']:.1f}ms  p99 {lat['p99']:.1f}ms  "
+        f"p999 {lat['p999']:.1f}ms  max {lat['max']:.1f}ms"
+    )
+    if result["errors"]:
+        print(f"errors: {result['errors']}")
+    if "server_rss_peak_kb" in result:
+        print(
+            f"server memory: peak RSS {result['server_rss_peak_kb'] / 1024:.1f} MiB, "
+            f"high water mark {result['server_hwm_kb'] / 1024:.1f} MiB"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()